@@ -0,0 +1,65 @@
+"""import-time benchmark of maesters
+
+    python benchmarks/bench_import.py [--repeat 5]
+
+Times `import maesters` in a fresh interpreter and the construction of a
+Maester, and exits nonzero if the best run exceeds its target. Neither may
+import xarray, pandas or a citadel module.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+IMPORT_TARGET = float(os.environ.get("MAESTERS_IMPORT_TARGET", 0.3))
+CONSTRUCT_TARGET = float(os.environ.get("MAESTERS_CONSTRUCT_TARGET", 0.05))
+
+HEAVY = ("xarray", "pandas", "pygrib", "maesters.citadels.")
+
+SCRIPT = """
+import sys, json, time
+from datetime import datetime
+t0 = time.perf_counter()
+import maesters
+t1 = time.perf_counter()
+from maesters.config import get_model
+varname = next(iter(get_model("ecmwf", "oper").by_outname))
+t2 = time.perf_counter()
+maesters.Maester(source="ecmwf", product="oper", varname=varname, batch=datetime(2022, 6, 25), hour=3)
+t3 = time.perf_counter()
+heavy = [m for m in sys.modules if m.startswith(%r)]
+print(json.dumps({"import": t1 - t0, "construct": t3 - t2, "heavy": heavy}))
+""" % (HEAVY,)
+
+
+def run_once() -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get("PYTHONPATH", "")]))
+    out = subprocess.check_output([sys.executable, "-c", SCRIPT], env=env, cwd=root)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.repeat)]
+    best_import = min(r["import"] for r in runs)
+    best_construct = min(r["construct"] for r in runs)
+    heavy = sorted({m for r in runs for m in r["heavy"]})
+    print(f"import maesters: {best_import:.3f}s (target {IMPORT_TARGET}s)")
+    print(f"Maester(...):    {best_construct:.3f}s (target {CONSTRUCT_TARGET}s)")
+
+    failed = False
+    if best_import > IMPORT_TARGET or best_construct > CONSTRUCT_TARGET:
+        failed = True
+    if heavy:
+        print(f"heavy modules imported: {heavy}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,23 @@
 import os
 import shutil
-import tempfile
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
-import xarray as xr
-import pandas as pd
+from .config import DEFAULT_MAESTER, get_model, get_concurrency
+from .citadels import get_citadel
+from .utils.cache import CACHE_ROOT, DataCache, cache_key
 
-from .config import DEFAULT_MAESTER, get_model
 
+MAX_NUMBER = get_concurrency()["ceiling"]
+# hours in flight ahead of the consumer of Maester.iter_hours
+PREFETCH = int(os.environ.get("MAESTERS_PREFETCH", 4))
 
-MAX_NUMBER = 5
+
+def split_key(key: str) -> tuple:
+    """split download_dict key '{OUTNAME}-{HOUR}' into (outname, hour)"""
+    varname, hour = key.rsplit("-", 1)
+    return varname, int(hour)
 
 
 class Maester:
@@ -23,20 +30,22 @@ class Maester:
         date: datetime = None,  # nwp predict variable time UTC
         hour: int = None,  # nwp predict variable hour from start predict time
         datahome: str = DEFAULT_MAESTER.get("datahome"),
+        bbox: tuple = None,
         **kwargs,
         # data_type: data type for ENS prediction to ECMWF ENFO, 'cf'/'pf1'/'pf2'/.../
-        # stats: stats method for ENS prediction enfo or geps 'ensmean'/'ensmax'/'ensmin'
+        # stats: stats method for ENS prediction enfo or geps 'ensmean'/'ensmax'/'ensmin', or a list of them for geps
     ) -> None:
         """Maesters instance
 
         Args:
             source (str, optional): NWP Data Provider. Defaults to DEFAULT_MAESTER.get("source").
             product (str, optional): NWP Product from Source. Defaults to DEFAULT_MAESTER.get("product").
-            varname (str, optional): NWP Variable name. Defaults to DEFAULT_MAESTER.get("varname").
+            varname (str | list, optional): NWP Variable name, or a list of names planned and downloaded together. Defaults to DEFAULT_MAESTER.get("varname").
             batch (datetime, optional): NWP batch start time (UTC). Defaults to None.
             date (datetime, optional): NWP predict time (UTC) (Notice: date should be larger than batch) . Defaults to None.
             hour (int): NWP predict hour from batch start time. Defaults to None
             datahome (str, optional): data save directory. Defaults to DEFAULT_MAESTER.get("datahome")
+            bbox (tuple, optional): (west, south, east, north), the fields are cropped to it at conversion or decode. Defaults to None for the whole grid.
 
         Raises:
             Exception: _description_
@@ -46,12 +55,16 @@ class Maester:
         self.product = product
         self.datahome = datahome
         self.varname = varname
+        self.bbox = tuple(bbox) if bbox is not None else None
         self.model = get_model(source, product)
+        self.citadel = get_citadel(source, product)
 
         if date is None and hour is None:
             raise Exception('One of "date", "hour" kwargs are needed')
 
         if isinstance(date, str):
+            import pandas as pd
+
             date = pd.to_datetime(date)
 
         if hour is None and date:
@@ -97,95 +110,313 @@ class Maester:
 
         for k, v in kwargs.items():
             setattr(self, k, v)
+        self.kwargs = kwargs
 
-        # import model get file dict method
-        exec(
-            f"from maesters.citadels.{self.source.upper()}.{self.product.lower()} import get_files_dict as get_{source}_{product}_files_dict ;self._get_files_dict = get_{source}_{product}_files_dict"
-        )
-        for k, v in self.model.variable.items():
-            if v.outname == varname:
-                self.variable = k
-                self.out = v
-                break
-        if not hasattr(self, "variable"):
-            raise Exception(f"{varname} not found")
-
-        # import model operation method
-        exec(
-            f"from maesters.citadels.{self.source.upper()}.{self.product.lower()} import operation;self._operation = operation"
-        )
+        # one or more variables, planned and transferred together
+        self.varnames = [varname] if isinstance(varname, str) else list(varname)
+        for v in self.varnames:
+            if v not in self.model.by_outname:
+                raise Exception(f"{v} not found")
+        self.var_dict = dict(self.model.by_outname[v] for v in self.varnames)
+        self.variable, self.out = self.model.by_outname[self.varnames[0]]
 
-        self.download_dict = {}
-        if self.hour and isinstance(self.hour, int):
-            self.download_dict = self._get_files_dict(
-                date=self.batch,
-                hour=self.hour,
-                var_dict={self.variable: self.out},
-                **kwargs,
-            )
-        elif self.hour and isinstance(self.hour, list):
-            self.download_dict = {}
-            for h in self.hour:
-                d = self._get_files_dict(
-                    date=self.batch,
-                    hour=h,
-                    var_dict={self.variable: self.out},
-                    **kwargs,
-                )
-                for k, v in d.items():
-                    self.download_dict[k] = v
+        self._download_dict = None
+        self._plans = {}
+
+    @property
+    def download_dict(self) -> dict:
+        """files to download of each hour, discovered from source on first use"""
+        if self._download_dict is not None:
+            return self._download_dict
+        self._download_dict = {}
+        # plan hours concurrently, the index/listing documents are cached across hours
+        with ThreadPoolExecutor(max_workers=MAX_NUMBER) as pool:
+            for files in pool.map(self.plan_hour, self.hours):
+                self._download_dict.update(files)
 
-        if len(self.download_dict) == 0:
+        if len(self._download_dict) == 0:
             print("Not available date found")
+        return self._download_dict
+
+    @property
+    def hours(self) -> list:
+        """predict hours as a list"""
+        return self.hour if isinstance(self.hour, list) else [self.hour]
+
+    def plan_hour(self, hour: int) -> dict:
+        """files to download at hour, discovered from source once
+
+        Args:
+            hour (int): NWP predict hour from batch start time
+
+        Returns:
+            dict: {'{OUTNAME}-{HOUR}': download kwargs}
+        """
+        if hour not in self._plans:
+            self._plans[hour] = self._get_files_dict(
+                date=self.batch, hour=hour, var_dict=self.var_dict, **self.kwargs
+            )
+        return self._plans[hour]
+
+    def _get_files_dict(self, **kwargs) -> dict:
+        # the citadel module is imported here, on first discovery
+        return self.citadel.get_files_dict(**kwargs)
+
+    def download(self, local_dir: str = "./", keys: list = None):
+        """download and convert files of download_dict
+
+        The citadels with batch_download take all files in one call, which shares
+        the transfers, e.g. ranges of one ECMWF file are fetched in coalesced spans.
 
-    def download(self, local_dir: str = "./"):
-        # import model download method
-        exec(
-            f"from maesters.citadels.{self.source.upper()}.{self.product.lower()} import download;self._download = download"
+        Args:
+            local_dir (str, optional): save directory, datahome if empty. Defaults to "./".
+            keys (list, optional): keys of download_dict to download. Defaults to None for all.
+        """
+        self.local_fp = self._download_files(
+            {
+                k: v
+                for k, v in self.download_dict.items()
+                if keys is None or k in keys
+            },
+            local_dir,
         )
-        self.local_fp = []
+
+    def _download_files(self, files: dict, local_dir: str) -> list:
+        """download and convert files to local_dir
+
+        Args:
+            files (dict): {'{OUTNAME}-{HOUR}': download kwargs}
+            local_dir (str): save directory, datahome if empty
+
+        Returns:
+            list: local filepaths
+        """
+        items = {}
+        for k, v in files.items():
+            local_fp = (
+                os.path.join(local_dir, f"{k}.nc")
+                if local_dir
+                else os.path.join(
+                    self.datahome,
+                    f"{self.source}",
+                    f"{self.product}",
+                    self.batch.strftime("%Y%m%d%H0000"),
+                    f"{k}.nc",
+                )
+            )
+            items[k] = dict(v, local_fp=local_fp)
+            if self.bbox is not None:
+                items[k]["bbox"] = self.bbox
+        local_fps = [v["local_fp"] for v in items.values()]
+        if hasattr(self.citadel, "batch_download"):
+            fail = self.citadel.batch_download(list(items.values()))
+            if fail:
+                raise Exception(f"download fail: {[i['local_fp'] for i in fail]}")
+            return local_fps
         res = []
         with ThreadPoolExecutor(max_workers=MAX_NUMBER) as pool:
-            for k, v in self.download_dict.items():
-                local_fp = (
-                    os.path.join(local_dir, f"{k}.nc")
-                    if local_dir
-                    else os.path.join(
-                        self.datahome,
-                        f"{self.source}",
-                        f"{self.product}",
-                        self.batch.strftime("%Y%m%d%H0000"),
-                        f"{k}.nc",
-                    )
-                )
-                v["local_fp"] = local_fp
-                res.append(pool.submit(self._download, **v))
-                self.local_fp.append(local_fp)
+            for v in items.values():
+                res.append(pool.submit(self.citadel.download, **v))
             for r in as_completed(res):
                 r.result()
+        return local_fps
 
-    def operation(self, local_dir: str = None):
-        # import model operation method
+    def operation(self, local_dir: str = None, **kwargs):
+        """download and convert the latest batch of source product
+
+        Args:
+            local_dir (str, optional): output directory. Defaults to None for datahome/source/product.
+            kwargs: options of the citadel operation, like layout='variable'
+        """
+        if self.bbox is not None:
+            kwargs.setdefault("bbox", self.bbox)
         if local_dir:
-            self._operation(local_dir)
+            self.citadel.operation(local_dir, **kwargs)
         else:
-            self._operation(os.path.join(self.datahome, self.source, self.product))
+            self.citadel.operation(
+                os.path.join(self.datahome, self.source, self.product), **kwargs
+            )
+
+    def cache_key(self, hour: int, varname: str = None) -> str:
+        """get the local cache key of the variable (the first one by default) at hour"""
+        return cache_key(
+            self.source,
+            self.product,
+            self.batch,
+            varname or self.varnames[0],
+            hour,
+            self.kwargs.get("data_type"),
+            self.kwargs.get("stats"),
+            self.bbox,
+        )
 
-    def xarray(self):
-        if hasattr(self, "data"):
+    def cached(self, hours: list = None) -> dict:
+        """get the files of all variables and hours from the local cache under cachehome, download the missing ones only
+
+        Args:
+            hours (list, optional): subset of hours. Defaults to None for all.
+
+        Returns:
+            dict: {varname: [cached filepath,...]}
+        """
+        cache = DataCache(CACHE_ROOT)
+        hours = self.hours if hours is None else hours
+        keys = {(v, int(h)): self.cache_key(h, v) for v in self.varnames for h in hours}
+        local_fp = {vh: cache.get(k) for vh, k in keys.items()}
+        missing = {vh for vh, fp in local_fp.items() if fp is None}
+        if missing:
+            tmp_dir = cache.staging()
+            try:
+                files = {
+                    k: v
+                    for h in sorted({h for _, h in missing})
+                    for k, v in self.plan_hour(h).items()
+                    if split_key(k) in missing
+                }
+                self._download_files(files, tmp_dir)
+                for k in files:
+                    vh = split_key(k)
+                    local_fp[vh] = cache.publish(
+                        os.path.join(tmp_dir, f"{k}.nc"), keys[vh]
+                    )
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            # files of the other hours may be in use by an iter_hours consumer
+            protect = [self.cache_key(h, v) for v in self.varnames for h in self.hours]
+            cache.evict(protect=protect)
+        res = {v: [] for v in self.varnames}
+        for (v, _), fp in local_fp.items():
+            if fp is not None:
+                res[v].append(fp)
+        return res
+
+    def iter_hours(self, order: str = "lead", prefetch: int = PREFETCH):
+        """yield the files of each hour as soon as it is downloaded and converted
+
+        At most prefetch hours are in flight ahead of the consumer.
+
+        Args:
+            order (str, optional): 'lead' for hour order, 'completion' for the order hours finish. Defaults to "lead".
+            prefetch (int, optional): hours in flight. Defaults to PREFETCH.
+
+        Yields:
+            tuple: (hour, {varname: cached filepath})
+        """
+        def files(h):
+            return {v: fps[0] for v, fps in self.cached([h]).items() if fps}
+
+        yield from self._iter(files, order, prefetch)
+
+    def iter_datasets(self, order: str = "lead", prefetch: int = PREFETCH):
+        """yield the dataset of each hour as soon as it is downloaded and decoded
+
+        Args:
+            order (str, optional): 'lead' for hour order, 'completion' for the order hours finish. Defaults to "lead".
+            prefetch (int, optional): hours in flight, bounds the decoded datasets held. Defaults to PREFETCH.
+
+        Yields:
+            tuple: (hour, xr.Dataset)
+        """
+        import xarray as xr
+
+        def load(h):
+            datasets = []
+            for fps in self.cached([h]).values():
+                for fp in fps:
+                    with xr.open_dataset(fp) as ds:
+                        datasets.append(ds.load())
+            return xr.merge(datasets, join="outer")
+
+        yield from self._iter(load, order, prefetch)
+
+    def _iter(self, func, order: str, prefetch: int):
+        if order not in ["lead", "completion"]:
+            raise Exception(f"order {order} not in ['lead', 'completion']")
+        hours = sorted(self.hours)
+        prefetch = max(1, prefetch)
+        with ThreadPoolExecutor(max_workers=prefetch) as pool:
+            pending = deque()
+            futures = {}
+
+            def submit():
+                if hours:
+                    h = hours.pop(0)
+                    f = pool.submit(func, h)
+                    futures[f] = h
+                    pending.append(f)
+
+            for _ in range(prefetch):
+                submit()
+            try:
+                while pending:
+                    if order == "lead":
+                        f = pending.popleft()
+                    else:
+                        f = next(iter(wait(pending, return_when=FIRST_COMPLETED).done))
+                        pending.remove(f)
+                    res = f.result()
+                    submit()
+                    yield futures.pop(f), res
+            finally:
+                # the consumer stopped early, drop the hours not started yet
+                for f in pending:
+                    f.cancel()
+
+    def xarray(self, engine: str = "netcdf"):
+        """get the dataset of all variables and hours, one data variable per varname
+
+        Args:
+            engine (str, optional): 'netcdf' to convert with cdo through the local nc cache,
+                'native' to decode GRIB in memory with no temp file or cdo process. Defaults to "netcdf".
+        """
+        import xarray as xr
+
+        if hasattr(self, "_data"):
             return self._data
-        elif hasattr(self, "local_fp"):
-            self._data = xr.open_mfdataset(self.local_fp, combine="nested")
+        if engine == "native":
+            self._data = self.decode()
             return self._data
+        elif engine != "netcdf":
+            raise Exception(f"engine {engine} not in ['netcdf', 'native']")
+        if hasattr(self, "local_fp"):
+            files = {}
+            for fp in self.local_fp:
+                varname = split_key(os.path.basename(fp)[: -len(".nc")])[0]
+                files.setdefault(varname, []).append(fp)
         else:
-            tmp_dir = tempfile.mkdtemp()
-            self.download(tmp_dir)
-            self._data = xr.open_mfdataset(self.local_fp, combine="nested")
-            shutil.rmtree(tmp_dir)
-            return self._data
+            files = self.cached()
+            self.local_fp = [fp for fps in files.values() for fp in fps]
+        self._data = xr.merge(
+            [xr.open_mfdataset(fps, combine="nested") for fps in files.values() if fps],
+            join="outer",
+        )
+        return self._data
+
+    def decode(self):
+        """download GRIB of all variables and hours into memory and decode it, skipping nc and the local cache
+
+        Returns:
+            xr.Dataset: one data variable per varname
+        """
+        import xarray as xr
+        from .utils.decode import decode_grib
+
+        if not hasattr(self.citadel, "batch_fetch"):
+            raise Exception(f"native engine is not supported by {self.source} {self.product}")
+        keys = list(self.download_dict)
+        buffers = self.citadel.batch_fetch([self.download_dict[k] for k in keys])
+        sources = {v: [] for v in self.varnames}
+        for k, buf in zip(keys, buffers):
+            sources[split_key(k)[0]].append(buf)
+        return xr.merge(
+            [decode_grib(bufs, v, self.bbox) for v, bufs in sources.items() if bufs],
+            join="outer",
+        )
 
     def get_batch(self, batch):
         if isinstance(batch, str):
+            import pandas as pd
+
             batch = pd.to_datetime(batch)
         elif isinstance(batch, str):
             batch = datetime.strptime(batch, "%Y-%m-%d %H:%M")
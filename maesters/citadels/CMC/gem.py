@@ -4,15 +4,23 @@ import sys
 from datetime import datetime, timedelta
 import shutil
 from glob import glob
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-import requests
 from retrying import retry
-from bs4 import BeautifulSoup
 from loguru import logger
 
-from maesters.config import V, get_model
-from maesters.utils.download import batch_session_download, single_session_download
+from maesters.config import V, get_model, get_concurrency
+from maesters.utils.download import (
+    batch_session_download,
+    fetch_buffer,
+    single_session_download,
+)
+from maesters.utils.http_cache import cached_listing
+from maesters.utils.journal import DownloadJournal, group_by
+from maesters.utils.encoding import Encoding
+from maesters.utils.layout import LayoutWriter
+from maesters.utils.region import check_bbox
+from maesters.utils.log import add_file_sink
 from maesters.utils.post_process import (
     batch_convert_nc,
     single_convert_nc,
@@ -20,13 +28,7 @@ from maesters.utils.post_process import (
 
 MAESTERS = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-logger.add(
-    os.path.join(os.path.dirname(MAESTERS), "log/GEM_{time:%Y%m%d}"),
-    rotation="00:00",
-    retention=10,
-)
-
-PARALLEL_NUM = 5
+PARALLEL_NUM = get_concurrency()["processes"]
 
 CMC_GEM = get_model("cmc", "gem")
 HOURS = {"medium": list(range(3, 240, 3))}
@@ -58,16 +60,11 @@ def get_files_dict(date: datetime, hour: int, var_dict: dict = CMC_GEM.variable)
     batch = str(date.hour).zfill(2)
     hour = str(hour).zfill(3)
     url = os.path.dirname(CMC_GEM.download_url).format(batch=batch, hour=hour)
-    resp = requests.get(url)
+    links = cached_listing(url, f"{date:%Y%m%d%H}")
     res_dict = {}
-    if resp.status_code == 200:
-        bs_items = BeautifulSoup(resp.text, "html.parser")
-        files_list = [
-            i["href"]
-            for i in bs_items.find_all(
-                "a", text=re.compile(f"CMC.*{date:%Y%m%d%H}.*.grib2")
-            )
-        ]
+    if links is not None:
+        pattern = re.compile(f"CMC.*{date:%Y%m%d%H}.*.grib2")
+        files_list = [i for i in links if pattern.search(i)]
         for f in files_list:
             match = parse_filename(f)
             if match:
@@ -82,17 +79,61 @@ def download(**kwargs):
     single_session_download(
         download_url=kwargs["url"], local_fp=kwargs["local_fp"].replace(".nc", ".grib2")
     )
-    single_convert_nc(kwargs["local_fp"].replace(".nc", ".grib2"), kwargs["local_fp"])
+    single_convert_nc(
+        kwargs["local_fp"].replace(".nc", ".grib2"),
+        kwargs["local_fp"],
+        bbox=kwargs.get("bbox"),
+    )
     os.remove(kwargs["local_fp"].replace(".nc", ".grib2"))
     return os.path.getsize(kwargs["local_fp"])
 
 
-def save_cmc_gem(date: datetime, local_dir: str):
+def batch_download(items: list) -> list:
+    """download and convert download_dict items together over the shared session
+
+    Args:
+        items (list): [{'url': str, 'local_fp': str, 'bbox': tuple (optional)},...]
+    Returns:
+        list: failed items
+    """
+    grib = {i["local_fp"]: i["local_fp"].replace(".nc", ".grib2") for i in items}
+    fail = batch_session_download(
+        [(i["url"], grib[i["local_fp"]]) for i in items]
+    )
+    failed = {f[1] for f in fail}
+    in_out_list = [
+        (g, fp, os.path.basename(fp).split("-")[0])
+        for fp, g in grib.items()
+        if g not in failed
+    ]
+    bbox = {i["local_fp"]: check_bbox(i.get("bbox")) for i in items}
+    for b, group in group_by(in_out_list, lambda i: bbox[i[1]]).items():
+        failed.update(f[0] for f in batch_convert_nc(group, bbox=b))
+    for g, _, _ in in_out_list:
+        if os.path.exists(g):
+            os.remove(g)
+    return [i for i in items if grib[i["local_fp"]] in failed]
+
+
+def batch_fetch(items: list) -> list:
+    """download the GRIB files of download_dict items into memory
+
+    Args:
+        items (list): [{'url': str},...]
+    Returns:
+        list: bytes of every item
+    """
+    with ThreadPoolExecutor(get_concurrency()["ceiling"]) as pool:
+        return list(pool.map(fetch_buffer, [i["url"] for i in items]))
+
+
+def save_cmc_gem(date: datetime, local_dir: str, journal: DownloadJournal = None):
     """save all gem batch files at date in directory
 
     Parameters:
         date: datetime, UTC
         local_dir: str, save dir
+        journal: DownloadJournal, resume the journaled downloads instead of discovering again
     return:
         -1 if some fail
         0 if all success
@@ -100,27 +141,49 @@ def save_cmc_gem(date: datetime, local_dir: str):
     batch = date.hour
     logger.info(f"GEM {date:%Y%m%d}{str(batch).zfill(2)} download start")
     hours = HOURS["medium"]
-    results = []
+    results = {}
     fail = []
     with ProcessPoolExecutor(max_workers=PARALLEL_NUM) as pool:
-        for hour in hours[:]:
-            urls = get_files_dict(date, hour)
-            url_fp_list = [
-                (v["url"], os.path.join(local_dir, os.path.basename(v["url"])))
-                for k, v in urls.items()
-            ]
-            # url_fp_list = [(v,os.path.join(local_dir,f'{k}.grib2')) for k,v in urls.items()]
-            results.append(pool.submit(batch_session_download, url_fp_list=url_fp_list))
-        for n, r in enumerate(as_completed(results)):
+        if journal is not None and journal.is_planned():
+            pending = journal.pending_downloads()
+            logger.info(f"GEM: resume {len(pending)} downloads from journal")
+            for url, url_fp_list in group_by(
+                pending, lambda i: os.path.dirname(i[0])
+            ).items():
+                results[
+                    pool.submit(
+                        batch_session_download, url_fp_list=url_fp_list, journal=journal
+                    )
+                ] = f"URL: {url}"
+        else:
+            discovered = True
+            for hour in hours[:]:
+                urls = get_files_dict(date, hour)
+                url_fp_list = [
+                    (v["url"], os.path.join(local_dir, os.path.basename(v["url"])))
+                    for k, v in urls.items()
+                ]
+                discovered = discovered and len(url_fp_list) > 0
+                if journal is not None:
+                    journal.plan(url_fp_list)
+                # url_fp_list = [(v,os.path.join(local_dir,f'{k}.grib2')) for k,v in urls.items()]
+                results[
+                    pool.submit(
+                        batch_session_download, url_fp_list=url_fp_list, journal=journal
+                    )
+                ] = f"HOUR: {hour}"
+            if journal is not None and discovered:
+                journal.close_plan()
+        for r in as_completed(results):
             res = r.result()
             if res:
                 fail.extend(res)
             else:
                 logger.info(
-                    f"GEM: [DATE: {date:%Y%m%d} BATCH: {str(batch).zfill(2)} HOUR: {hours[n]}] DOWNLOAD FINISH"
+                    f"GEM: [DATE: {date:%Y%m%d} BATCH: {str(batch).zfill(2)} {results[r]}] DOWNLOAD FINISH"
                 )
 
-    fail = batch_session_download(fail)
+    fail = batch_session_download(fail, journal=journal)
     if fail:
         logger.error("the following download fail")
         logger.error(fail)
@@ -132,14 +195,42 @@ def save_cmc_gem(date: datetime, local_dir: str):
         return 0
 
 
-def convert_cmc_gem(grib_dir: str, out_dir: str):
-    grib_files = glob(os.path.join(grib_dir, "*.grib*"))
-    in_out_list = [
-        (f, os.path.join(out_dir, os.path.basename(f).split(".gr")[0] + ".nc"))
-        for f in grib_files
-    ]
-    fail = batch_convert_nc(in_out_list)
-    fail = batch_convert_nc(fail)
+def convert_cmc_gem(
+    grib_dir: str,
+    out_dir: str,
+    journal: DownloadJournal = None,
+    layout: str = "file",
+    format: str = "nc",
+    chunks: dict = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
+):
+    grib_files = (
+        journal.pending_conversions()
+        if journal is not None
+        else glob(os.path.join(grib_dir, "*.grib*"))
+    )
+    writer = LayoutWriter(
+        out_dir, HOURS["medium"], layout, format, chunks, encoding
+    )
+    in_out_list = []
+    for f in grib_files:
+        name = os.path.basename(f).split(".gr")[0]
+        m = parse_filename(os.path.basename(f))
+        o = CMC_GEM.variable.get(V(m[1], m[2], m[3])) if m else None
+        if o:
+            in_out_list.append((f, writer.hour_fp(name, o.outname, int(m[6]))))
+        else:
+            in_out_list.append((f, writer.hour_fp(name)))
+    fail = batch_convert_nc(
+        in_out_list, callback=writer, encoding=writer.hour_encoding, bbox=bbox
+    )
+    fail = batch_convert_nc(
+        fail, callback=writer, encoding=writer.hour_encoding, bbox=bbox
+    )
+    if journal is not None:
+        journal.converted(writer.outputs(in_out_list), writer.outputs(fail))
+    writer.close()
     if fail:
         logger.error("the following convern nc fail")
         logger.error(fail)
@@ -150,7 +241,25 @@ def convert_cmc_gem(grib_dir: str, out_dir: str):
 
 
 @retry(stop_max_delay=3 * 60 * 60 * 10e3, stop_max_attempt_number=1)
-def operation(local_dir: str = None):
+def operation(
+    local_dir: str = None,
+    layout: str = "file",
+    format: str = "nc",
+    chunks: dict = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
+):
+    """download and convert the latest batch
+
+    Args:
+        local_dir (str, optional): output directory. Defaults to None for the data_dir of model.
+        layout (str, optional): 'file' for one nc per grib file, 'variable' for one nc per variable. Defaults to "file".
+        format (str, optional): 'nc', or 'zarr' for one chunked store of the batch. Defaults to "nc".
+        chunks (dict, optional): zarr chunk length by dimension like {"time": 1, "lat": 256, "lon": 256}. Defaults to None for ZARR_CHUNKS.
+        encoding (Encoding, optional): compression, chunks, dtype and packing of the nc outputs. Defaults to None.
+        bbox (tuple, optional): (west, south, east, north) written only. Defaults to None for the whole grid.
+    """
+    add_file_sink("GEM")
     now = datetime.utcnow() - timedelta(hours=4)
     batch = int(now.hour / 12) * 12
     tmp_dir = (
@@ -173,9 +282,18 @@ def operation(local_dir: str = None):
         if local_dir is None
         else local_dir
     )
-    save_cmc_gem(now.replace(hour=batch), tmp_dir)
-    convert_cmc_gem(tmp_dir, local_dir)
-    shutil.rmtree(tmp_dir, ignore_errors=True)
+    journal = DownloadJournal.for_batch(
+        local_dir, now.strftime(f"%Y%m%d{str(batch).zfill(2)}")
+    )
+    if journal.is_complete():
+        logger.info(f"CMC_GEM: {local_dir} ALREADY FINISH")
+        return
+    save_cmc_gem(now.replace(hour=batch), tmp_dir, journal=journal)
+    convert_cmc_gem(
+        tmp_dir, local_dir, journal, layout, format, chunks, encoding, bbox
+    )
+    if journal.is_complete():
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
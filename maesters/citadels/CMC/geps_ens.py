@@ -1,4 +1,3 @@
-import requests
 import re
 import os
 import sys
@@ -9,23 +8,23 @@ from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 from retrying import retry
-from bs4 import BeautifulSoup
 from loguru import logger
 
 from maesters.utils.post_process import batch_ens_stats
-from maesters.config import get_model, V
+from maesters.config import get_model, V, get_concurrency
 from maesters.utils.download import batch_session_download, single_session_download
+from maesters.utils.http_cache import cached_listing
+from maesters.utils.journal import DownloadJournal, group_by
+from maesters.utils.encoding import Encoding
+from maesters.utils.ensemble import parse_stats, stat_suffix
+from maesters.utils.layout import LayoutWriter
+from maesters.utils.region import check_bbox
+from maesters.utils.log import add_file_sink
 from maesters.utils.post_process import single_ens_mean, single_ens_stats
 
 MAESTERS = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-logger.add(
-    os.path.join(os.path.dirname(MAESTERS), "log/GEPS_ENS_{time:%Y%m%d}"),
-    rotation="00:00",
-    retention=10,
-)
-
-PARALLEL_NUM = 5
+PARALLEL_NUM = get_concurrency()["processes"]
 
 # GEPS_ENS_URL: 'https://dd.weather.gc.ca/ensemble/geps/grib2/{PRODUCT}/{batch}/{hour}/'
 # FN EX: 'CMC_geps-raw_AFRAIN_SFC_0_latlon0p5x0p5_2022051400_P192_allmbrs.grib2'
@@ -37,6 +36,21 @@ HOURS = {
 }
 
 
+def batch_hours(date: datetime) -> list:
+    """get the predict hours of the batch at date, the thursday 00 batch runs to the subseason
+
+    Parameters:
+        date: datetime, batch start time UTC
+    return:
+        list, hours
+    """
+    return (
+        HOURS["subseason"]
+        if date.weekday() in [3] and date.hour == 0
+        else HOURS["medium"]
+    )
+
+
 def parse_filename(fn: str, data_type: str = "raw") -> re.Match:
     """parse filename from cmc
 
@@ -83,16 +97,11 @@ def get_files_dict(
         batch=batch,
         hour=hour,
     )
-    resp = requests.get(url)
+    links = cached_listing(url, f"{date:%Y%m%d%H}")
     res_dict = {}
-    if resp.status_code == 200:
-        bs_items = BeautifulSoup(resp.text, "html.parser")
-        files_list = [
-            i["href"]
-            for i in bs_items.find_all(
-                "a", text=re.compile(f"CMC.*{date:%Y%m%d%H}.*.grib2")
-            )
-        ]
+    if links is not None:
+        pattern = re.compile(f"CMC.*{date:%Y%m%d%H}.*.grib2")
+        files_list = [i for i in links if pattern.search(i)]
         for f in files_list:
             match = parse_filename(f, data_type=data_type)
             if match:
@@ -112,6 +121,7 @@ def download(**kwargs):
             kwargs["local_fp"].replace(".nc", ".grib2"),
             kwargs["local_fp"],
             os.path.basename(kwargs["local_fp"]).split("-")[0],
+            bbox=kwargs.get("bbox"),
         )
     else:
         single_ens_stats(
@@ -119,48 +129,106 @@ def download(**kwargs):
             kwargs["local_fp"],
             os.path.basename(kwargs["local_fp"]).split("-")[0],
             kwargs.get("stats"),
+            bbox=kwargs.get("bbox"),
         )
     os.remove(kwargs["local_fp"].replace(".nc", ".grib2"))
     return os.path.getsize(kwargs["local_fp"])
 
 
-def save_geps_ens(date: datetime, local_dir: str, product="raw"):
+def batch_download(items: list) -> list:
+    """download download_dict items together over the shared session and cal their ens stats
+
+    Args:
+        items (list): [{'url': str, 'local_fp': str, 'stats': str | list (optional, default 'ensmean'), 'bbox': tuple (optional)},...]
+    Returns:
+        list: failed items
+    """
+    grib = {i["local_fp"]: i["local_fp"].replace(".nc", ".grib2") for i in items}
+    fail = batch_session_download([(i["url"], grib[i["local_fp"]]) for i in items])
+    failed = {f[1] for f in fail}
+    in_out_list = [
+        (grib[i["local_fp"]], i["local_fp"], os.path.basename(i["local_fp"]).split("-")[0])
+        for i in items
+        if grib[i["local_fp"]] not in failed
+    ]
+    options = {}
+    for i in items:
+        stats = i.get("stats") or "ensmean"
+        # a list of stats is computed together, grouped as a tuple
+        options[i["local_fp"]] = (
+            stats if isinstance(stats, str) else tuple(stats),
+            check_bbox(i.get("bbox")),
+        )
+    for (s, b), in_out_var_list in group_by(
+        in_out_list, lambda i: options[i[1]]
+    ).items():
+        failed.update(f[0] for f in batch_ens_stats(in_out_var_list, s, bbox=b))
+    for g, _, _ in in_out_list:
+        if os.path.exists(g):
+            os.remove(g)
+    return [i for i in items if grib[i["local_fp"]] in failed]
+
+
+def save_geps_ens(
+    date: datetime, local_dir: str, product="raw", journal: DownloadJournal = None
+):
     """save all geps_ens batch files at date in directory
 
     Parameters:
         date: datetime, UTC
         local_dir: str, save dir
         product: str, geps_ens product, 'raw'/'products'
+        journal: DownloadJournal, resume the journaled downloads instead of discovering again
     return:
         -1 if some fail
         0 if all success
     """
     batch = date.hour
     logger.info(f"GEPS_ENS {date:%Y%m%d}{str(batch).zfill(2)} download start")
-    hours = (
-        HOURS["subseason"] if date.weekday() in [3] and batch == 0 else HOURS["medium"]
-    )
-    results = []
+    hours = batch_hours(date)
+    results = {}
     fail = []
     with ProcessPoolExecutor(max_workers=PARALLEL_NUM) as pool:
-        for hour in hours[:]:
-            urls = get_files_dict(date, hour, data_type=product)
-            url_fp_list = [
-                (v["url"], os.path.join(local_dir, os.path.basename(v["url"])))
-                for k, v in urls.items()
-            ]
-            # url_fp_list = [(v,os.path.join(local_dir,f'{k}.grib2')) for k,v in urls.items()]
-            results.append(pool.submit(batch_session_download, url_fp_list=url_fp_list))
-        for n, r in enumerate(as_completed(results)):
+        if journal is not None and journal.is_planned():
+            pending = journal.pending_downloads()
+            logger.info(f"GEPS_ENS: resume {len(pending)} downloads from journal")
+            for url, url_fp_list in group_by(
+                pending, lambda i: os.path.dirname(i[0])
+            ).items():
+                results[
+                    pool.submit(
+                        batch_session_download, url_fp_list=url_fp_list, journal=journal
+                    )
+                ] = f"URL: {url}"
+        else:
+            discovered = True
+            for hour in hours[:]:
+                urls = get_files_dict(date, hour, data_type=product)
+                url_fp_list = [
+                    (v["url"], os.path.join(local_dir, os.path.basename(v["url"])))
+                    for k, v in urls.items()
+                ]
+                discovered = discovered and len(url_fp_list) > 0
+                if journal is not None:
+                    journal.plan(url_fp_list)
+                # url_fp_list = [(v,os.path.join(local_dir,f'{k}.grib2')) for k,v in urls.items()]
+                results[
+                    pool.submit(
+                        batch_session_download, url_fp_list=url_fp_list, journal=journal
+                    )
+                ] = f"HOUR: {hour}"
+            if journal is not None and discovered:
+                journal.close_plan()
+        for r in as_completed(results):
             res = r.result()
             if res:
                 fail.extend(res)
             else:
                 logger.info(
-                    f"GEPS_ENS: [DATE: {date:%Y%m%d} BATCH: {str(batch).zfill(2)} HOUR: {hours[n]}] DOWNLOAD FINISH"
+                    f"GEPS_ENS: [DATE: {date:%Y%m%d} BATCH: {str(batch).zfill(2)} {results[r]}] DOWNLOAD FINISH"
                 )
 
-    fail = batch_session_download(fail)
+    fail = batch_session_download(fail, journal=journal)
     if fail:
         logger.error("the following download fail")
         logger.error(fail)
@@ -175,33 +243,87 @@ def save_geps_ens(date: datetime, local_dir: str, product="raw"):
 def cal_geps_ens_stats(
     grib_dir: str,
     out_dir: str,
-    stats: str,
+    stats,
     varname_suffix: bool = False,
     split_rule: str = os.path.join(MAESTERS, "static/pf_split"),
+    journal: DownloadJournal = None,
+    layout: str = "file",
+    format: str = "nc",
+    chunks: dict = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
+    hours: list = None,
 ):
+    """cal the ens stats of all allmbrs grib in grib dir
+
+    Args:
+        grib_dir (str): grib file directory
+        out_dir (str): out file directory
+        stats (str | list): ens method like 'ensmean', or a list like ['ensmean', 'ensstd', 'enspctl,90', 'ensprob,gt,0.001'] computed in one pass and written together, each variable with the stat suffix like 'T2ENSSTD'
+        varname_suffix (bool, optional): name the variable of a single stat with its suffix. Defaults to False.
+        split_rule (str, optional): grib_filter split rule_file of the cdo engine.
+        journal (DownloadJournal, optional): convert only the journaled downloads not converted yet. Defaults to None.
+        layout (str, optional): 'file' for one nc per variable and hour, 'variable' for one nc per variable. Defaults to "file".
+        format (str, optional): 'nc', or 'zarr' for one chunked store of the batch. Defaults to "nc".
+        chunks (dict, optional): zarr chunk length by dimension. Defaults to None for ZARR_CHUNKS.
+        encoding (Encoding, optional): compression, chunks, dtype and packing of the nc outputs. Defaults to None.
+        bbox (tuple, optional): (west, south, east, north) written only. Defaults to None for the whole grid.
+        hours (list, optional): predict hours of the batch. Defaults to None for batch_hours of the batch in the filenames.
+
+    Returns:
+        int: -1 if some fail, 0 if all success
+    """
+    stats = parse_stats(stats)
+    label = ",".join(stats)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir, 0o777, exist_ok=True)
-    files = glob(os.path.join(grib_dir, "*.grib*"))
+    files = (
+        journal.pending_conversions()
+        if journal is not None
+        else glob(os.path.join(grib_dir, "*.grib*"))
+    )
     fns = [os.path.basename(f) for f in files]
     matches = [parse_filename(fn) for fn in fns]
+    if hours is None:
+        batches = {m[5] for m in matches if m}
+        hours = (
+            batch_hours(datetime.strptime(batches.pop(), "%Y%m%d%H"))
+            if len(batches) == 1
+            else HOURS["medium"]
+        )
+    writer = LayoutWriter(out_dir, hours, layout, format, chunks, encoding)
     in_out_var_list = []
     for n, m in enumerate(matches):
         if m:
             v = V(m[1], m[2], m[3])
             o = CMC_GEPS_ENS.variable.get(v)
             if o:
-                name = o.outname + stats.upper() if varname_suffix else o.outname
-                t = (files[n], os.path.join(out_dir, f"{o.outname}-{m[6]}.nc"), name)
-                in_out_var_list.append(t)
-    fail = batch_ens_stats(in_out_var_list, stats, split_rule)
+                name = (
+                    o.outname + stat_suffix(stats[0])
+                    if varname_suffix and len(stats) == 1
+                    else o.outname
+                )
+                hour_fp = writer.hour_fp(f"{o.outname}-{m[6]}", name, int(m[6]))
+                in_out_var_list.append((files[n], hour_fp, name))
+    fail = batch_ens_stats(
+        in_out_var_list, stats, split_rule, writer, writer.hour_encoding, bbox
+    )
 
-    fail = batch_ens_stats(fail, stats, split_rule)
+    fail = batch_ens_stats(
+        fail, stats, split_rule, writer, writer.hour_encoding, bbox
+    )
+    if journal is not None:
+        # files without output variable are done as well
+        mapped = {t[0] for t in in_out_var_list}
+        journal.converted([(f, None) for f in files if f not in mapped])
+        journal.converted(writer.outputs(in_out_var_list), writer.outputs(fail))
+    writer.close()
     if fail:
-        logger.error(f"the following cal {stats} fail")
+        logger.error(f"the following cal {label} fail")
         logger.error(fail)
         return -1
     else:
-        logger.info(f"GEPS_ENS: ALL {stats.upper()} CALC FINISH")
+        logger.info(f"GEPS_ENS: ALL {label.upper()} CALC FINISH")
         return 0
 
 
@@ -209,12 +331,53 @@ def cal_geps_ens_mean(
     grib_dir: str,
     out_dir: str,
     split_rule: str = os.path.join(MAESTERS, "static/pf_split"),
+    journal: DownloadJournal = None,
+    layout: str = "file",
+    format: str = "nc",
+    chunks: dict = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
+    hours: list = None,
 ):
-    return cal_geps_ens_stats(grib_dir, out_dir, "ensmean", split_rule)
+    return cal_geps_ens_stats(
+        grib_dir,
+        out_dir,
+        "ensmean",
+        split_rule=split_rule,
+        journal=journal,
+        layout=layout,
+        format=format,
+        chunks=chunks,
+        encoding=encoding,
+        bbox=bbox,
+        hours=hours,
+    )
 
 
 @retry(stop_max_delay=3 * 60 * 60 * 10e3, stop_max_attempt_number=1)
-def operation(local_dir: str = None, rm_origin: bool = True, **kwargs):
+def operation(
+    local_dir: str = None,
+    rm_origin: bool = True,
+    layout: str = "file",
+    format: str = "nc",
+    chunks: dict = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
+    **kwargs,
+):
+    """download the latest batch and cal its ens stats
+
+    Args:
+        local_dir (str, optional): output directory. Defaults to None for the data_dir of model.
+        rm_origin (bool, optional): remove the downloaded grib when all done. Defaults to True.
+        layout (str, optional): 'file' for one nc per variable and hour, 'variable' for one nc per variable. Defaults to "file".
+        format (str, optional): 'nc', or 'zarr' for one chunked store of the batch. Defaults to "nc".
+        chunks (dict, optional): zarr chunk length by dimension like {"time": 1, "lat": 256, "lon": 256}. Defaults to None for ZARR_CHUNKS.
+        encoding (Encoding, optional): compression, chunks, dtype and packing of the nc outputs. Defaults to None.
+        bbox (tuple, optional): (west, south, east, north) written only. Defaults to None for the whole grid.
+        stats (str | list, optional): ens method, or a list of them computed in one pass. Defaults to None for 'ensmean'.
+    """
+    add_file_sink("GEPS_ENS")
     now = datetime.utcnow() - timedelta(hours=6)
     batch = int(now.hour / 12) * 12
     tmp_dir = (
@@ -238,15 +401,41 @@ def operation(local_dir: str = None, rm_origin: bool = True, **kwargs):
         else local_dir
     )
 
-    save_geps_ens(now.replace(hour=batch), tmp_dir)
+    journal = DownloadJournal.for_batch(
+        local_dir, now.strftime(f"%Y%m%d{str(batch).zfill(2)}")
+    )
+    if journal.is_complete():
+        logger.info(f"GEPS_ENS: {local_dir} ALREADY FINISH")
+        return
+    save_geps_ens(now.replace(hour=batch), tmp_dir, journal=journal)
     if kwargs.get("stats") is None:
-        cal_geps_ens_mean(tmp_dir, local_dir)
-    elif isinstance(kwargs.get("stats"), str):
+        cal_geps_ens_mean(
+            tmp_dir,
+            local_dir,
+            journal=journal,
+            layout=layout,
+            format=format,
+            chunks=chunks,
+            encoding=encoding,
+            bbox=bbox,
+            hours=batch_hours(now.replace(hour=batch)),
+        )
+    elif isinstance(kwargs.get("stats"), (str, list, tuple)):
         cal_geps_ens_stats(
-            tmp_dir, local_dir, stats=kwargs.get("stats"), varname_suffix=True
+            tmp_dir,
+            local_dir,
+            stats=kwargs.get("stats"),
+            varname_suffix=True,
+            journal=journal,
+            layout=layout,
+            format=format,
+            chunks=chunks,
+            encoding=encoding,
+            bbox=bbox,
+            hours=batch_hours(now.replace(hour=batch)),
         )
 
-    if rm_origin:
+    if rm_origin and journal.is_complete():
         shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
@@ -1,32 +1,38 @@
 import re
 import os
+import bz2
 import sys
 from datetime import datetime, timedelta
 import shutil
 from glob import glob
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import requests
-from bs4 import BeautifulSoup
 from loguru import logger
 from retrying import retry
 
-from maesters.config import get_model, V
+from maesters.config import DEFAULT_MAESTER, get_model, V, get_concurrency
 from maesters.utils.download import batch_session_download, single_session_download
+from maesters.utils.http_cache import cached_listing
+from maesters.utils.journal import DownloadJournal, group_by
+from maesters.utils.encoding import Encoding
+from maesters.utils.layout import LayoutWriter
+from maesters.utils.region import check_bbox
+from maesters.utils.log import add_file_sink
 from maesters.utils.post_process import batch_tri_transform, single_tri_transform
+from maesters.utils.weights import grid_weights
 
 MAESTERS = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-logger.add(
-    os.path.join(os.path.dirname(MAESTERS), "log/DWD_ICON_{time:%Y%m%d}"),
-    rotation="00:00",
-    retention=10,
-)
-
-PARALLEL_NUM = 5
+PARALLEL_NUM = get_concurrency()["processes"]
 
 DWD_ICON = get_model("dwd", "icon")
 HOURS = {"medium": (list(range(0, 78, 1)) + list(range(78, 180 + 3, 3)))}
+# the icosahedral grid of the global ICON, source of the generated weights
+ICON_GRID_URL = "https://opendata.dwd.de/weather/lib/cdo/icon_grid_0026_R03B07_G.nc.bz2"
+ICON_GRID = os.environ.get(
+    "MAESTERS_ICON_GRID",
+    os.path.join(DEFAULT_MAESTER["cachehome"], "dwd", "icon_grid_0026_R03B07_G.nc"),
+)
 
 
 def parse_filename(fn: str):
@@ -64,13 +70,9 @@ def get_files_dict(
         url = os.path.dirname(DWD_ICON.download_url).format(
             batch=batch, variable=variable.varname.lower()
         )
-        resp = requests.get(url)
-        if resp.status_code == 200:
-            bs_items = BeautifulSoup(resp.text, "html.parser")
-            files_list = [
-                i["href"]
-                for i in bs_items.find_all("a", text=re.compile("icon_global_*"))
-            ]
+        links = cached_listing(url, f"{date:%Y%m%d%H}")
+        if links is not None:
+            files_list = [i for i in links if re.search("icon_global_*", i)]
             for f in files_list:
                 match = parse_filename(f)
                 if isinstance(hour, int):
@@ -113,54 +115,106 @@ def download(**kwargs):
         kwargs["local_fp"].replace(".nc", ".grib2"),
         kwargs["local_fp"],
         os.path.basename(kwargs["local_fp"]).split("-")[0],
+        bbox=kwargs.get("bbox"),
     )
     os.remove(kwargs["local_fp"].replace(".nc", ".grib2"))
     return os.path.getsize(kwargs["local_fp"])
 
 
-def save_dwd_icon(date: datetime, local_dir: str):
+def batch_download(items: list) -> list:
+    """download and convert download_dict items together over the shared session
+
+    Args:
+        items (list): [{'url': str, 'local_fp': str, 'bbox': tuple (optional)},...]
+    Returns:
+        list: failed items
+    """
+    grib = {i["local_fp"]: i["local_fp"].replace(".nc", ".grib2") for i in items}
+    fail = batch_session_download(
+        [(i["url"], grib[i["local_fp"]]) for i in items], file_type="bz2"
+    )
+    failed = {f[1] for f in fail}
+    in_out_list = [
+        (g, fp, os.path.basename(fp).split("-")[0])
+        for fp, g in grib.items()
+        if g not in failed
+    ]
+    bbox = {i["local_fp"]: check_bbox(i.get("bbox")) for i in items}
+    for b, group in group_by(in_out_list, lambda i: bbox[i[1]]).items():
+        failed.update(f[0] for f in batch_tri_transform(group, bbox=b))
+    for g, _, _ in in_out_list:
+        if os.path.exists(g):
+            os.remove(g)
+    return [i for i in items if grib[i["local_fp"]] in failed]
+
+
+def save_dwd_icon(date: datetime, local_dir: str, journal: DownloadJournal = None):
     """save all geps_ens batch files at date in directory
 
     Parameters:
         date: datetime, UTC
         local_dir: str, save dir
+        journal: DownloadJournal, resume the journaled downloads instead of discovering again
     return:
         -1 if some fail
         0 if all success
     """
     batch = date.hour
     logger.info(f"DWD_ICON {date:%Y%m%d}{str(batch).zfill(2)} download start")
-    results = []
+    results = {}
     fail = []
     with ProcessPoolExecutor(max_workers=PARALLEL_NUM) as pool:
-
-        for k, v in DWD_ICON.variable.items():
-            urls = get_files_dict(date.replace(hour=batch), var_dict={k: v})
-            url_fp_list = [
-                (
-                    v.get("url"),
-                    os.path.join(
-                        local_dir, os.path.basename(v.get("url")).split(".bz2")[0]
-                    ),
-                )
-                for k, v in urls.items()
-            ]
-            results.append(
-                pool.submit(
-                    batch_session_download, url_fp_list=url_fp_list, file_type="bz2"
-                )
-            )
-        for n, r in enumerate(as_completed(results)):
+        if journal is not None and journal.is_planned():
+            pending = journal.pending_downloads()
+            logger.info(f"DWD_ICON: resume {len(pending)} downloads from journal")
+            for url, url_fp_list in group_by(
+                pending, lambda i: os.path.dirname(i[0])
+            ).items():
+                results[
+                    pool.submit(
+                        batch_session_download,
+                        url_fp_list=url_fp_list,
+                        file_type="bz2",
+                        journal=journal,
+                    )
+                ] = f"URL: {url}"
+        else:
+            discovered = True
+            for k, v in DWD_ICON.variable.items():
+                urls = get_files_dict(date.replace(hour=batch), var_dict={k: v})
+                url_fp_list = [
+                    (
+                        v.get("url"),
+                        os.path.join(
+                            local_dir, os.path.basename(v.get("url")).split(".bz2")[0]
+                        ),
+                    )
+                    for k, v in urls.items()
+                ]
+                discovered = discovered and len(url_fp_list) > 0
+                if journal is not None:
+                    journal.plan(url_fp_list)
+                results[
+                    pool.submit(
+                        batch_session_download,
+                        url_fp_list=url_fp_list,
+                        file_type="bz2",
+                        journal=journal,
+                    )
+                ] = f"VARNAME: {k.varname}"
+            if journal is not None and discovered:
+                journal.close_plan()
+        for r in as_completed(results):
             res = r.result()
             if res:
                 fail.extend(res)
             else:
                 logger.info(
                     f"DWD_ICON: [DATE: {date:%Y%m%d} BATCH: {str(batch).zfill(2)} "
-                    f"VARNAME: {list(DWD_ICON.variable.keys())[n].varname}] DOWNLOAD FINISH"
+                    f"{results[r]}] DOWNLOAD FINISH"
                 )
 
-    fail = batch_session_download(fail, file_type="bz2")
+    fail = batch_session_download(fail, file_type="bz2", journal=journal)
     if fail:
         logger.error("the following download fail")
         logger.error(fail)
@@ -177,6 +231,12 @@ def dwd_transform(
     out_dir: str,
     grid_text: str = os.path.join(MAESTERS, "static/dwd/target_grid_world_0125.txt"),
     grid_weight: str = os.path.join(MAESTERS, "static/dwd/weights_icogl2world_0125.nc"),
+    journal: DownloadJournal = None,
+    layout: str = "file",
+    format: str = "nc",
+    chunks: dict = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
 ) -> int:
     """transfrom all files in grib dir to lon-lat-grid nc
 
@@ -185,13 +245,26 @@ def dwd_transform(
         out_dir: str, out file directory
         grid_text: str, transform output grid details file
         grid_weight: str, transform orig grid weight file
+        journal: DownloadJournal, transform only the journaled downloads not transformed yet
+        layout: str, 'file' for '{VAR}-{HOUR}.nc', 'variable' for '{VAR}.nc' of all hours
+        format: str, 'nc', or 'zarr' for '{BATCH}.zarr' of all variables and hours
+        chunks: dict, zarr chunk length by dimension, None for ZARR_CHUNKS
+        encoding: Encoding, compression, chunks, dtype and packing of the nc outputs
+        bbox: tuple, (west, south, east, north) of the target grid, remapped with the regional weights
 
     """
     if not os.path.exists(out_dir):
         os.makedirs(out_dir, 0o777, exist_ok=True)
-    files = glob(os.path.join(grib_dir, "icon*.grib2"))
+    files = (
+        journal.pending_conversions()
+        if journal is not None
+        else glob(os.path.join(grib_dir, "icon*.grib2"))
+    )
     fns = [os.path.basename(f) for f in files]
     matches = [parse_filename(fn) for fn in fns]
+    writer = LayoutWriter(
+        out_dir, HOURS["medium"], layout, format, chunks, encoding
+    )
     in_out_var_list = []
     for n, m in enumerate(matches):
         if m:
@@ -206,12 +279,22 @@ def dwd_transform(
                 if o:
                     t = (
                         files[n],
-                        os.path.join(out_dir, f"{o.outname}-{hour}.nc"),
+                        writer.hour_fp(f"{o.outname}-{hour}", o.outname, int(hour)),
                         o.outname,
                     )
                     in_out_var_list.append(t)
-    fail = batch_tri_transform(in_out_var_list, grid_text, grid_weight)
-    fail = batch_tri_transform(fail, grid_text, grid_weight)
+    fail = batch_tri_transform(
+        in_out_var_list, grid_text, grid_weight, writer, writer.hour_encoding, bbox
+    )
+    fail = batch_tri_transform(
+        fail, grid_text, grid_weight, writer, writer.hour_encoding, bbox
+    )
+    if journal is not None:
+        # files without output variable are done as well
+        mapped = {t[0] for t in in_out_var_list}
+        journal.converted([(f, None) for f in files if f not in mapped])
+        journal.converted(writer.outputs(in_out_var_list), writer.outputs(fail))
+    writer.close()
     if fail:
         logger.error("the following tri-transform fail")
         logger.error(fail)
@@ -221,8 +304,47 @@ def dwd_transform(
         return 0
 
 
+def icon_grid() -> str:
+    """get the ICON grid file, downloaded once
+
+    Returns:
+        str: filepath of the grid file
+    """
+    if not os.path.exists(ICON_GRID):
+        os.makedirs(os.path.dirname(ICON_GRID), 0o777, exist_ok=True)
+        # the bz2 stream download checks GRIB, the grid is a nc
+        single_session_download(ICON_GRID_URL, ICON_GRID + ".bz2", "file")
+        with bz2.open(ICON_GRID + ".bz2") as src, open(ICON_GRID + ".tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(ICON_GRID + ".tmp", ICON_GRID)
+        os.remove(ICON_GRID + ".bz2")
+    return ICON_GRID
+
+
 @retry(stop_max_delay=3 * 60 * 60 * 10e3, stop_max_attempt_number=1)
-def operation(local_dir: str = None):
+def operation(
+    local_dir: str = None,
+    layout: str = "file",
+    format: str = "nc",
+    chunks: dict = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
+    grid=None,
+    remap_method: str = "conservative",
+):
+    """download and transform the latest batch
+
+    Args:
+        local_dir (str, optional): output directory. Defaults to None for the data_dir of model.
+        layout (str, optional): 'file' for one nc per variable and hour, 'variable' for one nc per variable. Defaults to "file".
+        format (str, optional): 'nc', or 'zarr' for one chunked store of the batch. Defaults to "nc".
+        chunks (dict, optional): zarr chunk length by dimension like {"time": 1, "lat": 256, "lon": 256}. Defaults to None for ZARR_CHUNKS.
+        encoding (Encoding, optional): compression, chunks, dtype and packing of the nc outputs. Defaults to None.
+        bbox (tuple, optional): (west, south, east, north) written only. Defaults to None for the whole grid.
+        grid (GridSpec | str, optional): target grid, or its cdo grid description, remapped with weights generated once and cached. Defaults to None for the static 0.125 world grid.
+        remap_method (str, optional): 'nearest', 'bilinear' or 'conservative' weights of grid. Defaults to "conservative".
+    """
+    add_file_sink("DWD_ICON")
     now = datetime.utcnow() - timedelta(hours=4)
     batch = int(now.hour / 12) * 12
     tmp_dir = (
@@ -245,9 +367,33 @@ def operation(local_dir: str = None):
         if local_dir is None
         else local_dir
     )
-    save_dwd_icon(now.replace(hour=batch), tmp_dir)
-    dwd_transform(tmp_dir, local_dir)
-    shutil.rmtree(tmp_dir, ignore_errors=True)
+    journal = DownloadJournal.for_batch(
+        local_dir, now.strftime(f"%Y%m%d{str(batch).zfill(2)}")
+    )
+    if journal.is_complete():
+        logger.info(f"DWD_ICON: {local_dir} ALREADY FINISH")
+        return
+    save_dwd_icon(now.replace(hour=batch), tmp_dir, journal)
+    grid_files = (
+        {}
+        if grid is None
+        else dict(
+            zip(["grid_text", "grid_weight"], grid_weights(icon_grid(), grid, remap_method))
+        )
+    )
+    dwd_transform(
+        tmp_dir,
+        local_dir,
+        journal=journal,
+        layout=layout,
+        format=format,
+        chunks=chunks,
+        encoding=encoding,
+        bbox=bbox,
+        **grid_files,
+    )
+    if journal.is_complete():
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
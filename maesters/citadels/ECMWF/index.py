@@ -0,0 +1,103 @@
+import json
+from functools import lru_cache
+
+from loguru import logger
+import pandas as pd
+
+from maesters.utils.http_cache import cached_get
+
+# the level of single level parameters which have no levelist in index
+DEFAULT_LEVELIST = {"2t": 2, "10u": 10, "10v": 10}
+INDEX_KEYS = ["_offset", "_length", "param", "levtype", "levelist", "type", "number"]
+# parsed indexes kept by (index url, batch), a few hours of one batch
+INDEX_MEMO_SIZE = 4
+
+
+def read_index(content: str) -> pd.DataFrame:
+    """parse the JSON-lines index of an ECMWF open data grib2 file in one bulk call
+
+    Args:
+        content (str): index file text
+
+    Returns:
+        pd.DataFrame: one row per grib message, with int64 'start'/'end' (exclusive) bytes and
+            int64 'levelist', and 'param', 'levtype', 'type', 'number' columns
+    """
+    records = json.loads("[" + ",".join(l for l in content.splitlines() if l) + "]")
+    df = pd.DataFrame(
+        {k: [r.get(k) for r in records] for k in INDEX_KEYS}, columns=INDEX_KEYS
+    )
+    df["start"] = df.pop("_offset").astype("int64")
+    df["end"] = df["start"] + df.pop("_length").astype("int64")
+    default = df["param"].map(DEFAULT_LEVELIST).fillna(0)
+    levelist = pd.to_numeric(df["levelist"], errors="coerce")
+    df["levelist"] = levelist.fillna(default).astype("int64")
+    return df
+
+
+@lru_cache(maxsize=INDEX_MEMO_SIZE)
+def _url_index(query_url: str, batch: str = None) -> pd.DataFrame:
+    return read_index(cached_get(query_url, batch).text)
+
+
+def get_url_detail(url: str, batch: str = None) -> pd.DataFrame:
+    """get the detail messages of the grib2 file of the given url
+
+    The result is memoized by (url, batch), callers must not modify it in place.
+
+    Args:
+        url (str): grib file url
+        batch (str, optional): batch like '2022062500', part of the index cache key. Defaults to None.
+
+    Returns:
+        pd.DataFrame: mesaages details
+    """
+    query_url = url.replace(".grib2", ".index")
+    try:
+        return _url_index(query_url, batch)
+    except Exception as e:
+        logger.error(e)
+        return read_index("")
+
+
+def variable_table(var_dict: dict) -> pd.DataFrame:
+    """table of the variables to join index messages against
+
+    Args:
+        var_dict (dict): {V(varname, level_type, level): O(outname)}
+
+    Returns:
+        pd.DataFrame: columns 'param', 'levtype', 'levelist' (int64) and 'outname'
+    """
+    return pd.DataFrame(
+        [(v.varname, v.level_type, int(v.level), o.outname) for v, o in var_dict.items()],
+        columns=["param", "levtype", "levelist", "outname"],
+    ).astype({"levelist": "int64"})
+
+
+def match_variables(
+    df: pd.DataFrame, var_dict: dict, hour: int, data_type: str
+) -> pd.DataFrame:
+    """select the messages of data type and variables
+
+    Args:
+        df (pd.DataFrame): index messages from read_index
+        var_dict (dict): {V(varname, level_type, level): O(outname)}
+        hour (int): forecast hour
+        data_type (str): grib message data type, 'fc', 'cf', 'pf' for all perturbed members or 'pf{number}'
+
+    Returns:
+        pd.DataFrame: columns 'fn' ('{OUTNAME}-{HOUR}'), 'start', 'end'
+    """
+    if data_type.startswith("pf"):
+        mask = df["type"] == "pf"
+        if len(data_type) > 2:
+            number = pd.to_numeric(df["number"], errors="coerce")
+            mask &= number == int(data_type[2:])
+    else:
+        mask = df["type"] == data_type
+    res = df.loc[mask, ["param", "levtype", "levelist", "start", "end"]].merge(
+        variable_table(var_dict), on=["param", "levtype", "levelist"]
+    )
+    res["fn"] = res["outname"] + f"-{str(hour).zfill(3)}"
+    return res[["fn", "start", "end"]]
@@ -0,0 +1,250 @@
+from glob import glob
+import os
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from loguru import logger
+
+from maesters.config import MODEL, get_concurrency
+from maesters.utils import batch_range_download, single_range_download
+from maesters.utils.concurrency import get_controller
+from maesters.utils.download import coalesced_range_download, range_buffers
+from maesters.citadels.ECMWF.index import get_url_detail, match_variables
+from maesters.utils.journal import DownloadJournal, group_by
+from maesters.utils.encoding import Encoding
+from maesters.utils.layout import LayoutWriter
+from maesters.utils.region import check_bbox
+from maesters.utils.post_process import batch_convert_nc, single_convert_nc
+
+# the download and conversion shared by the ECMWF open data products, by model and hours
+
+PARALLEL_NUM = get_concurrency()["processes"]
+
+
+def get_files_dict(
+    model: MODEL, date: datetime, hour: int, var_dict: dict, data_type: str
+) -> dict:
+    """get download list of model at date batch hour
+
+    Args:
+        model (MODEL): ECMWF model like ECMWF_OPER
+        date (datetime): initial date
+        hour (int): forecast hour
+        var_dict (dict): variable dict
+        data_type (str): grib message data type {'fc','cf','pf'}
+    Returns:
+        dict: {
+            '{VARNAME}_{LEVEL}-{HOUR}': {'url': str, 'start': int, 'end': int},
+        }
+    """
+    url = date.strftime(model.download_url).format(hour=int(hour))
+    df = get_url_detail(url, f"{date:%Y%m%d%H}")
+
+    try:
+        res = match_variables(df, var_dict, hour, data_type)
+        return {
+            fn: {"url": url, "start": int(start), "end": int(end)}
+            for fn, start, end in res.itertuples(index=False)
+        }
+    except Exception as e:
+        logger.error(e)
+        return {}
+
+
+def get_all_files_list(model: MODEL, hours: list, dt: datetime, data_type: str) -> list:
+    """get the download lists of all hours, in the order of hours"""
+    result = []
+    # each index GET holds a slot of the host controller (cached_get), the pool
+    # starts at its current AIMD limit rather than at the ceiling
+    workers = max(1, int(get_controller(model.download_url).limit))
+    with ThreadPoolExecutor(max_workers=workers) as exec:
+        futures = [
+            exec.submit(get_files_dict, model, dt, h, model.variable, data_type)
+            for h in hours
+        ]
+        # keep the order of hours
+        for f in futures:
+            result.append(f.result())
+    return result
+
+
+def download(**kwargs):
+    single_range_download(
+        download_url=kwargs["url"],
+        start_bytes=kwargs["start"],
+        end_bytes=kwargs["end"],
+        local_fp=kwargs["local_fp"].replace(".nc", ".grib2"),
+    )
+    single_convert_nc(
+        kwargs["local_fp"].replace(".nc", ".grib2"),
+        kwargs["local_fp"],
+        bbox=kwargs.get("bbox"),
+    )
+    os.remove(kwargs["local_fp"].replace(".nc", ".grib2"))
+    return os.path.getsize(kwargs["local_fp"])
+
+
+def batch_download(items: list) -> list:
+    """download and convert download_dict items together, the messages of one url are fetched in coalesced spans
+
+    Args:
+        items (list): [{'url': str, 'start': int, 'end': int, 'local_fp': str, 'bbox': tuple (optional)},...]
+    Returns:
+        list: failed items
+    """
+    grib = {i["local_fp"]: i["local_fp"].replace(".nc", ".grib2") for i in items}
+    fail = coalesced_range_download(
+        [(i["url"], i["start"], i["end"], grib[i["local_fp"]]) for i in items]
+    )
+    failed = {f[3] for f in fail}
+    in_out_list = [(g, fp) for fp, g in grib.items() if g not in failed]
+    bbox = {i["local_fp"]: check_bbox(i.get("bbox")) for i in items}
+    for b, group in group_by(in_out_list, lambda i: bbox[i[1]]).items():
+        failed.update(f[0] for f in batch_convert_nc(group, bbox=b))
+    for g, _ in in_out_list:
+        if os.path.exists(g):
+            os.remove(g)
+    return [i for i in items if grib[i["local_fp"]] in failed]
+
+
+def batch_fetch(items: list) -> list:
+    """download the GRIB messages of download_dict items into memory, in coalesced spans
+
+    Args:
+        items (list): [{'url': str, 'start': int, 'end': int},...]
+    Returns:
+        list: bytes of every item
+    """
+    return range_buffers([(i["url"], i["start"], i["end"]) for i in items])
+
+
+def save_batch(
+    model: MODEL,
+    hours: list,
+    date: datetime,
+    local_dir: str,
+    data_type: str,
+    journal: DownloadJournal = None,
+):
+    """save all model batch files at date in directory
+
+    Parameters:
+        model: MODEL, ECMWF model like ECMWF_OPER
+        hours: list, forecast hours of the batch
+        date: datetime, UTC
+        local_dir: str, save dir
+        data_type: str, grib message data type {'fc','cf','pf'}
+        journal: DownloadJournal, resume the journaled downloads instead of discovering again
+    return:
+        -1 if some fail
+        0 if all success
+    """
+    name = model.modelname.upper()
+    logger.info(f"{name} {date:%Y%m%d}{str(date.hour).zfill(2)} download start")
+    results = {}
+    fail = []
+    if journal is not None and journal.is_planned():
+        pending = journal.pending_downloads()
+        logger.info(f"{name}: resume {len(pending)} downloads from journal")
+        downloads = {
+            f"URL: {url}": inputs_list
+            for url, inputs_list in group_by(pending, lambda i: i[0]).items()
+        }
+    else:
+        downloads = {}
+        for hour, d in zip(hours, get_all_files_list(model, hours, date, data_type)):
+            downloads[f"HOUR: {hour}"] = [
+                (v["url"], v["start"], v["end"], os.path.join(local_dir, k + ".grib2"))
+                for k, v in d.items()
+            ]
+        if journal is not None:
+            journal.plan([i for v in downloads.values() for i in v])
+            if all(downloads.values()):
+                journal.close_plan()
+
+    with ProcessPoolExecutor(max_workers=PARALLEL_NUM) as exec:
+        for label, inputs_list in downloads.items():
+            results[
+                exec.submit(
+                    coalesced_range_download, inputs_list=inputs_list, journal=journal
+                )
+            ] = label
+
+        for r in as_completed(results):
+            res = r.result()
+            if res:
+                fail.extend(res)
+            else:
+                logger.info(
+                    f"{name}: [DATE: {date:%Y%m%d} BATCH: {str(date.hour).zfill(2)} "
+                    f"{results[r]}] DOWNLOAD FINISH"
+                )
+
+    fail = batch_range_download(fail, file_type="grib", journal=journal)
+    if fail:
+        logger.error("the following download fail")
+        logger.error(fail)
+        return -1
+    else:
+        logger.info(
+            f"{name}: [DATE: {date:%Y%m%d} BATCH: {str(date.hour).zfill(2)}] ALL DOWNLOAD FINISH"
+        )
+        return 0
+
+
+def convert_batch(
+    model: MODEL,
+    hours: list,
+    grib_dir: str,
+    out_dir: str,
+    journal: DownloadJournal = None,
+    layout: str = "file",
+    format: str = "nc",
+    chunks: dict = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
+):
+    """convert the downloaded grib files of a model batch
+
+    Parameters:
+        model: MODEL, ECMWF model like ECMWF_OPER
+        hours: list, forecast hours of the batch
+        grib_dir: str, grib file directory
+        out_dir: str, out file directory
+        journal: DownloadJournal, convert only the journaled downloads not converted yet
+        layout: str, 'file' for one nc per variable and hour, 'variable' for one nc per variable
+        format: str, 'nc', or 'zarr' for one chunked store of the batch
+        chunks: dict, zarr chunk length by dimension, None for ZARR_CHUNKS
+        encoding: Encoding, compression, chunks, dtype and packing of the nc outputs
+        bbox: tuple, (west, south, east, north) written only, None for the whole grid
+    return:
+        -1 if some fail
+        0 if all success
+    """
+    grib_files = (
+        journal.pending_conversions()
+        if journal is not None
+        else glob(os.path.join(grib_dir, "*.grib*"))
+    )
+    writer = LayoutWriter(out_dir, hours, layout, format, chunks, encoding)
+    in_out_list = []
+    for f in grib_files:
+        name = os.path.basename(f).split(".gr")[0]
+        varname, hour = name.rsplit("-", 1)
+        in_out_list.append((f, writer.hour_fp(name, varname, int(hour))))
+    fail = batch_convert_nc(
+        in_out_list, callback=writer, encoding=writer.hour_encoding, bbox=bbox
+    )
+    fail = batch_convert_nc(
+        fail, callback=writer, encoding=writer.hour_encoding, bbox=bbox
+    )
+    if journal is not None:
+        journal.converted(writer.outputs(in_out_list), writer.outputs(fail))
+    writer.close()
+    if fail:
+        logger.error("the following convern nc fail")
+        logger.error(fail)
+        return -1
+    else:
+        logger.info(f"{model.modelname.upper()}: ALL CONVERT FINISH")
+        return 0
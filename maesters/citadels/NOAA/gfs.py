@@ -18,7 +18,7 @@ import numpy as np
 from retrying import retry
 from pandas.core.common import SettingWithCopyWarning
 
-from maesters.config import get_model, V  # , PATH
+from maesters.config import get_model, V, get_concurrency  # , PATH
 from maesters.utils import batch_range_download, single_range_download
 from maesters.utils.post_process import batch_convert_nc, single_convert_nc
 
@@ -32,7 +32,7 @@ logger.add(
 )
 
 
-PARALLEL_NUM = 5
+PARALLEL_NUM = get_concurrency()["processes"]
 
 NOAA_GFS = get_model("noaa", "gfs")
 HOURS = {
@@ -137,7 +137,7 @@ def get_files_dict(date: datetime, hour: int, var_dict=NOAA_GFS.variable) -> dic
 
 def get_all_files_list(dt: datetime) -> dict:
     result = []
-    with ThreadPoolExecutor(max_workers=5) as exec:
+    with ThreadPoolExecutor(max_workers=get_concurrency()["initial"]) as exec:
         futures = [
             exec.submit(get_files_dict, date=dt, hour=h) for h in HOURS["medium"]
         ]
@@ -0,0 +1,81 @@
+import importlib
+import threading
+
+# (source, product) -> module of the citadel, the ones not listed fall back to
+# maesters.citadels.{SOURCE}.{product}
+CITADELS = {
+    ("ecmwf", "oper"): "maesters.citadels.ECMWF.oper",
+    ("ecmwf", "enfo"): "maesters.citadels.ECMWF.enfo",
+    ("cmc", "gem"): "maesters.citadels.CMC.gem",
+    ("cmc", "geps_ens"): "maesters.citadels.CMC.geps_ens",
+    ("dwd", "icon"): "maesters.citadels.DWD.icon",
+}
+
+_HANDLERS = {}
+_HANDLERS_LOCK = threading.Lock()
+
+
+class Citadel:
+    """handler of one source product, its module (and the heavy imports in it) is loaded on first use
+
+    Attributes of the module like get_files_dict, download and operation are
+    looked up through the handler.
+    """
+
+    def __init__(self, source: str, product: str, module_name: str) -> None:
+        self.source = source
+        self.product = product
+        self.module_name = module_name
+        self._module = None
+        self._lock = threading.Lock()
+
+    @property
+    def module(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self.module_name)
+        return self._module
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.module, name)
+
+    def __repr__(self) -> str:
+        return f"Citadel({self.source}, {self.product}, {self.module_name})"
+
+
+def register_citadel(source: str, product: str, module_name: str):
+    """register the module of source product
+
+    Args:
+        source (str): NWP data provider like 'ecmwf'
+        product (str): NWP product from source like 'enfo'
+        module_name (str): module with get_files_dict, download and operation
+    """
+    key = (source.lower(), product.lower())
+    with _HANDLERS_LOCK:
+        CITADELS[key] = module_name
+        _HANDLERS.pop(key, None)
+
+
+def get_citadel(source: str, product: str) -> Citadel:
+    """get the lazily loaded handler of source product
+
+    Args:
+        source (str): NWP data provider like 'ecmwf'
+        product (str): NWP product from source like 'enfo'
+
+    Returns:
+        Citadel: shared handler
+    """
+    key = (source.lower(), product.lower())
+    handler = _HANDLERS.get(key)
+    if handler is None:
+        module_name = CITADELS.get(
+            key, f"maesters.citadels.{source.upper()}.{product.lower()}"
+        )
+        with _HANDLERS_LOCK:
+            handler = _HANDLERS.setdefault(key, Citadel(key[0], key[1], module_name))
+    return handler
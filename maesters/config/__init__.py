@@ -1,10 +1,17 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from statistics import mode
 import sys
 import os
+import threading
 from subprocess import check_output
 import toml
 
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_TOMLS = {}
+_MODELS = {}
+_REGISTRY_LOCK = threading.Lock()
+
 
 @dataclass
 class V:
@@ -39,13 +46,54 @@ class MODEL:
     data_dir: str
     download_url: str
     delay_hours: int
+    by_outname: dict = field(default_factory=dict, repr=False)
+    by_level_type: dict = field(default_factory=dict, repr=False)
+
+    def __post_init__(self):
+        # indexes of variable: {outname: (V, O)} and {level_type: {V: O}}
+        for v, o in self.variable.items():
+            self.by_outname[o.outname] = (v, o)
+            self.by_level_type.setdefault(v.level_type, {})[v] = o
+
+
+def load_toml(fp: str) -> dict:
+    """load toml file once per process, reloaded when its mtime changes
+
+    Args:
+        fp (str): toml filepath
+
+    Returns:
+        dict: toml content, shared by callers and not to be modified
+    """
+    st = os.stat(fp)
+    cached = _TOMLS.get(fp)
+    if cached is not None and cached[0] == st.st_mtime_ns:
+        return cached[1]
+
+    with open(fp, "r") as f:
+        content = toml.load(f)
+    with _REGISTRY_LOCK:
+        _TOMLS[fp] = (st.st_mtime_ns, content)
+    return content
 
 
 def get_model(source: str, product: str):
-    with open(
-        os.path.join(os.path.dirname(__file__), f"{source.lower()}.toml"), "r"
-    ) as f:
-        models = toml.load(f)
+    """get the model of source product from the process-wide registry
+
+    Args:
+        source (str): NWP data provider like 'ecmwf'
+        product (str): NWP product from source like 'enfo'
+
+    Returns:
+        MODEL: shared by callers and not to be modified, None if not found
+    """
+    fp = os.path.join(CONFIG_DIR, f"{source.lower()}.toml")
+    models = load_toml(fp)
+    key = (source.lower(), product.lower())
+    cached = _MODELS.get(key)
+    if cached is not None and cached[0] is models:
+        return cached[1]
+
     model = models.get(f"{source.lower()}_{product.lower()}")
     if model:
         varibales = model.get("variables")
@@ -62,13 +110,53 @@ def get_model(source: str, product: str):
             model.get("download_url"),
             model.get("delay_hours"),
         )
-        return m
     else:
-        return None
+        m = None
+    with _REGISTRY_LOCK:
+        _MODELS[key] = (models, m)
+    return m
+
+
+def get_concurrency(host: str = None) -> dict:
+    """get the concurrency limits of host (default section if host is None)
+
+    Args:
+        host (str, optional): url host like 'data.ecmwf.int'. Defaults to None.
+
+    Returns:
+        dict: {'floor': int, 'ceiling': int, 'initial': int, 'processes': int}
+    """
+    config = load_toml(os.path.join(CONFIG_DIR, "concurrency.toml"))
+    limits = dict(config.get("default", {}))
+    if host:
+        limits.update(config.get("hosts", {}).get(host, {}))
+    # env overrides every section
+    for k in ["floor", "ceiling"]:
+        if os.environ.get(f"MAESTERS_CONCURRENCY_{k.upper()}"):
+            limits[k] = int(os.environ.get(f"MAESTERS_CONCURRENCY_{k.upper()}"))
+    limits["initial"] = min(
+        max(limits.get("initial", limits["floor"]), limits["floor"]), limits["ceiling"]
+    )
+    return limits
+
+
+def get_convert_workers() -> int:
+    """get the conversion worker number, scaled by cpu count (env MAESTERS_CONVERT_WORKERS overrides)
+
+    Returns:
+        int: worker number
+    """
+    if os.environ.get("MAESTERS_CONVERT_WORKERS"):
+        return int(os.environ.get("MAESTERS_CONVERT_WORKERS"))
+    return max(1, (os.cpu_count() or 2) - 1)
 
 
 DEFAULT_MAESTER = {
     "datahome": os.path.join(os.environ.get("HOME"), "data"),
+    "cachehome": os.environ.get(
+        "MAESTERS_CACHE_HOME",
+        os.path.join(os.environ.get("HOME"), ".cache", "maesters"),
+    ),
     "source": "ecmwf",
     "product": "enfo",
     "varname": "TMP_L0",
@@ -0,0 +1,338 @@
+import asyncio
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from loguru import logger
+
+from maesters.utils.concurrency import get_controller, is_client_error
+from maesters.utils.download import (
+    CHUNK_SIZE,
+    ChecksumWriter,
+    DecompressGribWriter,
+    after_download,
+    before_download,
+    check_range_headers,
+    file_checksum,
+    journal_downloaded,
+    read_validator,
+    remove_partial,
+    save_validator,
+)
+
+CONCURRENCY = 256
+HOST_CONCURRENCY = 32
+RETRY_NUMBER = 3
+RETRY_WAIT = 10
+
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError as e:
+        raise ImportError(
+            "asyncio download backend needs aiohttp, install it by `pip install aiohttp`"
+        ) from e
+    return aiohttp
+
+
+async def _write_chunks(resp, write: Callable):
+    """stream the body of resp into write, flushed per CHUNK_SIZE in the default executor
+
+    The write, hashing and decompression of a flush run off the event loop,
+    so a slow disk or decompression never stalls the other transfers.
+    """
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        buffer += chunk
+        if len(buffer) >= CHUNK_SIZE:
+            await loop.run_in_executor(None, write, bytes(buffer))
+            buffer.clear()
+    if buffer:
+        await loop.run_in_executor(None, write, bytes(buffer))
+
+
+async def _stream_to_file(resp, tmp: str, mode: str, checksum: bool = False) -> str:
+    loop = asyncio.get_running_loop()
+    # in append mode the writer hashes the partial file first
+    f = await loop.run_in_executor(None, ChecksumWriter, tmp, mode, checksum)
+    try:
+        await _write_chunks(resp, f.write)
+    finally:
+        await loop.run_in_executor(None, f.close)
+    return f.hexdigest()
+
+
+async def _bz2_stream_download(
+    session, download_url: str, local_fp: str, journal=None
+) -> int:
+    tmp = local_fp + ".tmp"
+    before_download(tmp)
+    writer = DecompressGribWriter(tmp, checksum=journal is not None)
+    try:
+        async with session.get(download_url) as resp:
+            resp.raise_for_status()
+            await _write_chunks(resp, writer.write)
+        await asyncio.get_running_loop().run_in_executor(None, writer.close)
+    except Exception:
+        writer.abort()
+        remove_partial(tmp)
+        raise
+    shutil.move(tmp, local_fp)
+    journal_downloaded(journal, local_fp, writer.hexdigest())
+    return os.path.getsize(local_fp)
+
+
+async def session_download(
+    session, download_url: str, local_fp: str, file_type: str = "grib", journal=None
+) -> int:
+    """download single file from download url to local path on event loop, and verify
+
+    Parameters:
+        session: aiohttp.ClientSession
+        download_url: str, download url
+        local_fp: str, local filepath
+        file_type: str, grib, or bz2 to decompress the stream into local filepath on the fly
+        journal: DownloadJournal, record the download with the checksum computed while streaming
+    return:
+        int, the bytes size of file
+    """
+    tmp = local_fp + ".tmp"
+    if os.path.exists(local_fp):
+        journal_downloaded(journal, local_fp)
+        return os.path.getsize(local_fp)
+    if "bz2" in file_type.lower():
+        return await _bz2_stream_download(session, download_url, local_fp, journal)
+
+    before_download(tmp, resume=True)
+    offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+    headers = (
+        {"Range": f"bytes={offset}-", "If-Range": read_validator(tmp)}
+        if offset
+        else {}
+    )
+    async with session.get(download_url, headers=headers) as resp:
+        if resp.status == 416 and offset:
+            # the partial file already holds the whole content
+            total = resp.headers.get("Content-Range", "").split("/")[-1]
+            if total != str(offset):
+                remove_partial(tmp)
+                raise Exception(f"{download_url} can not resume from {offset}")
+            checksum = (
+                await asyncio.get_running_loop().run_in_executor(
+                    None, file_checksum, tmp
+                )
+                if journal is not None
+                else None
+            )
+        else:
+            resp.raise_for_status()
+            if resp.status == 206:
+                try:
+                    check_range_headers(resp.headers, download_url, offset)
+                except Exception:
+                    remove_partial(tmp)
+                    raise Exception(f"{download_url} can not resume from {offset}")
+            save_validator(tmp, resp.headers)
+            checksum = await _stream_to_file(
+                resp, tmp, "ab" if resp.status == 206 else "wb", journal is not None
+            )
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, after_download, tmp, file_type, local_fp)
+    journal_downloaded(journal, local_fp, checksum)
+    return os.path.getsize(local_fp)
+
+
+async def range_download(
+    session,
+    download_url: str,
+    start_bytes: int,
+    end_bytes: int,
+    local_fp: str,
+    file_type: str = "grib",
+    journal=None,
+) -> int:
+    """download bytes range of single file from download url to local path on event loop, and verify
+
+    Parameters:
+        session: aiohttp.ClientSession
+        download_url: str, download url
+        start_bytes: int, the download_range bytes start
+        end_bytes: int, the download_range bytes end (exclusive)
+        local_fp: str, local filepath
+        file_type: str, grib
+        journal: DownloadJournal, record the download with the checksum computed while streaming
+    return:
+        int, the bytes size of file
+    """
+    tmp = local_fp + ".tmp"
+    if os.path.exists(local_fp):
+        journal_downloaded(journal, local_fp)
+        return os.path.getsize(local_fp)
+
+    start_bytes, end_bytes = int(start_bytes), int(end_bytes)
+    before_download(tmp, resume=True)
+    offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+    if offset > end_bytes - start_bytes:
+        remove_partial(tmp)
+        offset = 0
+    headers = {"Range": f"bytes={start_bytes + offset}-{end_bytes - 1}"}
+    if offset:
+        headers["If-Range"] = read_validator(tmp)
+
+    checksum = None
+    if start_bytes + offset < end_bytes:
+        async with session.get(download_url, headers=headers) as resp:
+            resp.raise_for_status()
+            if resp.status != 206:
+                remove_partial(tmp)
+                raise Exception(f"{download_url} range request got status {resp.status}")
+            check_range_headers(
+                resp.headers, download_url, start_bytes + offset, end_bytes
+            )
+            save_validator(tmp, resp.headers)
+            checksum = await _stream_to_file(resp, tmp, "ab", journal is not None)
+    elif journal is not None:
+        checksum = await asyncio.get_running_loop().run_in_executor(
+            None, file_checksum, tmp
+        )
+    if os.path.getsize(tmp) != end_bytes - start_bytes:
+        raise Exception(f"{download_url} range {start_bytes}-{end_bytes} incomplete")
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, after_download, tmp, file_type, local_fp)
+    journal_downloaded(journal, local_fp, checksum)
+    return os.path.getsize(local_fp)
+
+
+async def _controlled(func, session, conditions: dict, *args):
+    """run one transfer within the adaptive in-flight limit of its host"""
+    controller = get_controller(args[0])
+    condition = conditions.setdefault(controller.host, asyncio.Condition())
+    async with condition:
+        await condition.wait_for(controller.try_acquire)
+    ok, nbytes = False, 0
+    try:
+        nbytes = await func(session, *args)
+        ok = True
+        return nbytes
+    except Exception as e:
+        ok = None if is_client_error(e) else False
+        raise
+    finally:
+        controller.release(ok, nbytes)
+        async with condition:
+            condition.notify_all()
+
+
+async def _retry(func, *args):
+    for attempt in range(RETRY_NUMBER):
+        try:
+            return await _controlled(func, *args)
+        except Exception:
+            if attempt == RETRY_NUMBER - 1:
+                raise
+            await asyncio.sleep(RETRY_WAIT)
+
+
+async def _batch(
+    func,
+    inputs_list: list,
+    file_type: str,
+    concurrency: int,
+    host_concurrency: int,
+    journal=None,
+) -> list:
+    aiohttp = _import_aiohttp()
+    connector = aiohttp.TCPConnector(
+        limit=concurrency, limit_per_host=host_concurrency
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=60 * 5)
+    fail = []
+    conditions = {}
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = [
+            asyncio.ensure_future(_retry(func, session, conditions, *i, file_type, journal))
+            for i in inputs_list
+        ]
+        for i, result in zip(
+            inputs_list, await asyncio.gather(*tasks, return_exceptions=True)
+        ):
+            if isinstance(result, BaseException):
+                logger.error(i[0])
+                logger.error(result)
+                fail.append(i)
+    return fail
+
+
+def _run(coro):
+    """run coroutine to the end, in a new thread if an event loop is running (e.g. jupyter)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+
+def async_batch_session_download(
+    url_fp_list: list,
+    file_type: str = "grib",
+    concurrency: int = CONCURRENCY,
+    host_concurrency: int = HOST_CONCURRENCY,
+    journal=None,
+) -> list:
+    """download multiply files from download urls to local path on one event loop, and handle logger
+
+    Parameters:
+        url_fp_list: list, [(url, local filepath),...]
+        file_type: str
+        concurrency: int, max concurrent transfers
+        host_concurrency: int, hard cap of concurrent transfers per host, under which the adaptive limit moves
+        journal: DownloadJournal, record the finished downloads
+    return:
+        fail: list
+    """
+    return _run(
+        _batch(
+            session_download,
+            url_fp_list,
+            file_type,
+            concurrency,
+            host_concurrency,
+            journal,
+        )
+    )
+
+
+def async_batch_range_download(
+    inputs_list: list,
+    file_type: str = "grib",
+    concurrency: int = CONCURRENCY,
+    host_concurrency: int = HOST_CONCURRENCY,
+    journal=None,
+) -> list:
+    """range-download multi files from download urls to local path on one event loop, and handle logger
+
+    Parameters:
+        inputs_list: list, [(url, start_bytes, end_bytes, local filepath),...], end_bytes is exclusive
+        file_type: str
+        concurrency: int, max concurrent transfers
+        host_concurrency: int, hard cap of concurrent transfers per host, under which the adaptive limit moves
+        journal: DownloadJournal, record the finished downloads
+    return:
+        fail: list
+    """
+    return _run(
+        _batch(
+            range_download,
+            inputs_list,
+            file_type,
+            concurrency,
+            host_concurrency,
+            journal,
+        )
+    )
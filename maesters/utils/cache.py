@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from datetime import datetime
+from contextlib import contextmanager
+
+from loguru import logger
+
+from maesters.config import DEFAULT_MAESTER
+
+# converted data, next to the http, remap and weight caches under cachehome
+CACHE_ROOT = os.path.join(DEFAULT_MAESTER["cachehome"], "data")
+# size quota of CACHE_ROOT only
+CACHE_QUOTA = int(os.environ.get("MAESTERS_CACHE_QUOTA", 20 * 1024**3))
+STALE_SECONDS = 6 * 60 * 60
+# prefix of the download directories aside in cache root
+STAGING_PREFIX = "staging-"
+
+
+def cache_key(
+    source: str,
+    product: str,
+    batch: datetime,
+    variable: str,
+    hour: int,
+    data_type: str = None,
+    stats: str = None,
+    bbox: tuple = None,
+) -> str:
+    """get the content address of one converted field
+
+    Parameters:
+        source: str, NWP data provider
+        product: str, NWP product from source
+        batch: datetime, NWP batch start time UTC
+        variable: str, output variable name
+        hour: int, predict hour from batch
+        data_type: str, ENS data type like 'cf'/'pf1'
+        stats: str, ENS stats method like 'ensmean'
+        bbox: tuple, (west, south, east, north) of a cropped field
+    return:
+        str, sha256 hex digest
+    """
+    fields = [
+        source.lower(),
+        product.lower(),
+        batch.strftime("%Y%m%d%H"),
+        variable,
+        int(hour),
+        data_type,
+        stats,
+    ]
+    if bbox is not None:
+        # the keys of whole fields are unchanged
+        fields.append([float(b) for b in bbox])
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+class DataCache:
+    """content-addressed cache of converted nc files with LRU eviction under a size quota
+
+    Files are published atomically (written aside, then os.replace), so a
+    reader never sees a partial file. A hit refreshes the file mtime, which
+    is the LRU order of eviction. Publish and eviction hold a lock file in
+    root, and eviction sweeps what crashed processes left behind.
+    """
+
+    def __init__(self, root: str, quota: int = CACHE_QUOTA) -> None:
+        self.root = root
+        self.quota = quota
+
+    @contextmanager
+    def _lock(self):
+        import fcntl
+
+        os.makedirs(self.root, 0o777, exist_ok=True)
+        with open(os.path.join(self.root, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".nc")
+
+    def get(self, key: str) -> str:
+        """get the cached filepath of key and mark it recently used, None if missing"""
+        fp = self.path(key)
+        try:
+            os.utime(fp)
+        except FileNotFoundError:
+            return None
+        return fp
+
+    def staging(self) -> str:
+        """make a directory in cache root to download aside, publish from it is then an atomic rename"""
+        os.makedirs(self.root, 0o777, exist_ok=True)
+        return tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=self.root)
+
+    def publish(self, local_fp: str, key: str) -> str:
+        """move local file into cache atomically
+
+        Parameters:
+            local_fp: str, local filepath, moved away
+            key: str, cache key
+        return:
+            str, cached filepath
+        """
+        fp = self.path(key)
+        with self._lock():
+            os.makedirs(os.path.dirname(fp), 0o777, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(fp))
+            os.close(fd)
+            try:
+                shutil.move(local_fp, tmp)
+                os.chmod(tmp, 0o666)
+                os.replace(tmp, fp)
+            except Exception as e:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise Exception from e
+        return fp
+
+    def usage(self) -> list:
+        """get the cached files
+
+        return:
+            list, [(mtime, size, filepath),...]
+        """
+        files = []
+        for d in os.scandir(self.root) if os.path.isdir(self.root) else []:
+            # key prefix directories only, not the download directories aside
+            if not d.is_dir() or len(d.name) != 2:
+                continue
+            for f in os.scandir(d.path):
+                if not f.name.endswith(".nc"):
+                    continue
+                try:
+                    st = f.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, f.path))
+        return files
+
+    def sweep(self) -> int:
+        """remove the staging directories and publish temp files left by crashed processes
+
+        return:
+            int, number of entries removed
+        """
+        stale = time.time() - STALE_SECONDS
+        removed = 0
+        for d in os.scandir(self.root) if os.path.isdir(self.root) else []:
+            try:
+                if d.name.startswith(STAGING_PREFIX) and d.is_dir():
+                    if d.stat().st_mtime < stale:
+                        shutil.rmtree(d.path, ignore_errors=True)
+                        removed += 1
+                elif d.is_dir() and len(d.name) == 2:
+                    for f in os.scandir(d.path):
+                        if f.name.endswith(".tmp") and f.stat().st_mtime < stale:
+                            os.remove(f.path)
+                            removed += 1
+            except FileNotFoundError:
+                continue
+        if removed:
+            logger.info(f"cache {self.root}: sweep {removed} stale staging entries")
+        return removed
+
+    def evict(self, protect: list = ()) -> int:
+        """remove the least recently used files until the cache fits its quota
+
+        Parameters:
+            protect: list, keys in use which are never evicted
+        return:
+            int, bytes removed
+        """
+        with self._lock():
+            self.sweep()
+            files = sorted(self.usage())
+            total = sum(f[1] for f in files)
+            protected = {self.path(k) for k in protect}
+            removed = 0
+            for mtime, size, fp in files:
+                if total - removed <= self.quota:
+                    break
+                if fp in protected:
+                    continue
+                try:
+                    os.remove(fp)
+                except FileNotFoundError:
+                    pass
+                removed += size
+        if removed:
+            logger.info(f"cache {self.root}: evict {removed} bytes")
+        return removed
@@ -0,0 +1,157 @@
+import os
+import time
+import multiprocessing
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from maesters.config import get_concurrency
+
+WINDOW = 16
+DECREASE = 0.5
+
+_CONTROLLERS = {}
+_CONTROLLERS_PID = None
+_CONTROLLERS_LOCK = threading.Lock()
+
+
+class HostController:
+    """AIMD controller of in-flight transfers to one host
+
+    The limit grows by one after every window of successful transfers whose
+    throughput does not fall behind the best one seen, shrinks by one when it
+    does, and is multiplied by DECREASE on any error or timeout. It always
+    stays within [floor, ceiling].
+    """
+
+    def __init__(
+        self,
+        host: str,
+        floor: int = 2,
+        ceiling: int = 32,
+        initial: int = 5,
+        window: int = WINDOW,
+    ) -> None:
+        self.host = host
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = float(min(max(initial, floor), ceiling))
+        self.window = window
+        self.inflight = 0
+        self._cond = threading.Condition()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_count = 0
+        self._best = 0.0
+
+    def try_acquire(self) -> bool:
+        """take a transfer slot if the limit allows, without blocking"""
+        with self._cond:
+            if self.inflight < int(self.limit):
+                self.inflight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """block until a transfer slot is free and take it"""
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+
+    def release(self, ok: bool = True, nbytes: int = 0):
+        """free a transfer slot and feed its outcome to the controller
+
+        Parameters:
+            ok: bool, False if the transfer failed or timed out, None if the outcome says nothing about the host load
+            nbytes: int, bytes transferred
+        """
+        with self._cond:
+            self.inflight -= 1
+            if ok:
+                self._on_success(nbytes)
+            elif ok is not None:
+                self._on_error()
+            self._cond.notify_all()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_count = 0
+
+    def _on_success(self, nbytes: int):
+        self._window_bytes += nbytes
+        self._window_count += 1
+        if self._window_count < self.window:
+            return
+        throughput = self._window_bytes / max(
+            time.monotonic() - self._window_start, 1e-6
+        )
+        if throughput >= 0.9 * self._best:
+            self.limit = min(self.limit + 1, self.ceiling)
+        else:
+            self.limit = max(self.limit - 1, self.floor)
+        self._best = max(self._best, throughput)
+        self._reset_window()
+
+    def _on_error(self):
+        limit = max(self.limit * DECREASE, self.floor)
+        if int(limit) < int(self.limit):
+            logger.warning(f"{self.host}: in-flight limit {int(self.limit)} -> {int(limit)}")
+        self.limit = limit
+        # the throughput seen before the backoff is not reachable for now
+        self._best *= DECREASE
+        self._reset_window()
+
+    @contextmanager
+    def transfer(self):
+        """hold a transfer slot for the with-block, set 'bytes' of the yielded dict to report size"""
+        self.acquire()
+        stats = {"bytes": 0}
+        try:
+            yield stats
+        except BaseException as e:
+            self.release(None if is_client_error(e) else False)
+            raise
+        self.release(True, stats["bytes"])
+
+
+def is_client_error(e: BaseException) -> bool:
+    """whether the exception is an http 4xx (except 429) answer, which is not a sign of overload"""
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is None:
+        status = getattr(e, "status", None)
+    return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+
+def get_controller(download_url: str) -> HostController:
+    """get the controller of the url host, shared by all threads of the process
+
+    The controller of a pool worker (like the download processes of a
+    citadel operation) gets its share, ceiling / processes, of the host
+    ceiling, so the pool as a whole stays under it.
+
+    Parameters:
+        download_url: str, download url
+    return:
+        HostController
+    """
+    global _CONTROLLERS_PID
+    host = urlsplit(download_url).netloc
+    with _CONTROLLERS_LOCK:
+        if _CONTROLLERS_PID != os.getpid():
+            _CONTROLLERS.clear()
+            _CONTROLLERS_PID = os.getpid()
+        controller = _CONTROLLERS.get(host)
+        if controller is None:
+            limits = get_concurrency(host)
+            ceiling = limits["ceiling"]
+            if multiprocessing.current_process().name != "MainProcess":
+                ceiling = max(limits["floor"], ceiling // limits["processes"])
+            controller = HostController(
+                host, limits["floor"], ceiling, limits["initial"]
+            )
+            _CONTROLLERS[host] = controller
+    return controller
@@ -0,0 +1,108 @@
+import numpy as np
+
+from maesters.utils.grib import split_messages
+from maesters.utils.region import bbox_index
+
+REGULAR_GRIDS = ["regular_ll", "regular_gg"]
+
+
+def open_messages(source) -> list:
+    """open the GRIB messages of a file or of in-memory bytes
+
+    Parameters:
+        source: str | bytes | list, grib filepath, bytes of messages, or a list of them
+    return:
+        list, pygrib messages
+    """
+    import pygrib
+
+    if isinstance(source, (list, tuple)):
+        return [m for s in source for m in open_messages(s)]
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return [pygrib.fromstring(m) for m in split_messages(source)]
+    grbs = pygrib.open(source)
+    try:
+        return list(grbs)
+    finally:
+        grbs.close()
+
+
+def grid_coords(msg) -> tuple:
+    """get the 1-D lat and lon of a regular grid message, in the scan order of the message
+
+    Parameters:
+        msg: pygrib message
+    return:
+        tuple, (lat, lon) np.ndarray
+    """
+    if msg.gridType not in REGULAR_GRIDS:
+        raise Exception(f"native decode does not support {msg.gridType} grid")
+    lats, lons = msg.latlons()
+    return lats[:, 0], lons[0, :]
+
+
+def decode_messages(messages: list, varname: str, bbox: tuple = None):
+    """decode GRIB messages of one variable into a dataset, like the nc written by cdo
+
+    The messages are stacked along time, and along number if they are
+    several members of an ensemble. With bbox every field is cropped as it
+    is decoded, only the region is held.
+
+    Parameters:
+        messages: list, pygrib messages on the same grid
+        varname: str, variable name in the dataset
+        bbox: tuple, (west, south, east, north), None for the whole grid
+    return:
+        xr.Dataset, varname(time, lat, lon) or varname(number, time, lat, lon)
+    """
+    import xarray as xr
+
+    if len(messages) == 0:
+        raise Exception(f"{varname}: no GRIB message")
+    lat, lon = grid_coords(messages[0])
+    shape = (len(lat), len(lon))
+    if bbox is not None:
+        lat_idx, lon_idx, lon = bbox_index(lat, lon, bbox)
+        lat = lat[lat_idx]
+    fields = {}
+    for msg in messages:
+        number = msg["perturbationNumber"] if msg.has_key("perturbationNumber") else None
+        values = np.ma.filled(msg.values.astype("float32"), np.nan)
+        if values.shape != shape:
+            raise Exception(f"{varname}: messages are not on the same grid")
+        if bbox is not None:
+            values = values[np.ix_(lat_idx, lon_idx)]
+        fields.setdefault(number, {})[np.datetime64(msg.validDate, "ns")] = values
+
+    times = sorted({t for f in fields.values() for t in f})
+    numbers = sorted(fields, key=lambda n: -1 if n is None else n)
+    data = np.full((len(numbers), len(times), len(lat), len(lon)), np.nan, "float32")
+    for i, n in enumerate(numbers):
+        for j, t in enumerate(times):
+            if t in fields[n]:
+                data[i, j] = fields[n][t]
+
+    attrs = {"units": messages[0].units, "long_name": messages[0].name}
+    coords = {"time": times, "lat": ("lat", lat), "lon": ("lon", lon)}
+    if len(numbers) == 1:
+        var = xr.Variable(("time", "lat", "lon"), data[0], attrs)
+    else:
+        var = xr.Variable(("number", "time", "lat", "lon"), data, attrs)
+        coords["number"] = [-1 if n is None else n for n in numbers]
+    ds = xr.Dataset({varname: var}, coords=coords)
+    ds["lat"].attrs = {"units": "degrees_north", "standard_name": "latitude"}
+    ds["lon"].attrs = {"units": "degrees_east", "standard_name": "longitude"}
+    return ds
+
+
+def decode_grib(source, varname: str, bbox: tuple = None):
+    """decode GRIB of a file or of in-memory bytes into a dataset, no nc intermediate is written
+
+    Parameters:
+        source: str | bytes | list, grib filepath, bytes of messages, or a list of them
+        varname: str, variable name in the dataset
+        bbox: tuple, (west, south, east, north), None for the whole grid
+    return:
+        xr.Dataset
+    """
+    return decode_messages(open_messages(source), varname, bbox)
@@ -1,18 +1,104 @@
 from retrying import retry
 import requests
-import pygrib
+from requests.adapters import HTTPAdapter
 from loguru import logger
 
+from maesters.config import get_concurrency
+from maesters.utils.concurrency import get_controller
+from maesters.utils.grib import GribStreamChecker, check_grib
+
 from typing import Callable
 import http.cookiejar
-import http.client
 import urllib
+import urllib.error
+import urllib.request
+import json
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+import threading
 import re
 import time
 import shutil
 import bz2
+import io
+import hashlib
+
+RANGE_GAP_BYTES = 512 * 1024
+WHOLE_FILE_RATIO = 0.8
+CHUNK_SIZE = 1024 * 1024
+POOL_MAXSIZE = 32
+DOWNLOAD_BACKEND = os.environ.get("MAESTERS_DOWNLOAD_BACKEND", "thread")
+
+_SESSIONS = {}
+_SESSIONS_PID = None
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(download_url: str) -> requests.Session:
+    """get the keep-alive session of the url host, shared by all threads of the process
+
+    Parameters:
+        download_url: str, download url
+    return:
+        requests.Session
+    """
+    global _SESSIONS_PID
+    parts = urlsplit(download_url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    with _SESSIONS_LOCK:
+        if _SESSIONS_PID != os.getpid():
+            # connections must not be shared with the parent after fork
+            _SESSIONS.clear()
+            _SESSIONS_PID = os.getpid()
+        session = _SESSIONS.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+            session.mount(host, adapter)
+            _SESSIONS[host] = session
+    return session
+
+
+def check_content_range(
+    resp: requests.Response, start_bytes: int, end_bytes: int = None
+):
+    """check the response is the partial content of the requested range
+
+    Parameters:
+        resp: requests.Response
+        start_bytes: int, the requested bytes start
+        end_bytes: int, the requested bytes end (exclusive), None for open-ended range
+    """
+    if resp.status_code != 206:
+        raise Exception(
+            f"{resp.url} range {start_bytes}-{end_bytes} got status {resp.status_code}"
+        )
+    check_range_headers(resp.headers, resp.url, start_bytes, end_bytes)
+
+
+def check_range_headers(headers, url: str, start_bytes: int, end_bytes: int = None):
+    """check the Content-Range header starts at the requested bytes, covers the range and ends within the total
+
+    Parameters:
+        headers: dict, response headers
+        url: str, requested url
+        start_bytes: int, the requested bytes start
+        end_bytes: int, the requested bytes end (exclusive), None for open-ended range up to the total
+    """
+    m = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", headers.get("Content-Range", ""))
+    total = None if m is None or m.group(3) == "*" else int(m.group(3))
+    if (
+        m is None
+        or int(m.group(1)) != start_bytes
+        or (end_bytes is not None and int(m.group(2)) + 1 < end_bytes)
+        or (total is not None and int(m.group(2)) >= total)
+        or (end_bytes is None and total is not None and int(m.group(2)) + 1 != total)
+    ):
+        raise Exception(
+            f"{url} range {start_bytes}-{end_bytes} got "
+            f"Content-Range {headers.get('Content-Range')}"
+        )
 
 
 @retry(wait_fixed=5e3, stop_max_attempt_number=3)
@@ -29,21 +115,69 @@ def decompress_check_grib(bz_fp: str, de_fp: str):
         for data in iter(lambda: file.read(100 * 1024), b""):
             new_file.write(data)
             new_file.flush()
-    pygrib.index(de_fp, "shortName")
+    check_grib(de_fp)
     os.remove(bz_fp)
     return 0
 
 
-def before_download(local_fp: str):
+def read_validator(tmp: str) -> str:
+    """read the ETag/Last-Modified validator saved along with a partial download
+
+    Parameters:
+        tmp: str, partial download filepath
+    return:
+        str, validator for If-Range, None if the partial file is not resumable
+    """
+    meta = tmp + ".meta"
+    if not (os.path.exists(tmp) and os.path.exists(meta)):
+        return None
+    try:
+        with open(meta, "r") as f:
+            return json.load(f).get("validator")
+    except Exception:
+        return None
+
+
+def save_validator(tmp: str, headers: dict):
+    """save the strong ETag or Last-Modified of response, which a later resume is checked against
+
+    Parameters:
+        tmp: str, partial download filepath
+        headers: dict, response headers
+    """
+    etag = headers.get("ETag")
+    validator = (
+        etag if etag and not etag.startswith("W/") else headers.get("Last-Modified")
+    )
+    if validator:
+        with open(tmp + ".meta", "w") as f:
+            json.dump({"validator": validator}, f)
+    elif os.path.exists(tmp + ".meta"):
+        os.remove(tmp + ".meta")
+
+
+def remove_partial(tmp: str):
+    """remove partial download file and its validator
+
+    Parameters:
+        tmp: str, partial download filepath
+    """
+    for fp in (tmp, tmp + ".meta"):
+        if os.path.exists(fp):
+            os.remove(fp)
+
+
+def before_download(local_fp: str, resume: bool = False):
     """precosse before download.
-            1. if previous then remove previous file
+            1. if previous then remove previous file, unless it is resumable
             2. makedirs
 
     Parameters:
         local_fp: str
+        resume: bool, keep previous partial file if it has a validator
     """
-    if os.path.exists(local_fp):
-        os.remove(local_fp)
+    if not resume or read_validator(local_fp) is None:
+        remove_partial(local_fp)
     if not os.path.exists(os.path.dirname(local_fp)):
         os.makedirs(os.path.dirname(local_fp), 0o777)
 
@@ -61,12 +195,12 @@ def after_download(local_fp: str, file_type: str, rename_fp: str = None):
 
     if "grib" in file_type.lower():
         try:
-            pygrib.index(local_fp)
+            check_grib(local_fp)
             if rename_fp:
                 # os.rename(local_fp,rename_fp)
                 shutil.move(local_fp, rename_fp)
         except Exception as e:
-            os.remove(local_fp)
+            remove_partial(local_fp)
             raise Exception from e
     elif "nc" in file_type.lower():
         import xarray as xr
@@ -79,14 +213,14 @@ def after_download(local_fp: str, file_type: str, rename_fp: str = None):
                 shutil.move(local_fp, rename_fp)
 
         except Exception as e:
-            os.remove(local_fp)
+            remove_partial(local_fp)
             raise Exception from e
 
     elif "bz2" in file_type.lower():
         try:
             decompress_check_grib(local_fp, rename_fp)
         except Exception as e:
-            os.remove(local_fp)
+            remove_partial(local_fp)
             raise Exception from e
     else:
         try:
@@ -95,43 +229,207 @@ def after_download(local_fp: str, file_type: str, rename_fp: str = None):
                 shutil.move(local_fp, rename_fp)
 
         except Exception as e:
-            os.remove(local_fp)
+            remove_partial(local_fp)
             raise Exception from e
 
+    if os.path.exists(local_fp + ".meta"):
+        os.remove(local_fp + ".meta")
+
+
+def file_checksum(local_fp: str) -> str:
+    """sha256 hex digest of local file"""
+    with ChecksumWriter(local_fp, "ab", True) as f:
+        return f.hexdigest()
+
+
+class ChecksumWriter:
+    """file writer computing the sha256 of the whole file while streaming, if checksum is enabled
+
+    In append mode the content already in the file is hashed first, so a
+    resumed download gets the checksum of the complete file.
+    """
+
+    def __init__(self, local_fp: str, mode: str = "wb", checksum: bool = False) -> None:
+        self._hash = hashlib.sha256() if checksum else None
+        if self._hash is not None and "a" in mode and os.path.exists(local_fp):
+            with open(local_fp, "rb") as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    self._hash.update(block)
+        self._f = open(local_fp, mode)
+
+    def write(self, data: bytes):
+        self._f.write(data)
+        if self._hash is not None:
+            self._hash.update(data)
+
+    def close(self):
+        self._f.close()
+
+    def hexdigest(self) -> str:
+        """sha256 hex digest of the written file, None if checksum is disabled"""
+        return self._hash.hexdigest() if self._hash is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def journal_downloaded(journal, local_fp: str, checksum: str = None):
+    """record the finished download of local filepath in journal, if any
+
+    Parameters:
+        journal: DownloadJournal, None to skip
+        local_fp: str, local filepath
+        checksum: str, sha256 computed while streaming
+    """
+    if journal is not None:
+        journal.downloaded(local_fp, os.path.getsize(local_fp), checksum)
+
+
+class DecompressGribWriter:
+    """decompress a bz2 stream into a file and check its GRIB messages on the fly"""
+
+    def __init__(self, local_fp: str, checksum: bool = False) -> None:
+        self.local_fp = local_fp
+        self._f = ChecksumWriter(local_fp, "wb", checksum)
+        self._decompressor = bz2.BZ2Decompressor()
+        self._fresh = True
+        self._checker = GribStreamChecker()
+
+    def write(self, chunk: bytes):
+        while chunk:
+            data = self._decompressor.decompress(chunk)
+            self._fresh = False
+            self._checker.update(data)
+            self._f.write(data)
+            chunk = b""
+            if self._decompressor.eof:
+                # concatenated bz2 streams
+                chunk = self._decompressor.unused_data
+                self._decompressor = bz2.BZ2Decompressor()
+                self._fresh = True
+
+    def abort(self):
+        self._f.close()
+
+    def close(self):
+        """close the file, raise Exception if the stream or the GRIB messages are incomplete"""
+        self._f.close()
+        if not self._fresh:
+            raise Exception(f"{self.local_fp}: bz2 stream is truncated")
+        if self._checker.close() is None:
+            check_grib(self.local_fp)
+
+    def hexdigest(self) -> str:
+        """sha256 hex digest of the decompressed file, None if checksum is disabled"""
+        return self._f.hexdigest()
+
+
+def bz2_stream_download(download_url: str, local_fp: str, journal=None) -> int:
+    """download a bz2 compressed grib, decompress and check it while streaming into local path
+
+    Partial downloads are not resumed, as the decompressor state is lost with the process.
+    single_session_download(file_type="bz2") calls it with retry.
+
+    Parameters:
+        download_url: str, download url
+        local_fp: str, local filepath of decompressed grib
+        journal: DownloadJournal, record the download with checksum of decompressed grib
+    return:
+        int, the bytes size of file
+    """
+    tmp = local_fp + ".tmp"
+    if os.path.exists(local_fp):
+        journal_downloaded(journal, local_fp)
+        return os.path.getsize(local_fp)
+
+    before_download(tmp)
+    writer = DecompressGribWriter(tmp, checksum=journal is not None)
+    try:
+        with get_controller(download_url).transfer() as transfer:
+            resp = get_session(download_url).get(
+                download_url, stream=True, timeout=60 * 5
+            )
+            with resp:
+                resp.raise_for_status()
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    transfer["bytes"] += len(chunk)
+                    writer.write(chunk)
+        writer.close()
+    except Exception as e:
+        writer.abort()
+        remove_partial(tmp)
+        raise Exception from e
+
+    shutil.move(tmp, local_fp)
+    journal_downloaded(journal, local_fp, writer.hexdigest())
+    return os.path.getsize(local_fp)
+
 
 @retry(wait_fixed=10e3, stop_max_attempt_number=3)
 def single_session_download(
-    download_url: str, local_fp: str, file_type: str = "grib"
+    download_url: str, local_fp: str, file_type: str = "grib", journal=None
 ) -> int:
-    """download single file from download url to local path using session, and verify
+    """download single file from download url to local path using pooled session with chunked writes, and verify
 
     Parameters:
         download_url: str, download url
         local_fp: str, local filepath
-        file_type: str, grib
+        file_type: str, grib, or bz2 to decompress the stream into local filepath on the fly
+        journal: DownloadJournal, record the download with the checksum computed while streaming
     return:
         int, the bytes size of file
     """
-    session = None
     tmp = local_fp + ".tmp"
     if os.path.exists(local_fp):
+        journal_downloaded(journal, local_fp)
         return os.path.getsize(local_fp)
+    if "bz2" in file_type.lower():
+        return bz2_stream_download(download_url, local_fp, journal)
 
-    before_download(tmp)
+    before_download(tmp, resume=True)
+    offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+    headers = (
+        {"Range": f"bytes={offset}-", "If-Range": read_validator(tmp)}
+        if offset
+        else {}
+    )
 
     try:
-        session = requests.Session()
-        resp = session.get(download_url, stream=True, timeout=60 * 5)
-        with open(tmp, "wb") as f:
-            f.write(resp.content)
-            f.flush()
-        session.close()
+        with get_controller(download_url).transfer() as transfer:
+            resp = get_session(download_url).get(
+                download_url, headers=headers, stream=True, timeout=60 * 5
+            )
+            with resp:
+                if resp.status_code == 416 and offset:
+                    # the partial file already holds the whole content
+                    total = resp.headers.get("Content-Range", "").split("/")[-1]
+                    if total != str(offset):
+                        remove_partial(tmp)
+                        raise Exception(f"{download_url} can not resume from {offset}")
+                    checksum = file_checksum(tmp) if journal is not None else None
+                else:
+                    resp.raise_for_status()
+                    if resp.status_code == 206:
+                        check_content_range(resp, offset)
+                    save_validator(tmp, resp.headers)
+                    with ChecksumWriter(
+                        tmp,
+                        "ab" if resp.status_code == 206 else "wb",
+                        journal is not None,
+                    ) as f:
+                        for chunk in resp.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                    checksum = f.hexdigest()
+            transfer["bytes"] = os.path.getsize(tmp) - offset
     except Exception as e:
-        os.remove(tmp)
-        session.close()
+        # keep the partial file to resume on retry
         raise Exception from e
 
     after_download(tmp, file_type, local_fp)
+    journal_downloaded(journal, local_fp, checksum)
     return os.path.getsize(local_fp)
 
 
@@ -142,31 +440,63 @@ def single_range_download(
     end_bytes: str,
     local_fp: str,
     file_type: str = "grib",
+    journal=None,
 ) -> int:
-    """download bytes range of single file from download url to local path using curl command
+    """download bytes range of single file from download url to local path using pooled session
 
     Parameters:
         download_url: str, download url
         start_bytes: str, the download_range bytes start
-        end_bytes: str, the download_range bytes end
+        end_bytes: str, the download_range bytes end (exclusive)
         local_fp: str, local filepath
         file_type: str, grib
+        journal: DownloadJournal, record the download with the checksum computed while streaming
     return:
         int, the bytes size of file
     """
     tmp = local_fp + ".tmp"
     if os.path.exists(local_fp):
+        journal_downloaded(journal, local_fp)
         return os.path.getsize(local_fp)
 
-    before_download(tmp)
+    start_bytes, end_bytes = int(start_bytes), int(end_bytes)
+    before_download(tmp, resume=True)
+    offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+    if offset > end_bytes - start_bytes:
+        remove_partial(tmp)
+        offset = 0
+    headers = {"Range": f"bytes={start_bytes + offset}-{end_bytes - 1}"}
+    if offset:
+        headers["If-Range"] = read_validator(tmp)
+
+    f = ChecksumWriter(tmp, "ab", journal is not None)
     try:
-        cmd = f"curl -s --range {start_bytes}-{end_bytes} {download_url} > {tmp}"
-        os.system(cmd)
+        if start_bytes + offset < end_bytes:
+            with get_controller(download_url).transfer() as transfer:
+                resp = get_session(download_url).get(
+                    download_url, headers=headers, stream=True, timeout=60 * 5
+                )
+                with resp:
+                    resp.raise_for_status()
+                    if resp.status_code == 200 and offset:
+                        # validator changed, the remote file is not the one partially downloaded
+                        remove_partial(tmp)
+                        raise Exception(f"{download_url} changed since partial download")
+                    check_content_range(resp, start_bytes + offset, end_bytes)
+                    save_validator(tmp, resp.headers)
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                transfer["bytes"] = os.path.getsize(tmp) - offset
+        f.close()
+        if os.path.getsize(tmp) != end_bytes - start_bytes:
+            raise Exception(f"{download_url} range {start_bytes}-{end_bytes} incomplete")
     except Exception as e:
-        os.remove(tmp)
+        # keep the partial file to resume on retry
+        f.close()
         raise Exception from e
 
     after_download(tmp, file_type, local_fp)
+    journal_downloaded(journal, local_fp, f.hexdigest())
     return os.path.getsize(local_fp)
 
 
@@ -174,7 +504,9 @@ def batch_session_download(
     url_fp_list: list,
     file_type: str = "grib",
     download_func: Callable = single_session_download,
-    thread_num: int = 5,
+    thread_num: int = None,
+    backend: str = DOWNLOAD_BACKEND,
+    journal=None,
 ):
     """download multiply files from download urls to local path using session, and handle logger
 
@@ -182,47 +514,74 @@ def batch_session_download(
         url_fp_list: list, [(url, local filepath),...]
         file_type: str
         download_func: Callable
-        thread_num: int, default is 5
+        thread_num: int, default is the concurrency ceiling
+        backend: str, 'thread' or 'asyncio' (thread_num is ignored with asyncio),
+            a download_func other than single_session_download (e.g. with auth) runs on threads
+        journal: DownloadJournal, record the finished downloads
     return:
         fail: list
     """
-    futures = []
+    if backend == "asyncio" and download_func is not single_session_download:
+        logger.warning(
+            f"asyncio backend does not support {getattr(download_func, '__name__', download_func)}, download on threads"
+        )
+        backend = "thread"
+    if backend == "asyncio":
+        from maesters.utils.async_download import async_batch_session_download
+
+        return async_batch_session_download(url_fp_list, file_type, journal=journal)
+
+    futures = {}
     fail = []
-    with ThreadPoolExecutor(thread_num) as pool:
+    with ThreadPoolExecutor(thread_num or get_concurrency()["ceiling"]) as pool:
         for i in url_fp_list:
-            futures.append(
+            futures[
                 pool.submit(
-                    download_func, download_url=i[0], local_fp=i[1], file_type=file_type
+                    download_func,
+                    download_url=i[0],
+                    local_fp=i[1],
+                    file_type=file_type,
+                    journal=journal,
                 )
-            )
-        for n, f in enumerate(as_completed(futures)):
-            # f.result()
+            ] = i
+        for f in as_completed(futures):
             try:
                 f.result()
             except Exception as e:
-                logger.error(url_fp_list[n][0])
+                logger.error(futures[f][0])
                 logger.error(e)
-                fail.append(url_fp_list[n])
+                fail.append(futures[f])
     return fail
 
 
 def batch_range_download(
-    inputs_list: list, file_type: str = "grib", thread_num: int = 5
+    inputs_list: list,
+    file_type: str = "grib",
+    thread_num: int = None,
+    backend: str = DOWNLOAD_BACKEND,
+    journal=None,
 ):
-    """range-download multi files from download urls to local path using curl, and handle logger
+    """range-download multi files from download urls to local path using pooled sessions, and handle logger
 
     Parameters:
-        inputs_list: list, [(url, start_bytes, end_bytes, local filepath),...]
+        inputs_list: list, [(url, start_bytes, end_bytes, local filepath),...], end_bytes is exclusive
         file_type: str
-        thread_num: int, default is 5
+        thread_num: int, default is the concurrency ceiling
+        backend: str, 'thread' or 'asyncio' (thread_num is ignored with asyncio)
+        journal: DownloadJournal, record the finished downloads
     return:
         fail: list
     """
-    futures = []
+    if backend == "asyncio":
+        from maesters.utils.async_download import async_batch_range_download
+
+        return async_batch_range_download(inputs_list, file_type, journal=journal)
+
+    futures = {}
     fail = []
-    with ThreadPoolExecutor(thread_num) as pool:
+    with ThreadPoolExecutor(thread_num or get_concurrency()["ceiling"]) as pool:
         for i in inputs_list:
-            futures.append(
+            futures[
                 pool.submit(
                     single_range_download,
                     download_url=i[0],
@@ -230,16 +589,307 @@ def batch_range_download(
                     end_bytes=i[2],
                     local_fp=i[3],
                     file_type=file_type,
+                    journal=journal,
                 )
-            )
-        for n, f in enumerate(as_completed(futures)):
-            # f.result()
+            ] = i
+        for f in as_completed(futures):
             try:
                 f.result()
             except Exception as e:
-                logger.error(inputs_list[n][0])
+                logger.error(futures[f][0])
                 logger.error(e)
-                fail.append(inputs_list[n])
+                fail.append(futures[f])
+    return fail
+
+
+def get_content_length(download_url: str) -> int:
+    """get the remote file size of download url by HEAD request
+
+    Parameters:
+        download_url: str, download url
+    return:
+        int, the bytes size of remote file, None if unknown
+    """
+    try:
+        resp = get_session(download_url).head(
+            download_url, allow_redirects=True, timeout=60
+        )
+        if resp.status_code == 200 and resp.headers.get("Content-Length"):
+            return int(resp.headers["Content-Length"])
+    except Exception as e:
+        logger.warning(e)
+    return None
+
+
+def plan_range_spans(
+    ranges: list,
+    gap_bytes: int = RANGE_GAP_BYTES,
+    file_size: int = None,
+    whole_file_ratio: float = WHOLE_FILE_RATIO,
+) -> list:
+    """sort byte ranges of one url and merge the adjacent or nearly adjacent ones into spans
+
+    Parameters:
+        ranges: list, [(start_bytes, end_bytes, local filepath),...], end_bytes is exclusive
+        gap_bytes: int, ranges whose gap is no larger than gap_bytes are merged into one span
+        file_size: int, the bytes size of remote file, None if unknown
+        whole_file_ratio: float, plan one whole-file span if the wanted bytes exceed this ratio of file_size
+    return:
+        list, [(span_start, span_end, [(start_bytes, end_bytes, local filepath),...]),...]
+    """
+    items = sorted((int(r[0]), int(r[1]), r[2]) for r in ranges)
+    if len(items) == 0:
+        return []
+
+    if file_size and whole_file_ratio is not None:
+        wanted = sum(i[1] - i[0] for i in items)
+        if wanted >= whole_file_ratio * file_size:
+            return [(0, file_size, items)]
+
+    spans = []
+    for item in items:
+        if spans and item[0] - spans[-1][1] <= gap_bytes:
+            spans[-1][1] = max(spans[-1][1], item[1])
+            spans[-1][2].append(item)
+        else:
+            spans.append([item[0], item[1], [item]])
+    return [tuple(s) for s in spans]
+
+
+def _stream_span(
+    download_url: str, span_start: int, span_end: int, members: list, handles: list
+):
+    """GET one span of url and write the bytes of every member range to its handle
+
+    Parameters:
+        download_url: str, download url
+        span_start: int, the span bytes start
+        span_end: int, the span bytes end (exclusive)
+        members: list, [(start_bytes, end_bytes, ...),...] sorted by start_bytes
+        handles: list, writer of every member
+    """
+    with get_controller(download_url).transfer() as transfer:
+        resp = get_session(download_url).get(
+            download_url,
+            headers={"Range": f"bytes={span_start}-{span_end - 1}"},
+            stream=True,
+            timeout=60 * 5,
+        )
+        with resp:
+            resp.raise_for_status()
+            if not (resp.status_code == 200 and span_start == 0):
+                check_content_range(resp, span_start, span_end)
+            pos = span_start
+            first = 0
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                chunk_end = pos + len(chunk)
+                for n in range(first, len(members)):
+                    start, end = members[n][0], members[n][1]
+                    if start >= chunk_end:
+                        break
+                    if end > pos:
+                        handles[n].write(
+                            chunk[max(start, pos) - pos : min(end, chunk_end) - pos]
+                        )
+                while first < len(members) and members[first][1] <= chunk_end:
+                    first += 1
+                pos = chunk_end
+                if pos >= span_end:
+                    break
+        transfer["bytes"] = pos - span_start
+    if pos < span_end:
+        raise Exception(f"{download_url} span {span_start}-{span_end} incomplete")
+
+
+@retry(wait_fixed=10e3, stop_max_attempt_number=3)
+def fetch_span(
+    download_url: str,
+    span_start: int,
+    span_end: int,
+    members: list,
+    checksum: bool = False,
+) -> list:
+    """download one span of url once and split the member ranges into their .tmp files
+
+    Parameters:
+        download_url: str, download url
+        span_start: int, the span bytes start
+        span_end: int, the span bytes end (exclusive)
+        members: list, [(start_bytes, end_bytes, local filepath),...] sorted by start_bytes
+        checksum: bool, compute sha256 of member files while streaming
+    return:
+        list, sha256 hex digest of every member file, None if checksum is disabled
+    """
+    tmps = [m[2] + ".tmp" for m in members]
+    for tmp in tmps:
+        before_download(tmp)
+    handles = [ChecksumWriter(tmp, "wb", checksum) for tmp in tmps]
+    try:
+        _stream_span(download_url, span_start, span_end, members, handles)
+    except Exception as e:
+        for h, tmp in zip(handles, tmps):
+            h.close()
+            os.remove(tmp)
+        raise Exception from e
+    for h in handles:
+        h.close()
+    return [h.hexdigest() for h in handles]
+
+
+@retry(wait_fixed=10e3, stop_max_attempt_number=3)
+def fetch_span_buffers(
+    download_url: str, span_start: int, span_end: int, members: list
+) -> list:
+    """download one span of url once and split the member ranges into memory
+
+    Parameters:
+        download_url: str, download url
+        span_start: int, the span bytes start
+        span_end: int, the span bytes end (exclusive)
+        members: list, [(start_bytes, end_bytes, ...),...] sorted by start_bytes
+    return:
+        list, bytes of every member
+    """
+    handles = [io.BytesIO() for _ in members]
+    _stream_span(download_url, span_start, span_end, members, handles)
+    return [h.getvalue() for h in handles]
+
+
+@retry(wait_fixed=10e3, stop_max_attempt_number=3)
+def fetch_buffer(download_url: str) -> bytes:
+    """download a whole file into memory
+
+    Parameters:
+        download_url: str, download url
+    return:
+        bytes
+    """
+    with get_controller(download_url).transfer() as transfer:
+        resp = get_session(download_url).get(download_url, timeout=60 * 5)
+        resp.raise_for_status()
+        transfer["bytes"] = len(resp.content)
+    return resp.content
+
+
+def range_buffers(
+    inputs_list: list,
+    thread_num: int = None,
+    gap_bytes: int = RANGE_GAP_BYTES,
+    whole_file_ratio: float = WHOLE_FILE_RATIO,
+) -> list:
+    """range-download messages into memory with coalesced spans, no local file is written
+
+    Parameters:
+        inputs_list: list, [(url, start_bytes, end_bytes),...], end_bytes is exclusive
+        thread_num: int, default is the concurrency ceiling
+        gap_bytes: int, ranges whose gap is no larger than gap_bytes are merged into one span
+        whole_file_ratio: float, fetch whole file once if the wanted bytes exceed this ratio, None to disable
+    return:
+        list, bytes of every item of inputs_list, raise Exception if some fail
+    """
+    url_ranges = {}
+    for n, i in enumerate(inputs_list):
+        url_ranges.setdefault(i[0], []).append((i[1], i[2], n))
+
+    res = [None] * len(inputs_list)
+    futures = {}
+    with ThreadPoolExecutor(thread_num or get_concurrency()["ceiling"]) as pool:
+        for url, ranges in url_ranges.items():
+            file_size = (
+                get_content_length(url) if whole_file_ratio is not None else None
+            )
+            for span in plan_range_spans(ranges, gap_bytes, file_size, whole_file_ratio):
+                futures[pool.submit(fetch_span_buffers, url, *span)] = span[2]
+        for f in as_completed(futures):
+            for m, buf in zip(futures[f], f.result()):
+                res[m[2]] = buf
+    return res
+
+
+def span_download(
+    download_url: str,
+    span_start: int,
+    span_end: int,
+    members: list,
+    file_type: str = "grib",
+    journal=None,
+) -> list:
+    """download one span and verify every split member file
+
+    Parameters:
+        download_url: str, download url
+        span_start: int, the span bytes start
+        span_end: int, the span bytes end (exclusive)
+        members: list, [(start_bytes, end_bytes, local filepath),...] sorted by start_bytes
+        file_type: str
+        journal: DownloadJournal, record the finished downloads
+    return:
+        fail: list, local filepaths of failed members
+    """
+    try:
+        checksums = fetch_span(
+            download_url, span_start, span_end, members, journal is not None
+        )
+    except Exception as e:
+        logger.error(download_url)
+        logger.error(e)
+        return [m[2] for m in members]
+
+    fail = []
+    for m, checksum in zip(members, checksums):
+        try:
+            after_download(m[2] + ".tmp", file_type, m[2])
+            journal_downloaded(journal, m[2], checksum)
+        except Exception as e:
+            logger.error(m[2])
+            logger.error(e)
+            fail.append(m[2])
+    return fail
+
+
+def coalesced_range_download(
+    inputs_list: list,
+    file_type: str = "grib",
+    thread_num: int = None,
+    gap_bytes: int = RANGE_GAP_BYTES,
+    whole_file_ratio: float = WHOLE_FILE_RATIO,
+    journal=None,
+) -> list:
+    """range-download multi messages with coalesced spans, each span is fetched once and split locally
+
+    Parameters:
+        inputs_list: list, [(url, start_bytes, end_bytes, local filepath),...], end_bytes is exclusive
+        file_type: str
+        thread_num: int, default is the concurrency ceiling
+        gap_bytes: int, ranges whose gap is no larger than gap_bytes are merged into one span
+        whole_file_ratio: float, fetch whole file once if the wanted bytes exceed this ratio, None to disable
+        journal: DownloadJournal, record the finished downloads
+    return:
+        fail: list, items of inputs_list
+    """
+    inputs = {}
+    for i in inputs_list:
+        if os.path.exists(i[3]):
+            journal_downloaded(journal, i[3])
+        else:
+            inputs[i[3]] = i
+    url_ranges = {}
+    for i in inputs.values():
+        url_ranges.setdefault(i[0], []).append((i[1], i[2], i[3]))
+
+    futures = []
+    fail = []
+    with ThreadPoolExecutor(thread_num or get_concurrency()["ceiling"]) as pool:
+        for url, ranges in url_ranges.items():
+            file_size = (
+                get_content_length(url) if whole_file_ratio is not None else None
+            )
+            spans = plan_range_spans(ranges, gap_bytes, file_size, whole_file_ratio)
+            logger.debug(f"{url}: {len(ranges)} ranges in {len(spans)} spans")
+            for span in spans:
+                futures.append(pool.submit(span_download, url, *span, file_type, journal))
+        for f in as_completed(futures):
+            fail.extend(inputs[fp] for fp in f.result())
     return fail
 
 
@@ -303,7 +953,7 @@ class auth_download:
 
     @retry(wait_fixed=10e3, stop_max_attempt_number=3)
     def single_session_auth_download(
-        self, download_url: str, local_fp: str, file_type: str = "grib"
+        self, download_url: str, local_fp: str, file_type: str = "grib", journal=None
     ) -> int:
         """download single file from download url to local path using session with auth, and verify
 
@@ -311,6 +961,7 @@ class auth_download:
             download_url: str, download url
             local_fp: str, local filepath
             verify: verify function
+            journal: DownloadJournal, record the download with the checksum computed while streaming
         return:
             int, the bytes size of file
         """
@@ -322,26 +973,51 @@ class auth_download:
         tmp = tmp + ".tmp"
 
         if os.path.exists(local_fp):
+            journal_downloaded(journal, local_fp)
             return os.path.getsize(local_fp)
-        before_download(tmp)
+        before_download(tmp, resume=True)
+        offset = os.path.getsize(tmp) if os.path.exists(tmp) else 0
+        request = urllib.request.Request(download_url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+            request.add_header("If-Range", read_validator(tmp))
 
         try:
-            with open(tmp, "wb") as outfile:
-                infile = self.opener.open(download_url)
-                # content = infile.read()
-                # infile = urllib.request.urlopen(download_url)
-                try:
-                    content = infile.read()
-                except http.client.IncompleteRead as e:
-                    content = e.partial
-                outfile.write(content)
-                outfile.flush()
+            try:
+                infile = self.opener.open(request)
+            except urllib.error.HTTPError as e:
+                # the partial file already holds the whole content
+                total = e.headers.get("Content-Range", "").split("/")[-1]
+                if not (e.code == 416 and offset and total == str(offset)):
+                    if e.code == 416:
+                        remove_partial(tmp)
+                    raise
+                infile = None
+                checksum = file_checksum(tmp) if journal is not None else None
+            if infile is not None:
+                with infile:
+                    status = infile.getcode()
+                    if status == 206 and not infile.headers.get(
+                        "Content-Range", ""
+                    ).startswith(f"bytes {offset}-"):
+                        remove_partial(tmp)
+                        raise Exception(
+                            f"{download_url} can not resume from {offset}: "
+                            f"{infile.headers.get('Content-Range')}"
+                        )
+                    save_validator(tmp, infile.headers)
+                    with ChecksumWriter(
+                        tmp, "ab" if status == 206 else "wb", journal is not None
+                    ) as outfile:
+                        # an IncompleteRead keeps the written chunks to resume from
+                        shutil.copyfileobj(infile, outfile, CHUNK_SIZE)
+                    checksum = outfile.hexdigest()
         except Exception as e:
             logger.error(e)
-            os.remove(tmp)
             raise Exception from e
 
         after_download(tmp, file_type, local_fp)
+        journal_downloaded(journal, local_fp, checksum)
         return os.path.getsize(local_fp)
 
     def batch_download(self, url_fp_list: list, file_type: str = "grib") -> list:
@@ -0,0 +1,265 @@
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+COMPRESSIONS = [None, "zlib", "zstd"]
+DTYPES = ["float32", "float64"]
+PACKS = [None, "int16", "bitround"]
+# fill value of int16 packing, the data is packed into the rest of the range
+INT16_FILL = -32767
+INT16_MAX = 32766
+MANTISSA_BITS = {"float32": 23, "float64": 52}
+
+
+@dataclass
+class Encoding:
+    """encoding of the nc outputs, applied by the writer of the file
+
+    Attributes:
+        compression: None, 'zlib' or 'zstd'
+        level: compression level, 1-9 for zlib and 1-19 for zstd
+        shuffle: shuffle the bytes before compression
+        chunks: chunk length by dimension like {'time': 1, 'lat': 256, 'lon': 256},
+            the dimensions not listed are one chunk. None for one chunk per field.
+            cdo writes whole fields or rows, lat/lon tiles smaller than the field
+            are written again after cdo
+        dtype: 'float32' or 'float64'
+        pack: None, 'int16' for scale/offset packing, or 'bitround' to keep
+            significant_bits of the mantissa (lossy, compresses much better)
+        significant_bits: mantissa bits kept by 'bitround'
+        valid_range: (min, max) packed by 'int16', None for the range of each file
+    """
+
+    compression: str = None
+    level: int = 4
+    shuffle: bool = True
+    chunks: dict = None
+    dtype: str = "float32"
+    pack: str = None
+    significant_bits: int = 12
+    valid_range: tuple = None
+
+    def __post_init__(self):
+        if self.compression not in COMPRESSIONS:
+            raise Exception(f"compression {self.compression} not in {COMPRESSIONS}")
+        if self.dtype not in DTYPES:
+            raise Exception(f"dtype {self.dtype} not in {DTYPES}")
+        if self.pack not in PACKS:
+            raise Exception(f"pack {self.pack} not in {PACKS}")
+        if self.pack == "bitround" and not (
+            0 < self.significant_bits <= MANTISSA_BITS[self.dtype]
+        ):
+            raise Exception(
+                f"significant_bits {self.significant_bits} out of 1-{MANTISSA_BITS[self.dtype]}"
+            )
+
+    @property
+    def rewrite(self) -> bool:
+        """cdo can not apply the encoding (packing, or chunks of other dimensions than 1), its output is written again"""
+        return self.pack is not None or (
+            self.chunks is not None and cdo_chunktype(self.chunks) is None
+        )
+
+
+def cdo_chunktype(chunks: dict = None) -> str:
+    """get the cdo -k chunk type closest to chunks, None if cdo can not write them
+
+    cdo chunks one field ('grid') or one row ('lines'), the other dimensions by 1.
+    lat/lon lengths covering the field are 'grid', the tiles are checked against
+    the written file by rewrite_nc.
+    """
+    chunks = dict(chunks or {})
+    lat = chunks.pop("lat", None)
+    chunks.pop("lon", None)
+    if any(n != 1 for n in chunks.values()):
+        return None
+    return "lines" if lat == 1 else "grid"
+
+
+def _chunks_differ(ds, encoding: Encoding) -> bool:
+    """whether the fields of ds are not chunked as encoding asks"""
+    for var in ds.data_vars.values():
+        if not np.issubdtype(var.dtype, np.floating):
+            continue
+        written = var.encoding.get("chunksizes")
+        if written is None or list(written) != chunk_sizes(encoding, var.dims, var.shape):
+            return True
+    return False
+
+
+def bitround(values: np.ndarray, bits: int) -> np.ndarray:
+    """round the float mantissa to bits, to nearest with ties to even, nan stays nan
+
+    Parameters:
+        values: np.ndarray, float32 or float64
+        bits: int, mantissa bits kept
+    return:
+        np.ndarray
+    """
+    values = np.asarray(values)
+    uint = np.uint32 if values.dtype == np.float32 else np.uint64
+    drop = MANTISSA_BITS[str(values.dtype)] - bits
+    if drop <= 0:
+        return values
+    b = values.view(uint)
+    half = uint((1 << (drop - 1)) - 1)
+    mask = ~uint((1 << drop) - 1)
+    b = (b + half + ((b >> uint(drop)) & uint(1))) & mask
+    return np.where(np.isnan(values), values, b.view(values.dtype))
+
+
+def pack_params(values: np.ndarray, valid_range: tuple = None) -> tuple:
+    """get the scale_factor and add_offset packing valid_range (or the range of values) into int16
+
+    return:
+        tuple, (scale_factor, add_offset)
+    """
+    if valid_range is None:
+        finite = np.asarray(values)[np.isfinite(values)]
+        valid_range = (finite.min(), finite.max()) if finite.size else (0.0, 0.0)
+    lo, hi = float(valid_range[0]), float(valid_range[1])
+    scale = (hi - lo) / (2 * INT16_MAX) if hi > lo else 1.0
+    return scale, (hi + lo) / 2
+
+
+def encode_values(values: np.ndarray, encoding: Encoding, params: tuple = None) -> np.ndarray:
+    """get the values as stored in the file: cast, bitround or int16 packed
+
+    Parameters:
+        values: np.ndarray, unpacked values, nan for missing
+        encoding: Encoding
+        params: tuple, (scale_factor, add_offset) of int16 packing
+    return:
+        np.ndarray
+    """
+    values = np.asarray(values).astype(encoding.dtype)
+    if encoding.pack == "bitround":
+        return bitround(values, encoding.significant_bits)
+    if encoding.pack == "int16":
+        scale, offset = params
+        packed = np.clip(np.round((values - offset) / scale), -INT16_MAX, INT16_MAX)
+        return np.where(np.isnan(values), INT16_FILL, packed).astype("int16")
+    return values
+
+
+def chunk_sizes(encoding: Encoding, dims: tuple, shape: tuple) -> list:
+    """get the chunk shape of a variable, chunks None is one chunk per field, of the last 2 dims"""
+    if encoding.chunks is None:
+        return [n if len(shape) - i <= 2 else 1 for i, n in enumerate(shape)]
+    return [max(1, min(encoding.chunks.get(d, n), n)) for d, n in zip(dims, shape)]
+
+
+def variable_kwargs(encoding: Encoding, dims: tuple, shape: tuple) -> dict:
+    """get the netCDF4 createVariable kwargs of a field variable
+
+    Parameters:
+        encoding: Encoding
+        dims: tuple, dimension names of the variable
+        shape: tuple, its shape
+    return:
+        dict, datatype, fill_value, compression and chunksizes
+    """
+    kwargs = {
+        "datatype": "i2" if encoding.pack == "int16" else encoding.dtype,
+        "fill_value": INT16_FILL if encoding.pack == "int16" else np.nan,
+        "chunksizes": chunk_sizes(encoding, dims, shape),
+    }
+    if encoding.compression is not None:
+        kwargs.update(
+            compression=encoding.compression,
+            complevel=encoding.level,
+            shuffle=encoding.shuffle,
+        )
+    return kwargs
+
+
+def encode_dataset(ds, encoding: Encoding) -> tuple:
+    """apply encoding to the data variables of ds
+
+    Parameters:
+        ds: xr.Dataset, decoded
+        encoding: Encoding
+    return:
+        tuple, (xr.Dataset, to_netcdf encoding)
+    """
+    ds = ds.copy()
+    nc_encoding = {}
+    for name, var in ds.data_vars.items():
+        if not np.issubdtype(var.dtype, np.floating):
+            continue
+        values = var.values.astype(encoding.dtype)
+        e = {"chunksizes": chunk_sizes(encoding, var.dims, var.shape)}
+        if encoding.compression is not None:
+            e.update(
+                compression=encoding.compression,
+                complevel=encoding.level,
+                shuffle=encoding.shuffle,
+            )
+        if encoding.pack == "int16":
+            scale, offset = pack_params(values, encoding.valid_range)
+            e.update(dtype="int16", scale_factor=scale, add_offset=offset, _FillValue=INT16_FILL)
+        else:
+            if encoding.pack == "bitround":
+                values = bitround(values, encoding.significant_bits)
+            e.update(dtype=encoding.dtype, _FillValue=np.nan)
+        ds[name] = var.copy(data=values)
+        nc_encoding[name] = e
+    return ds, nc_encoding
+
+
+def write_nc(ds, nc_fp: str, encoding: Encoding = None):
+    """write ds to nc with encoding in one pass
+
+    Parameters:
+        ds: xr.Dataset
+        nc_fp: str, output nc filepath
+        encoding: Encoding, None writes ds as is
+    """
+    if encoding is None:
+        ds.to_netcdf(nc_fp, format="NETCDF4")
+        return
+    ds, nc_encoding = encode_dataset(ds, encoding)
+    ds.to_netcdf(nc_fp, format="NETCDF4", encoding=nc_encoding)
+
+
+def rewrite_nc(nc_fp: str, encoding: Encoding = None):
+    """write nc again with the encoding cdo can not apply, in place: int16 or bitround packing, and chunks cdo did not write
+
+    Parameters:
+        nc_fp: str, nc filepath
+        encoding: Encoding
+    """
+    if encoding is None or (not encoding.rewrite and encoding.chunks is None):
+        return
+    import xarray as xr
+
+    with xr.open_dataset(nc_fp) as ds:
+        if not encoding.rewrite and not _chunks_differ(ds, encoding):
+            return
+        ds = ds.load()
+    write_nc(ds, nc_fp + ".enc", encoding)
+    os.replace(nc_fp + ".enc", nc_fp)
+
+
+def cdo_options(encoding: Encoding = None, file_format: str = "nc") -> list:
+    """get the cdo options writing nc with encoding
+
+    Parameters:
+        encoding: Encoding, None for the file_format alone
+        file_format: str, cdo -f of no compression, 'nc' or 'nc4'
+    return:
+        list, like ['-f', 'nc4', '-b', 'F32', '-k', 'grid', '-z', 'zip_4', '--shuffle']
+    """
+    if encoding is None:
+        return ["-f", file_format]
+    options = ["-b", "F32" if encoding.dtype == "float32" else "F64"]
+    if encoding.rewrite or (encoding.compression is None and encoding.chunks is None):
+        # compressed and chunked when rewritten, not twice
+        return ["-f", file_format, *options]
+    options += ["-k", cdo_chunktype(encoding.chunks)]
+    if encoding.compression is not None:
+        options += ["-z", f"{'zip' if encoding.compression == 'zlib' else 'zstd'}_{encoding.level}"]
+        if encoding.shuffle:
+            options.append("--shuffle")
+    return ["-f", "nc4", *options]
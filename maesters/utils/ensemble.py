@@ -0,0 +1,182 @@
+import warnings
+
+import numpy as np
+
+# ens stats computed in process, named like the cdo operators
+STATS = [
+    "ensmean",
+    "ensstd",
+    "ensstd1",
+    "ensvar",
+    "ensvar1",
+    "ensmin",
+    "ensmax",
+    "enssum",
+    "ensrange",
+    "ensmedian",
+    "enspctl",
+    "ensprob",
+]
+# run by cdo only
+CDO_ONLY = ["ensskew", "enskurt"]
+# the ones run by cdo, ensprob needs the native engine
+CDO_STATS = [s for s in STATS if s != "ensprob"] + CDO_ONLY
+PROB_OPS = {
+    "gt": np.greater,
+    "ge": np.greater_equal,
+    "lt": np.less,
+    "le": np.less_equal,
+}
+
+
+def split_stat(stat: str) -> tuple:
+    """split a stat like 'ensmean', 'enspctl,90' or 'ensprob,gt,0.001' into its operator and arguments
+
+    Parameters:
+        stat: str, 'enspctl,P' is the P-th percentile, 'ensprob,[gt|ge|lt|le,]T' the
+            fraction of members above (or at least, below, at most) the threshold T
+    return:
+        tuple, (operator, [arguments])
+    """
+    name, *args = [a.strip() for a in stat.split(",")]
+    if name not in STATS + CDO_ONLY:
+        raise Exception(f"stats {name} not in {STATS + CDO_ONLY}")
+    if name == "enspctl":
+        if len(args) != 1 or not 0 <= float(args[0]) <= 100:
+            raise Exception(f"stats {stat} is not 'enspctl,P' with P in 0-100")
+        return name, [float(args[0])]
+    if name == "ensprob":
+        if len(args) == 1:
+            args = ["gt", *args]
+        if len(args) != 2 or args[0] not in PROB_OPS:
+            raise Exception(f"stats {stat} is not 'ensprob,[{'|'.join(PROB_OPS)},]T'")
+        return name, [args[0], float(args[1])]
+    if args:
+        raise Exception(f"stats {name} takes no argument")
+    return name, []
+
+
+def parse_stats(stats) -> list:
+    """get stats as a checked list
+
+    Parameters:
+        stats: str | list, like 'ensmean' or ['ensmean', 'ensstd', 'enspctl,90', 'ensprob,gt,0.001']
+    return:
+        list, stats
+    """
+    stats = [stats] if isinstance(stats, str) else list(stats)
+    if len(stats) == 0:
+        raise Exception("no stats")
+    for s in stats:
+        split_stat(s)
+    return stats
+
+
+def stat_suffix(stat: str) -> str:
+    """get the variable name suffix of stat, like 'ENSMEAN', 'ENSPCTL90' or 'ENSPROBGT0P001'"""
+    return stat.upper().replace(",", "").replace(".", "P").replace("-", "M").replace(" ", "")
+
+
+def member_messages(messages: list) -> list:
+    """keep the perturbed members after step 0 of allmbrs messages, like static/pf_split"""
+    return [
+        m
+        for m in messages
+        if not (m.has_key("dataType") and m["dataType"] == "cf")
+        and not (m.has_key("endStep") and m["endStep"] == 0)
+    ]
+
+
+def ens_stats(values: np.ndarray, stats: list) -> dict:
+    """compute stats over the members of values in one pass
+
+    Missing members of a cell are left out, a cell without member is nan.
+    Percentiles interpolate linearly between the sorted members, all of
+    them from a single sort.
+
+    Parameters:
+        values: np.ndarray, (member, ...) nan for missing
+        stats: list, stats like 'ensmean', 'enspctl,90' or 'ensprob,gt,0.001'
+    return:
+        dict, {stat: float32 np.ndarray (...)}
+    """
+    parsed = {s: split_stat(s) for s in stats}
+    names = {name for name, _ in parsed.values()}
+    if names & set(CDO_ONLY):
+        raise Exception(f"stats {sorted(names & set(CDO_ONLY))} are computed by cdo only")
+    values = np.asarray(values, "float64")
+    valid = ~np.isnan(values)
+    count = valid.sum(0)
+    out = {}
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        # cells without member
+        warnings.simplefilter("ignore", RuntimeWarning)
+        total = np.where(count > 0, np.nansum(values, 0), np.nan)
+        mean = total / count
+        if names & {"ensstd", "ensstd1", "ensvar", "ensvar1"}:
+            squares = np.where(count > 0, np.nansum((values - mean) ** 2, 0), np.nan)
+        if names & {"ensmin", "ensrange"}:
+            low = np.nanmin(values, 0)
+        if names & {"ensmax", "ensrange"}:
+            high = np.nanmax(values, 0)
+        q = sorted(
+            {args[0] for name, args in parsed.values() if name == "enspctl"}
+            | ({50.0} if "ensmedian" in names else set())
+        )
+        pctl = dict(zip(q, np.nanpercentile(values, q, axis=0))) if q else {}
+        for s, (name, args) in parsed.items():
+            if name == "ensmean":
+                v = mean
+            elif name == "enssum":
+                v = total
+            elif name in ["ensvar", "ensstd"]:
+                v = squares / count
+            elif name in ["ensvar1", "ensstd1"]:
+                v = squares / (count - 1)
+            elif name == "ensmin":
+                v = low
+            elif name == "ensmax":
+                v = high
+            elif name == "ensrange":
+                v = high - low
+            elif name == "ensmedian":
+                v = pctl[50.0]
+            elif name == "enspctl":
+                v = pctl[args[0]]
+            else:
+                op, threshold = args
+                v = np.where(count > 0, (PROB_OPS[op](values, threshold) & valid).sum(0) / count, np.nan)
+            if name in ["ensstd", "ensstd1"]:
+                v = np.sqrt(v)
+            out[s] = np.asarray(v, "float32")
+    return out
+
+
+def ens_dataset(ds, varname: str, stats: list, names: dict = None):
+    """compute the stats of the members of varname in ds into one dataset
+
+    Parameters:
+        ds: xr.Dataset, varname(number, time, lat, lon) as decoded, or (time, lat, lon) of a single member
+        varname: str, variable of the members
+        stats: list, stats like 'ensmean', 'enspctl,90' or 'ensprob,gt,0.001'
+        names: dict, {stat: output variable name}, None for varname and the stat suffix
+    return:
+        xr.Dataset, a (time, lat, lon) variable of every stat
+    """
+    import xarray as xr
+
+    var = ds[varname]
+    values = var.transpose("number", ...).values if "number" in var.dims else var.values[None]
+    dims = tuple(d for d in var.dims if d != "number")
+    results = ens_stats(values, stats)
+    out = xr.Dataset(coords={k: c for k, c in ds.coords.items() if "number" not in c.dims and k != "number"})
+    for s in stats:
+        attrs = dict(var.attrs)
+        name, args = split_stat(s)
+        if name == "ensprob":
+            attrs = {
+                "units": "1",
+                "long_name": f"probability of {var.attrs.get('long_name', varname)} {args[0]} {args[1]:g}",
+            }
+        out[(names or {}).get(s, varname + stat_suffix(s))] = (dims, results[s], attrs)
+    return out
@@ -0,0 +1,197 @@
+import mmap
+import os
+
+GRIB1_LARGE_FLAG = 0x800000
+# zero bytes allowed between two messages, any other byte is rejected
+MAX_PADDING = 1024
+
+
+def _message_length(buf, offset: int) -> int:
+    """get the total length of the GRIB message starting at offset from its section 0
+
+    return:
+        int, None for a large GRIB1 message, whose length is not in section 0
+    """
+    if buf[offset : offset + 4] != b"GRIB":
+        raise Exception(f"no GRIB indicator at {offset}")
+    if offset + 16 > len(buf):
+        raise Exception(f"truncated section 0 at {offset}")
+    edition = buf[offset + 7]
+    if edition == 2:
+        return int.from_bytes(buf[offset + 8 : offset + 16], "big")
+    elif edition == 1:
+        length = int.from_bytes(buf[offset + 4 : offset + 7], "big")
+        if length & GRIB1_LARGE_FLAG:
+            # ECMWF large GRIB1 messages encode the length in 120-byte units
+            return None
+        return length
+    raise Exception(f"unknown GRIB edition {edition} at {offset}")
+
+
+def _skip_padding(buf, offset: int) -> int:
+    """get the offset of the next message after the zero padding at offset"""
+    head = bytes(buf[offset : offset + MAX_PADDING + 1])
+    padding = len(head) - len(head.lstrip(b"\0"))
+    if padding > MAX_PADDING:
+        raise Exception(f"padding at {offset} exceeds {MAX_PADDING} bytes")
+    return offset + padding
+
+
+def _pygrib_count(local_fp: str) -> int:
+    """count messages with eccodes, for the files whose headers can not be walked"""
+    import pygrib
+
+    grbs = pygrib.open(local_fp)
+    count = grbs.messages
+    grbs.close()
+    return count
+
+
+def check_grib(local_fp: str, messages: int = None) -> int:
+    """check a GRIB file by walking section 0 and section 8 of every message, without decoding
+
+    The first message starts at offset 0, every next one at the end of the previous one
+    after at most MAX_PADDING zero bytes, and the last one ends at the end of file.
+
+    Parameters:
+        local_fp: str, grib filepath
+        messages: int, expected message number, None to skip the check
+    return:
+        int, message number, raise Exception if the file is not complete GRIB messages
+    """
+    size = os.path.getsize(local_fp)
+    if size == 0:
+        raise Exception(f"{local_fp} is empty")
+
+    count = 0
+    with open(local_fp, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buf:
+        offset = 0
+        while offset < size:
+            if count:
+                offset = _skip_padding(buf, offset)
+            length = _message_length(buf, offset)
+            if length is None:
+                count = _pygrib_count(local_fp)
+                break
+            end = offset + length
+            if length < 16 or end > size:
+                raise Exception(
+                    f"{local_fp} message {count} length {length} at {offset} exceeds file size {size}"
+                )
+            if buf[end - 4 : end] != b"7777":
+                raise Exception(f"{local_fp} message {count} has no end section at {end}")
+            count += 1
+            offset = end
+
+    if messages is not None and count != messages:
+        raise Exception(f"{local_fp} has {count} messages, {messages} expected")
+    return count
+
+
+def split_messages(buf: bytes) -> list:
+    """split in-memory GRIB bytes into messages by walking their section 0, zero padding between them is skipped
+
+    Parameters:
+        buf: bytes, complete GRIB messages
+    return:
+        list, bytes of every message
+    """
+    messages = []
+    buf = bytes(buf)
+    offset = 0
+    while offset < len(buf):
+        if messages:
+            offset = _skip_padding(buf, offset)
+        length = _message_length(buf, offset)
+        if length is None:
+            raise Exception(f"message {len(messages)} at {offset} is a large GRIB1 message")
+        end = offset + length
+        if length < 16 or end > len(buf) or buf[end - 4 : end] != b"7777":
+            raise Exception(f"message {len(messages)} at {offset} is truncated")
+        messages.append(buf[offset:end])
+        offset = end
+    return messages
+
+
+class GribStreamChecker:
+    """check GRIB messages incrementally while their bytes are streamed
+
+    Feed the bytes in order with update(), and call close() at the end of
+    stream to get the message number. At most MAX_PADDING zero bytes are
+    allowed between messages, any other byte is rejected.
+    """
+
+    def __init__(self) -> None:
+        self.count = 0
+        self._head = b""
+        self._remaining = 0
+        self._tail = b""
+        self._padding = 0
+        self._unchecked = False
+
+    def update(self, data: bytes):
+        if self._unchecked:
+            return
+        pos = 0
+        while pos < len(data):
+            if self._remaining == 0:
+                if self.count and not self._head:
+                    piece = data[pos : pos + MAX_PADDING + 1 - self._padding]
+                    zeros = len(piece) - len(piece.lstrip(b"\0"))
+                    self._padding += zeros
+                    pos += zeros
+                    if self._padding > MAX_PADDING:
+                        raise Exception(
+                            f"padding after message {self.count} exceeds {MAX_PADDING} bytes"
+                        )
+                    if pos == len(data):
+                        return
+                need = 16 - len(self._head)
+                self._head += data[pos : pos + need]
+                pos += need
+                if not b"GRIB".startswith(self._head[:4]):
+                    raise Exception(f"no GRIB indicator after message {self.count}")
+                if len(self._head) < 16:
+                    return
+                length = _message_length(self._head, 0)
+                if length is None:
+                    self._unchecked = True
+                    return
+                if length < 16:
+                    raise Exception(f"message {self.count} length {length} too short")
+                self._padding = 0
+                self._remaining = length - len(self._head)
+                self._tail = self._head[-4:]
+                self._head = b""
+                if self._remaining == 0:
+                    self._end_message()
+                continue
+            piece = data[pos : pos + self._remaining]
+            pos += len(piece)
+            self._remaining -= len(piece)
+            self._tail = (self._tail + piece[-4:])[-4:]
+            if self._remaining == 0:
+                self._end_message()
+
+    def _end_message(self):
+        if self._tail != b"7777":
+            raise Exception(f"message {self.count} has no end section")
+        self.count += 1
+
+    def close(self) -> int:
+        """check the stream ends at a message boundary
+
+        return:
+            int, message number, None if the messages can not be checked while streaming
+        """
+        if self._unchecked:
+            return None
+        if self._remaining or self._head:
+            raise Exception(f"message {self.count} is truncated")
+        if self._padding:
+            raise Exception(f"{self._padding} bytes after message {self.count}")
+        if self.count == 0:
+            raise Exception("no GRIB message")
+        return self.count
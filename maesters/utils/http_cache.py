@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import namedtuple
+
+from loguru import logger
+
+from maesters.config import DEFAULT_MAESTER
+from maesters.utils.concurrency import get_controller
+from maesters.utils.download import get_session
+
+HTTP_CACHE_TTL = int(os.environ.get("MAESTERS_HTTP_CACHE_TTL", 5 * 60))
+HTTP_CACHE_KEEP = 3 * 24 * 60 * 60
+
+CachedResponse = namedtuple("CachedResponse", ["status_code", "text"])
+
+_MEMORY = {}
+_MEMORY_LOCK = threading.Lock()
+_PRUNED = False
+
+
+def _disk_path(key: str) -> str:
+    return os.path.join(DEFAULT_MAESTER["cachehome"], "http", key[:2], key + ".json")
+
+
+def _read_disk(key: str) -> dict:
+    try:
+        with open(_disk_path(key), "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _write_disk(key: str, entry: dict):
+    """write entry aside and rename it, processes sharing the cache never read a partial entry"""
+    global _PRUNED
+    fp = _disk_path(key)
+    try:
+        os.makedirs(os.path.dirname(fp), 0o777, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(fp))
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, fp)
+    except Exception as e:
+        logger.warning(f"http cache {fp}: {e}")
+        return
+    if not _PRUNED:
+        _PRUNED = True
+        prune_http_cache()
+
+
+def prune_http_cache(max_age: int = HTTP_CACHE_KEEP):
+    """remove the on-disk entries not revalidated for max_age seconds
+
+    Parameters:
+        max_age: int, seconds
+    """
+    root = os.path.join(DEFAULT_MAESTER["cachehome"], "http")
+    now = time.time()
+    for dirpath, _, filenames in os.walk(root):
+        for fn in filenames:
+            fp = os.path.join(dirpath, fn)
+            try:
+                if now - os.path.getmtime(fp) > max_age:
+                    os.remove(fp)
+            except FileNotFoundError:
+                pass
+
+
+def cache_key(url: str, batch: str = None) -> str:
+    """key of url document, the batch keeps listings whose url repeats every day apart"""
+    return hashlib.sha256(f"{url}|{batch}".encode("utf-8")).hexdigest()
+
+
+def _remember(key: str, entry: dict) -> dict:
+    entry["expires"] = time.monotonic() + HTTP_CACHE_TTL
+    with _MEMORY_LOCK:
+        _MEMORY[key] = entry
+    return entry
+
+
+def _get_entry(url: str, batch: str = None) -> tuple:
+    """get the cached entry of url, fetched or revalidated when expired
+
+    return:
+        tuple, (status_code, entry), entry is None if not available
+    """
+    key = cache_key(url, batch)
+    with _MEMORY_LOCK:
+        entry = _MEMORY.get(key)
+    if entry is not None and entry["expires"] > time.monotonic():
+        return 200, entry
+
+    if entry is None:
+        entry = _read_disk(key)
+        if entry is not None and time.time() - entry["fetched"] < HTTP_CACHE_TTL:
+            # fresh entry of another process
+            return 200, _remember(key, entry)
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        # listings and indexes count against the in-flight limit of the host as well
+        with get_controller(url).transfer() as transfer:
+            resp = get_session(url).get(url, headers=headers, timeout=60)
+            transfer["bytes"] = len(resp.content)
+    except Exception as e:
+        if entry is None:
+            raise Exception from e
+        logger.warning(f"{url}: {e}, use the cached document")
+        return 200, _remember(key, entry)
+
+    if resp.status_code == 304 and entry is not None:
+        entry["fetched"] = time.time()
+    elif resp.status_code == 200:
+        entry = {
+            "url": url,
+            "batch": batch,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "text": resp.text,
+            "fetched": time.time(),
+        }
+    elif resp.status_code >= 500 and entry is not None:
+        logger.warning(f"{url}: status {resp.status_code}, use the cached document")
+        return 200, _remember(key, entry)
+    else:
+        logger.debug(f"{url}: status {resp.status_code}")
+        return resp.status_code, None
+    _write_disk(key, {k: v for k, v in entry.items() if k not in ["expires", "links"]})
+    return 200, _remember(key, entry)
+
+
+def cached_get(url: str, batch: str = None) -> CachedResponse:
+    """GET a document like an index file or directory listing through the in-process and on-disk cache
+
+    The cached document is revalidated with If-None-Match/If-Modified-Since
+    once it is older than HTTP_CACHE_TTL seconds.
+
+    Parameters:
+        url: str, document url
+        batch: str, NWP batch like '2022062500', part of the cache key
+    return:
+        CachedResponse, (status_code, text), text is empty if status_code is not 200
+    """
+    status_code, entry = _get_entry(url, batch)
+    return CachedResponse(status_code, entry["text"] if entry else "")
+
+
+def cached_listing(url: str, batch: str = None) -> list:
+    """get the hrefs of a HTTP directory listing, parsed once per cached document
+
+    Parameters:
+        url: str, directory url
+        batch: str, NWP batch like '2022062500', part of the cache key
+    return:
+        list, hrefs, None if the listing is not available
+    """
+    _, entry = _get_entry(url, batch)
+    if entry is None:
+        return None
+    if entry.get("links") is None:
+        from bs4 import BeautifulSoup
+
+        bs_items = BeautifulSoup(entry["text"], "html.parser")
+        entry["links"] = [i["href"] for i in bs_items.find_all("a", href=True)]
+    return entry["links"]
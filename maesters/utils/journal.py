@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Callable
+
+from loguru import logger
+
+PLANNED = "planned"
+DOWNLOADED = "downloaded"
+CONVERTED = "converted"
+
+JOURNAL_NAME = ".maesters_journal.sqlite"
+
+
+class DownloadJournal:
+    """sqlite journal of one batch: the planned download tasks and the stage each reached
+
+    Tasks are keyed by their local grib filepath. The journal is picklable (by
+    path) so it can be handed to download processes, each process opens its
+    own connection.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_batch(cls, local_dir: str, batch: str = None) -> "DownloadJournal":
+        """get the journal kept in the batch output directory
+
+        Parameters:
+            local_dir: str, the batch output directory
+            batch: str, key of the batch like '2024010312', a journal of another
+                batch left in local_dir is reset
+        return:
+            DownloadJournal
+        """
+        os.makedirs(local_dir, 0o777, exist_ok=True)
+        journal = cls(os.path.join(local_dir, JOURNAL_NAME))
+        if batch is not None:
+            journal.start(batch)
+        return journal
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "local_fp TEXT PRIMARY KEY, item TEXT, stage TEXT, bytes INTEGER, "
+                "checksum TEXT, out_fp TEXT, updated REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            conn.commit()
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def _execute(self, sql: str, params=(), many: bool = False) -> list:
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+            rows = cursor.fetchall()
+            conn.commit()
+            return rows
+
+    def start(self, batch: str):
+        """keep the journal for batch, the tasks of another batch are dropped with the downloads they did not convert
+
+        Parameters:
+            batch: str, key of the batch like '2024010312'
+        """
+        rows = self._execute("SELECT value FROM meta WHERE key = 'batch'")
+        if rows and rows[0][0] == batch:
+            return
+        stale = self._execute(
+            "SELECT local_fp FROM tasks WHERE stage != ?", (CONVERTED,)
+        )
+        for (local_fp,) in stale:
+            if os.path.exists(local_fp):
+                os.remove(local_fp)
+        if rows:
+            logger.info(f"journal of batch {rows[0][0]} is reset for batch {batch}")
+        self._execute("DELETE FROM tasks")
+        self._execute("DELETE FROM meta")
+        self._execute("INSERT INTO meta VALUES ('batch', ?)", (batch,))
+
+    def is_planned(self) -> bool:
+        """whether discovery of the batch has been journaled"""
+        return bool(self._execute("SELECT 1 FROM meta WHERE key = 'planned'"))
+
+    def plan(self, items: list, local_fp_index: int = -1):
+        """journal the discovered download tasks, the already journaled ones keep their stage
+
+        Parameters:
+            items: list, download inputs like [(url, local filepath),...]
+            local_fp_index: int, the index of local filepath in item
+        """
+        now = time.time()
+        self._execute(
+            "INSERT OR IGNORE INTO tasks (local_fp, item, stage, updated) VALUES (?, ?, ?, ?)",
+            [(i[local_fp_index], json.dumps(list(i)), PLANNED, now) for i in items],
+            many=True,
+        )
+
+    def close_plan(self):
+        """mark the discovery of the batch complete, restarts then take the tasks from journal"""
+        self._execute(
+            "INSERT OR REPLACE INTO meta VALUES ('planned', ?)", (str(time.time()),)
+        )
+
+    def downloaded(self, local_fp: str, nbytes: int, checksum: str = None):
+        """journal a finished download with its size and the checksum computed while streaming"""
+        self._execute(
+            "UPDATE tasks SET stage = ?, bytes = ?, checksum = ?, updated = ? "
+            "WHERE local_fp = ? AND stage = ?",
+            (DOWNLOADED, nbytes, checksum, time.time(), local_fp, PLANNED),
+        )
+
+    def converted(self, in_out_list: list, fail: list = ()):
+        """journal the finished conversions of downloaded local filepaths
+
+        Parameters:
+            in_out_list: list, [(local filepath, out filepath, ...),...]
+            fail: list, the failed items of in_out_list
+        """
+        now = time.time()
+        fail = set(fail)
+        self._execute(
+            "UPDATE tasks SET stage = ?, out_fp = ?, updated = ? WHERE local_fp = ?",
+            [(CONVERTED, i[1], now, i[0]) for i in in_out_list if i not in fail],
+            many=True,
+        )
+
+    def stage(self, local_fp: str) -> str:
+        """get the stage of task, None if not journaled"""
+        rows = self._execute("SELECT stage FROM tasks WHERE local_fp = ?", (local_fp,))
+        return rows[0][0] if rows else None
+
+    def pending_downloads(self) -> list:
+        """get the items to download: planned ones, and downloaded ones whose file is lost before conversion
+
+        return:
+            list, download inputs
+        """
+        rows = self._execute(
+            "SELECT local_fp, item, stage FROM tasks WHERE stage != ?", (CONVERTED,)
+        )
+        lost = {r[0] for r in rows if r[2] == DOWNLOADED and not os.path.exists(r[0])}
+        if lost:
+            self._execute(
+                "UPDATE tasks SET stage = ? WHERE local_fp = ?",
+                [(PLANNED, fp) for fp in lost],
+                many=True,
+            )
+        return [
+            tuple(json.loads(r[1]))
+            for r in rows
+            if r[2] == PLANNED or r[0] in lost
+        ]
+
+    def pending_conversions(self) -> list:
+        """get the local filepaths downloaded but not converted yet
+
+        return:
+            list, local filepaths
+        """
+        rows = self._execute("SELECT local_fp FROM tasks WHERE stage = ?", (DOWNLOADED,))
+        return [r[0] for r in rows]
+
+    def is_complete(self) -> bool:
+        """whether every planned task is converted"""
+        rows = self._execute("SELECT COUNT(*) FROM tasks WHERE stage != ?", (CONVERTED,))
+        return self.is_planned() and rows[0][0] == 0
+
+
+def group_by(items: list, key: Callable) -> dict:
+    """group download inputs, e.g. the pending ones of journal by url, to submit them together
+
+    Parameters:
+        items: list, download inputs
+        key: Callable, get group key of item
+    return:
+        dict, {key: [item,...]}
+    """
+    groups = {}
+    for i in items:
+        groups.setdefault(key(i), []).append(i)
+    return groups
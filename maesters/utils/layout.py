@@ -0,0 +1,414 @@
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy as np
+
+from maesters.utils.encoding import Encoding, encode_values, pack_params, variable_kwargs
+
+LAYOUTS = ["file", "variable"]
+# hour files of the 'variable' layout are converted here before they are written into the variable file
+STAGE_DIR = ".hours"
+FORMATS = ["nc", "zarr"]
+# chunk length of the zarr arrays by dimension, the dimensions not listed are one chunk
+ZARR_CHUNKS = {
+    "time": int(os.environ.get("MAESTERS_ZARR_CHUNK_TIME", 1)),
+    "lat": int(os.environ.get("MAESTERS_ZARR_CHUNK_LAT", 256)),
+    "lon": int(os.environ.get("MAESTERS_ZARR_CHUNK_LON", 256)),
+}
+
+
+class VariableWriter:
+    """one nc file of a variable for a whole batch, every hour is written into its slot of the time dimension
+
+    The file is created from the first hour that arrives: the time coordinate
+    (hours since batch, for all steps) and the other coordinates are written
+    once. Hours may arrive in any order, and a rewritten hour (e.g. after a
+    restart) overwrites its own slot. The file is opened for every hour, so
+    it is readable whenever no hour is being written. With an encoding the
+    fields are compressed, cast and packed as they are written.
+    """
+
+    def __init__(self, out_fp: str, steps: list, encoding: Encoding = None) -> None:
+        self.out_fp = out_fp
+        self.steps = sorted(int(s) for s in steps)
+        self.encoding = encoding
+        self._index = {s: n for n, s in enumerate(self.steps)}
+
+    def _create(self, src, step: int):
+        import netCDF4
+
+        time = src.variables["time"]
+        valid = netCDF4.num2date(
+            time[0],
+            time.units,
+            getattr(time, "calendar", "standard"),
+            only_use_cftime_datetimes=False,
+            only_use_python_datetimes=True,
+        )
+        batch = valid - timedelta(hours=step)
+
+        tmp = self.out_fp + ".tmp"
+        try:
+            self._create_tmp(tmp, src, batch)
+        except Exception as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise Exception from e
+        os.replace(tmp, self.out_fp)
+
+    def _create_tmp(self, tmp: str, src, batch):
+        import netCDF4
+
+        with netCDF4.Dataset(tmp, "w", format="NETCDF4") as dst:
+            dst.set_auto_maskandscale(False)
+            dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+            for name, dim in src.dimensions.items():
+                dst.createDimension(name, len(self.steps) if name == "time" else len(dim))
+            t = dst.createVariable("time", "f8", ("time",))
+            t.setncatts(
+                {
+                    "standard_name": "time",
+                    "units": f"hours since {batch:%Y-%m-%d %H:%M:%S}",
+                    "calendar": "standard",
+                    "axis": "T",
+                }
+            )
+            t[:] = self.steps
+            s = dst.createVariable("step", "i4", ("time",))
+            s.setncatts({"long_name": "forecast hour", "units": "hours"})
+            s[:] = self.steps
+            for name, var in src.variables.items():
+                if name == "time":
+                    continue
+                if "time" in var.dimensions:
+                    self._create_field(dst, var)
+                else:
+                    # coordinates and bounds, stored once
+                    out = dst.createVariable(
+                        name, var.dtype, var.dimensions, fill_value=self._fill(var)
+                    )
+                    out.setncatts(self._attrs(var))
+                    out[:] = var[:]
+
+    @staticmethod
+    def _fill(var):
+        return var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+
+    @staticmethod
+    def _attrs(var) -> dict:
+        return {k: var.getncattr(k) for k in var.ncattrs() if k != "_FillValue"}
+
+    def _create_field(self, dst, var):
+        if self.encoding is not None:
+            return self._create_encoded(dst, var)
+        # one chunk per hour, an hour is written and read in one piece
+        chunks = [1 if d == "time" else len(dst.dimensions[d]) for d in var.dimensions]
+        fill = self._fill(var)
+        if fill is None and np.issubdtype(var.dtype, np.floating):
+            fill = np.nan
+        out = dst.createVariable(
+            var.name, var.dtype, var.dimensions, fill_value=fill, chunksizes=chunks
+        )
+        out.setncatts(self._attrs(var))
+        return out
+
+    def _create_encoded(self, dst, var):
+        shape = [len(dst.dimensions[d]) for d in var.dimensions]
+        out = dst.createVariable(
+            var.name, dimensions=var.dimensions, **variable_kwargs(self.encoding, var.dimensions, shape)
+        )
+        packing = ("missing_value", "scale_factor", "add_offset")
+        out.setncatts({k: v for k, v in self._attrs(var).items() if k not in packing})
+        if self.encoding.pack == "int16":
+            # the file holds all hours, it is packed with one scale of valid_range
+            scale, offset = pack_params(None, self.encoding.valid_range)
+            out.setncatts({"scale_factor": scale, "add_offset": offset})
+        return out
+
+    def _values(self, var, out, axis: int) -> np.ndarray:
+        if self.encoding is None:
+            return np.take(var[:], 0, axis=axis)
+        var.set_auto_maskandscale(True)
+        values = np.ma.filled(np.take(var[:], 0, axis=axis).astype("float64"), np.nan)
+        params = (
+            (out.getncattr("scale_factor"), out.getncattr("add_offset"))
+            if self.encoding.pack == "int16"
+            else None
+        )
+        return encode_values(values, self.encoding, params)
+
+    def write(self, hour_fp: str, step: int):
+        """write the fields of an hour nc into the slot of step
+
+        Parameters:
+            hour_fp: str, nc of one hour, with a time dimension of size 1
+            step: int, forecast hour
+        """
+        import netCDF4
+
+        if int(step) not in self._index:
+            raise Exception(f"{hour_fp}: step {step} not in {self.out_fp} steps")
+        idx = self._index[int(step)]
+        with netCDF4.Dataset(hour_fp) as src:
+            src.set_auto_maskandscale(False)
+            if len(src.dimensions["time"]) != 1:
+                raise Exception(f"{hour_fp} has {len(src.dimensions['time'])} times, 1 expected")
+            if not os.path.exists(self.out_fp):
+                self._create(src, int(step))
+            with netCDF4.Dataset(self.out_fp, "a") as dst:
+                dst.set_auto_maskandscale(False)
+                for name, var in src.variables.items():
+                    if name == "time" or "time" not in var.dimensions:
+                        continue
+                    out = (
+                        dst.variables[name]
+                        if name in dst.variables
+                        else self._create_field(dst, var)
+                    )
+                    axis = var.dimensions.index("time")
+                    index = [slice(None)] * var.ndim
+                    index[axis] = idx
+                    out[tuple(index)] = self._values(var, out, axis)
+
+
+class ZarrWriter:
+    """one zarr store for a whole batch, every variable is an array with a time dimension of all steps
+
+    The hours are written from the conversion workers. The array of a
+    variable (and the time, step and grid coordinates of the store) is
+    created by the first hour of it that arrives, under a file lock, then
+    every hour writes the region of its own slot. With a time chunk of 1 the
+    regions of two hours never share a chunk, so they are written without
+    lock; a longer time chunk serializes the writes. The metadata is
+    consolidated once all hours are written.
+    """
+
+    def __init__(self, store: str, steps: list, chunks: dict = None) -> None:
+        self.store = store
+        self.steps = sorted(int(s) for s in steps)
+        self.chunks = dict(ZARR_CHUNKS if chunks is None else chunks)
+        self._index = {s: n for n, s in enumerate(self.steps)}
+        self._created = set()
+
+    @contextmanager
+    def _lock(self):
+        import fcntl
+
+        os.makedirs(os.path.dirname(self.store), 0o777, exist_ok=True)
+        with open(self.store + ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _arrays(self) -> set:
+        import zarr
+
+        if not os.path.exists(self.store):
+            return set()
+        return set(zarr.open_group(self.store, mode="r").array_keys())
+
+    def _create(self, ds, varname: str, step: int, existing: set):
+        import dask.array as da
+        import xarray as xr
+
+        var = ds[varname]
+        batch = ds["time"].values[0] - np.timedelta64(int(step), "h")
+        shape = [len(self.steps) if d == "time" else var.sizes[d] for d in var.dims]
+        chunks = [min(self.chunks.get(d, n), n) for d, n in zip(var.dims, shape)]
+        fill = np.nan if np.issubdtype(var.dtype, np.floating) else 0
+        data = da.full(shape, fill, dtype=var.dtype, chunks=chunks)
+        coords = {d: ds[d] for d in var.dims if d != "time" and d in ds.coords}
+        coords["time"] = batch + np.array(self.steps, "timedelta64[h]")
+        coords["step"] = ("time", np.array(self.steps, "int32"), {"long_name": "forecast hour", "units": "hours"})
+        template = xr.Dataset({varname: (var.dims, data, var.attrs)}, coords=coords, attrs=ds.attrs)
+        encoding = {varname: {"chunks": chunks}}
+        if "time" in existing:
+            # coordinates are written by the first variable only
+            template = template.drop_vars([c for c in template.coords if c in existing])
+        else:
+            encoding["time"] = {
+                "units": f"hours since {np.datetime_as_string(batch, unit='s').replace('T', ' ')}",
+                "dtype": "f8",
+            }
+        template.to_zarr(
+            self.store, mode="a", compute=False, encoding=encoding, consolidated=False
+        )
+
+    def write(self, hour_fp: str, step: int):
+        """write the fields of an hour nc into the region of step
+
+        Parameters:
+            hour_fp: str, nc of one hour, with a time dimension of size 1
+            step: int, forecast hour
+        """
+        import xarray as xr
+
+        if int(step) not in self._index:
+            raise Exception(f"{hour_fp}: step {step} not in {self.store} steps")
+        idx = self._index[int(step)]
+        with xr.open_dataset(hour_fp) as ds:
+            ds = ds.load()
+        # the time_bnds of cdo outputs are no field
+        names = [n for n, v in ds.data_vars.items() if "time" in v.dims and "bnds" not in v.dims]
+        if ds.sizes.get("time") != 1 or not names:
+            raise Exception(f"{hour_fp}: one time of fields expected")
+        for varname in names:
+            if varname not in self._created:
+                with self._lock():
+                    existing = self._arrays()
+                    if varname not in existing:
+                        self._create(ds, varname, step, existing)
+                self._created.add(varname)
+
+        region = ds[names].drop_vars(list(ds[names].coords))
+        for varname in names:
+            region[varname].encoding = {}
+        if self.chunks.get("time", 1) > 1:
+            with self._lock():
+                region.to_zarr(self.store, region={"time": slice(idx, idx + 1)}, consolidated=False)
+        else:
+            region.to_zarr(self.store, region={"time": slice(idx, idx + 1)}, consolidated=False)
+
+    def consolidate(self):
+        """consolidate the metadata of the store, readers open it with a single read"""
+        import warnings
+
+        import zarr
+
+        if os.path.exists(self.store):
+            with warnings.catch_warnings():
+                # zarr v3 warns that consolidated metadata is not in its spec yet
+                warnings.simplefilter("ignore")
+                zarr.consolidate_metadata(self.store)
+        if os.path.exists(self.store + ".lock"):
+            os.remove(self.store + ".lock")
+
+
+class LayoutWriter:
+    """place the converted hours of a batch in the output layout
+
+    'file': one nc per variable and hour in out_dir, like '{VAR}-{HOUR}.nc'.
+    'variable': one nc per variable, '{VAR}.nc' with a time dimension of all
+    steps. The hours are converted into a staging directory and written into
+    the variable file as each one finishes. Pass the writer as the callback
+    of a batch conversion, which calls it in the parent process, so each
+    variable file has a single writer.
+
+    format 'zarr' writes every variable of the batch into one store,
+    '{BATCH}.zarr' in out_dir, whatever the layout. The hours are staged the
+    same way, and written into the store by the conversion workers through
+    the worker of the writer.
+
+    encoding applies to the nc outputs: the converters write it into the
+    files of the 'file' layout (see hour_encoding), and the variable files
+    are encoded by their writer as the hours are written.
+    """
+
+    def __init__(
+        self,
+        out_dir: str,
+        steps: list,
+        layout: str = "file",
+        format: str = "nc",
+        chunks: dict = None,
+        encoding: Encoding = None,
+    ) -> None:
+        if layout not in LAYOUTS:
+            raise Exception(f"layout {layout} not in {LAYOUTS}")
+        if format not in FORMATS:
+            raise Exception(f"format {format} not in {FORMATS}")
+        if (
+            layout == "variable"
+            and encoding is not None
+            and encoding.pack == "int16"
+            and encoding.valid_range is None
+        ):
+            raise Exception("int16 packing of the 'variable' layout needs a valid_range")
+        self.out_dir = out_dir
+        self.steps = steps
+        self.layout = layout
+        self.format = format
+        self.encoding = encoding
+        self._hours = {}
+        self._writers = {}
+        self._zarr = (
+            ZarrWriter(
+                os.path.join(out_dir, os.path.basename(os.path.normpath(out_dir)) + ".zarr"),
+                steps,
+                chunks,
+            )
+            if format == "zarr"
+            else None
+        )
+
+    @property
+    def hour_encoding(self) -> Encoding:
+        """encoding of the converted hours, None when they are staged and encoded by the writer"""
+        return self.encoding if self.layout == "file" and self.format == "nc" else None
+
+    def hour_fp(self, name: str, varname: str = None, step: int = None) -> str:
+        """get the nc filepath to convert an hour to
+
+        Parameters:
+            name: str, file name of the 'file' layout, without suffix
+            varname: str, variable of the hour, None keeps the 'file' layout for it
+            step: int, forecast hour
+        return:
+            str, nc filepath
+        """
+        if (self.layout == "file" and self.format == "nc") or varname is None:
+            return os.path.join(self.out_dir, name + ".nc")
+        fp = os.path.join(self.out_dir, STAGE_DIR, f"{varname}-{str(step).zfill(3)}.nc")
+        self._hours[fp] = (varname, int(step))
+        return fp
+
+    def out_fp(self, hour_fp: str) -> str:
+        """get the output filepath holding the hour"""
+        if hour_fp in self._hours and self._zarr is not None:
+            return self._zarr.store
+        if hour_fp in self._hours:
+            return os.path.join(self.out_dir, self._hours[hour_fp][0] + ".nc")
+        return hour_fp
+
+    def outputs(self, in_out_list: list) -> list:
+        """map (grib filepath, hour filepath, ...) items to their output filepaths, as journaled"""
+        return [(i[0], self.out_fp(i[1]), *i[2:]) for i in in_out_list]
+
+    def __call__(self, value: tuple):
+        """write the converted hour of (grib filepath, hour filepath, ...) into its variable file"""
+        hour_fp = value[1]
+        if hour_fp not in self._hours or self._zarr is not None:
+            return
+        varname, step = self._hours[hour_fp]
+        if varname not in self._writers:
+            self._writers[varname] = VariableWriter(
+                self.out_fp(hour_fp), self.steps, self.encoding
+            )
+        self._writers[varname].write(hour_fp, step)
+        os.remove(hour_fp)
+
+    @property
+    def worker(self):
+        """called in the conversion worker with every converted value, None if the hours are written in this process"""
+        return self.write_zarr if self._zarr is not None else None
+
+    def write_zarr(self, value: tuple):
+        """write the converted hour of (grib filepath, hour filepath, ...) into the zarr store"""
+        hour_fp = value[1]
+        if hour_fp not in self._hours:
+            return
+        _, step = self._hours[hour_fp]
+        self._zarr.write(hour_fp, step)
+        os.remove(hour_fp)
+
+    def close(self):
+        """remove the staging directory once every hour is written, and consolidate the zarr store"""
+        if self._zarr is not None:
+            self._zarr.consolidate()
+        stage = os.path.join(self.out_dir, STAGE_DIR)
+        if os.path.isdir(stage) and not os.listdir(stage):
+            shutil.rmtree(stage, ignore_errors=True)
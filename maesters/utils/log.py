@@ -0,0 +1,26 @@
+import os
+
+from loguru import logger
+
+LOG_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "log"
+)
+
+_SINKS = {}
+
+
+def add_file_sink(name: str) -> int:
+    """add the daily rotated log file sink of name, once per process
+
+    Parameters:
+        name: str, log file prefix like 'ECMWF_OPER'
+    return:
+        int, loguru handler id
+    """
+    if name not in _SINKS:
+        _SINKS[name] = logger.add(
+            os.path.join(LOG_DIR, name + "_{time:%Y%m%d}"),
+            rotation="00:00",
+            retention=10,
+        )
+    return _SINKS[name]
@@ -1,28 +1,66 @@
-from subprocess import call, check_output
+from subprocess import call
 import os, sys
+import math
+from glob import glob
+from typing import Callable
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import shutil
 
+import numpy as np
 from loguru import logger
 from retrying import retry
 
-try:
-    PATH = os.path.dirname(
-        check_output("which cdo", shell=True).decode("utf-8").split("\n")[0][:]
-    )
-except:
-    PATH = os.path.dirname(sys.executable)
+from maesters.config import get_convert_workers
+from maesters.utils.encoding import Encoding, cdo_options, rewrite_nc, write_nc
+from maesters.utils.ensemble import CDO_STATS, ens_dataset, parse_stats, split_stat, stat_suffix
+from maesters.utils.region import cdo_sellonlatbox, regional_remap
+from maesters.utils.remap import load_remap, read_fields, remap_dataset
+
+# cdo/grib_filter directory, looked up without spawning a shell at import
+PATH = (
+    os.path.dirname(shutil.which("cdo"))
+    if shutil.which("cdo")
+    else os.path.dirname(sys.executable)
+)
 MAESTERS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-PARALLEL_NUM = 5
+PARALLEL_NUM = get_convert_workers()
+# 'cdo', or 'native' to decode grib and write nc in process
+# (regular grids, the icon remap with its SCRIP weights as a sparse matrix, and ens stats)
+CONVERT_ENGINE = os.environ.get("MAESTERS_CONVERT_ENGINE", "cdo")
+# the most files converted in one worker call
+CONVERT_CHUNK = int(os.environ.get("MAESTERS_CONVERT_CHUNK", 16))
+
+
+def cdo(*args: str, cwd: str = None):
+    """run one cdo invocation without shell
+
+    Parameters:
+        args: str, cdo options, operator chain, input and output files
+        cwd: str, working directory
+    """
+    cmd = [os.path.join(PATH, "cdo"), *args]
+    code = call(cmd, cwd=cwd)
+    if code != 0:
+        raise Exception(f"{' '.join(cmd)} exit {code}")
+
+
+def publish_nc(tmp_fp: str, out_nc_fp: str):
+    """rename the written tmp file to out nc, a failed conversion never leaves a partial out nc"""
+    os.replace(tmp_fp, out_nc_fp)
+    os.chmod(out_nc_fp, 0o777)
 
 
 @retry(wait_fixed=10e3, stop_max_attempt_number=3, stop_max_delay=10 * 10e3)
-def single_convert_nc(orig_grib_fp: str, out_nc_fp: str):
-    """change name and convert grib to nc
+def single_convert_nc(
+    orig_grib_fp: str, out_nc_fp: str, encoding: Encoding = None, bbox: tuple = None
+):
+    """change name, crop and convert grib to nc in one pass
 
     Parameters:
         orig_grib_fp: str, original grib filepath
         out_nc_fp: str, output nc filepath
+        encoding: Encoding, compression, chunks, dtype and packing of the nc
+        bbox: tuple, (west, south, east, north) written only, None for the whole grid
     return:
         out_nc_fp
     """
@@ -31,41 +69,141 @@ def single_convert_nc(orig_grib_fp: str, out_nc_fp: str):
     varname = os.path.basename(out_nc_fp).split(".nc")[0].split("-")[0]
     out_dir = os.path.dirname(out_nc_fp)
     os.makedirs(out_dir, 0o777, exist_ok=True)
-    call(
-        f"{os.path.join(PATH,'cdo')} showname {orig_grib_fp} | xargs -I {'{}'} {os.path.join(PATH,'cdo')} -f nc4 -chname,{'{}'},{varname} {orig_grib_fp} {out_nc_fp}",
-        shell=True,
-    )
-    os.chmod(out_nc_fp, 0o777)
+    tmp_fp = out_nc_fp + ".tmp"
+    if CONVERT_ENGINE == "native":
+        from maesters.utils.decode import decode_grib
+
+        write_nc(decode_grib(orig_grib_fp, varname, bbox), tmp_fp, encoding)
+    else:
+        crop = [cdo_sellonlatbox(bbox)] if bbox is not None else []
+        cdo(
+            *cdo_options(encoding, "nc4"),
+            f"-setname,{varname}",
+            *crop,
+            orig_grib_fp,
+            tmp_fp,
+        )
+        rewrite_nc(tmp_fp, encoding)
+    publish_nc(tmp_fp, out_nc_fp)
     return out_nc_fp
 
 
-def batch_convert_nc(in_out_list: list) -> list:
-    """batch rename and convert grib to nc
+def run_chunk(
+    func: Callable, kwargs_list: list, values: list = None, worker: Callable = None
+) -> list:
+    """run func with every kwargs of kwargs_list in one worker call
 
     Parameters:
-        in_out_list: list, [(orig_grib_fp, out_nc_fp, varname), ...,]
+        func: Callable, single conversion
+        kwargs_list: list, [kwargs,...]
+        values: list, the items of kwargs_list, passed to worker
+        worker: Callable, called here with every converted value
     return:
-        list, fail list
+        list, [(index, error),...] of the failed ones
+    """
+    fail = []
+    for n, kwargs in enumerate(kwargs_list):
+        try:
+            func(**kwargs)
+            if worker is not None:
+                worker(values[n])
+        except Exception as e:
+            fail.append((n, repr(e)))
+    return fail
+
+
+def batch_run(
+    func: Callable,
+    values: list,
+    kwargs_list: list,
+    callback: Callable = None,
+    runner: Callable = run_chunk,
+) -> list:
+    """run func on worker processes, the values are sent in chunks to spread the startup cost
+
+    Parameters:
+        func: Callable, single conversion
+        values: list, the items of batch
+        kwargs_list: list, func kwargs of every item
+        callback: Callable, called in this process with every converted value as soon as its chunk finishes,
+            its worker (if any, like the one of a zarr LayoutWriter) is called in the worker process first
+        runner: Callable, runs a chunk in the worker process, run_chunk or one with its signature
+    return:
+        list, fail list of values
     """
-    results = []
+    results = {}
     fail = []
+    worker = getattr(callback, "worker", None)
+    chunk = max(1, min(CONVERT_CHUNK, math.ceil(len(values) / PARALLEL_NUM)))
     with ProcessPoolExecutor(max_workers=PARALLEL_NUM) as pool:
-        for value in in_out_list:
-            results.append(
+        for i in range(0, len(values), chunk):
+            results[
                 pool.submit(
-                    single_convert_nc, orig_grib_fp=value[0], out_nc_fp=value[1]
+                    runner,
+                    func,
+                    kwargs_list[i : i + chunk],
+                    values[i : i + chunk],
+                    worker,
                 )
-            )
-        for n, r in enumerate(as_completed(results)):
+            ] = values[i : i + chunk]
+        for r in as_completed(results):
             try:
-                r.result()
+                errors = r.result()
             except Exception as e:
-                logger.error(in_out_list[n])
                 logger.error(e)
-                fail.append(in_out_list[n])
+                fail.extend(results[r])
+                continue
+            for n, e in errors:
+                logger.error(results[r][n])
+                logger.error(e)
+                fail.append(results[r][n])
+            if callback is None:
+                continue
+            failed = {n for n, _ in errors}
+            for n, value in enumerate(results[r]):
+                if n in failed:
+                    continue
+                try:
+                    callback(value)
+                except Exception as e:
+                    logger.error(value)
+                    logger.error(e)
+                    fail.append(value)
     return fail
 
 
+def batch_convert_nc(
+    in_out_list: list,
+    callback: Callable = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
+) -> list:
+    """batch rename and convert grib to nc
+
+    Parameters:
+        in_out_list: list, [(orig_grib_fp, out_nc_fp, varname), ...,]
+        callback: Callable, called with every converted item, e.g. a LayoutWriter
+        encoding: Encoding, compression, chunks, dtype and packing of the nc
+        bbox: tuple, (west, south, east, north) written only, None for the whole grid
+    return:
+        list, fail list
+    """
+    return batch_run(
+        single_convert_nc,
+        in_out_list,
+        [
+            {
+                "orig_grib_fp": v[0],
+                "out_nc_fp": v[1],
+                "encoding": encoding,
+                "bbox": bbox,
+            }
+            for v in in_out_list
+        ],
+        callback,
+    )
+
+
 @retry(wait_fixed=10e3, stop_max_attempt_number=3, stop_max_delay=10 * 10e3)
 def single_tri_transform(
     orig_grib_fp: str,
@@ -73,8 +211,13 @@ def single_tri_transform(
     varname: str,
     grid_text: str = os.path.join(MAESTERS, "static/dwd/target_grid_world_0125.txt"),
     grid_weight: str = os.path.join(MAESTERS, "static/dwd/weights_icogl2world_0125.nc"),
+    encoding: Encoding = None,
+    bbox: tuple = None,
 ):
-    """single transform: 1. dwd icon tri-grid to lon-lat grid 2. grib to nc 3. change variable name
+    """single transform in one cdo chain: 1. dwd icon tri-grid to lon-lat grid 2. grib to nc 3. change variable name
+
+    With bbox the remap uses the regional subset of the weights, only the
+    target cells inside bbox are computed and written.
 
     Parameters:
         orig_grib_fp: str, orig grib filepath
@@ -82,37 +225,111 @@ def single_tri_transform(
         varname: rename variable name
         grid_text: str, transform output grid details file
         grid_weight: str, transform orig grid weight file
+        encoding: Encoding, compression, chunks, dtype and packing of the nc
+        bbox: tuple, (west, south, east, north) of the target grid, None for all of it
     """
-    orig_dir = os.path.dirname(orig_grib_fp)
-    orig_fn = os.path.basename(orig_grib_fp)
-    out_dir = os.path.dirname(out_nc_fp)
-
     if os.path.exists(out_nc_fp):
         return
-    if os.path.exists(os.path.join(out_dir, orig_fn + ".tmp")):
-        os.remove(os.path.join(out_dir, orig_fn + ".tmp"))
-    os.makedirs(out_dir, 0o777, exist_ok=True)
+    if bbox is not None:
+        grid_text, grid_weight = regional_remap(grid_text, grid_weight, bbox)
+    os.makedirs(os.path.dirname(out_nc_fp), 0o777, exist_ok=True)
+    tmp_fp = out_nc_fp + ".tmp"
+    if CONVERT_ENGINE == "native":
+        fields, times, attrs = read_fields(orig_grib_fp)
+        values = load_remap(grid_weight).apply(fields)
+        ds = remap_dataset(values, times, varname, grid_text, attrs)
+        write_nc(ds, tmp_fp, encoding)
+    else:
+        cdo(
+            *cdo_options(encoding, "nc"),
+            f"-setname,{varname}",
+            f"-remap,{grid_text},{grid_weight}",
+            orig_grib_fp,
+            tmp_fp,
+        )
+        rewrite_nc(tmp_fp, encoding)
+    publish_nc(tmp_fp, out_nc_fp)
+    return
 
-    call(
-        f"{os.path.join(PATH,'cdo')} -f grb2 remap,{grid_text},{grid_weight} {orig_grib_fp} {orig_fn+'.tmp'}",
-        cwd=out_dir,
-        shell=True,
-    )
-    # paraName = check_output(f"{os.path.join(PATH,'cdo')} showname {orig_fn}",cwd=out_dir,shell=True).decode('utf-8').split('\n')[0][1:]
-    call(
-        f"{os.path.join(PATH,'cdo')} showname {orig_fn+'.tmp'} | xargs -I {'{}'} {os.path.join(PATH,'cdo')} -f nc -chname,{'{}'},{varname} {orig_fn+'.tmp'} {out_nc_fp}",
-        cwd=out_dir,
-        shell=True,
-    )
-    os.remove(os.path.join(out_dir, orig_fn + ".tmp"))
 
-    return
+def run_remap_chunk(
+    func: Callable, kwargs_list: list, values: list = None, worker: Callable = None
+) -> list:
+    """remap a chunk of single_tri_transform kwargs in process, like run_chunk
+
+    The fields of all files are stacked and remapped in one sparse product
+    per weights file, which is loaded once per worker, then every nc is
+    written directly. func is not called.
+
+    Parameters:
+        func: Callable, single_tri_transform
+        kwargs_list: list, [kwargs,...]
+        values: list, the items of kwargs_list, passed to worker
+        worker: Callable, called here with every converted value
+    return:
+        list, [(index, error),...] of the failed ones
+    """
+    fail = {}
+    fields = {}
+    for n, kwargs in enumerate(kwargs_list):
+        if os.path.exists(kwargs["out_nc_fp"]):
+            continue
+        try:
+            fields[n] = read_fields(kwargs["orig_grib_fp"])
+        except Exception as e:
+            fail[n] = repr(e)
+
+    groups = {}
+    for n in fields:
+        groups.setdefault(
+            (kwargs_list[n]["grid_text"], kwargs_list[n]["grid_weight"]), []
+        ).append(n)
+    for (grid_text, grid_weight), ns in groups.items():
+        try:
+            remapped = load_remap(grid_weight).apply(
+                np.concatenate([fields[n][0] for n in ns])
+            )
+        except Exception as e:
+            fail.update((n, repr(e)) for n in ns)
+            continue
+        offset = 0
+        for n in ns:
+            _, times, attrs = fields[n]
+            kwargs = kwargs_list[n]
+            try:
+                ds = remap_dataset(
+                    remapped[offset : offset + len(times)],
+                    times,
+                    kwargs["varname"],
+                    grid_text,
+                    attrs,
+                )
+                os.makedirs(os.path.dirname(kwargs["out_nc_fp"]), 0o777, exist_ok=True)
+                tmp_fp = kwargs["out_nc_fp"] + ".tmp"
+                write_nc(ds, tmp_fp, kwargs.get("encoding"))
+                publish_nc(tmp_fp, kwargs["out_nc_fp"])
+            except Exception as e:
+                fail[n] = repr(e)
+            offset += len(times)
+
+    if worker is not None:
+        for n in range(len(kwargs_list)):
+            if n in fail:
+                continue
+            try:
+                worker(values[n])
+            except Exception as e:
+                fail[n] = repr(e)
+    return sorted(fail.items())
 
 
 def batch_tri_transform(
     in_out_var_list: list,
     grid_text: str = os.path.join(MAESTERS, "static/dwd/target_grid_world_0125.txt"),
     grid_weight: str = os.path.join(MAESTERS, "static/dwd/weights_icogl2world_0125.nc"),
+    callback: Callable = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
 ) -> list:
     """batch transform dwd icon tri-grid grib data to lon-lat-grid nc
 
@@ -120,31 +337,32 @@ def batch_tri_transform(
         in_out_var_list: list, [(orig_grib_fp, out_nc_fp, varname), ...,]
         grid_text: str, transform output grid details file
         grid_weight: str, transform orig grid weight file
+        callback: Callable, called with every converted item, e.g. a LayoutWriter
+        encoding: Encoding, compression, chunks, dtype and packing of the nc
+        bbox: tuple, (west, south, east, north) of the target grid, None for all of it
     Return:
         list, fail list
     """
-    results = []
-    fail = []
-    with ProcessPoolExecutor(max_workers=PARALLEL_NUM) as pool:
-        for value in in_out_var_list:
-            results.append(
-                pool.submit(
-                    single_tri_transform,
-                    orig_grib_fp=value[0],
-                    out_nc_fp=value[1],
-                    varname=value[2],
-                    grid_text=grid_text,
-                    grid_weight=grid_weight,
-                )
-            )
-        for n, r in enumerate(as_completed(results)):
-            try:
-                r.result()
-            except Exception as e:
-                logger.error(in_out_var_list[n])
-                logger.error(e)
-                fail.append(in_out_var_list[n])
-    return fail
+    if bbox is not None:
+        # the regional weights are cut once here, not in every worker
+        grid_text, grid_weight = regional_remap(grid_text, grid_weight, bbox)
+    return batch_run(
+        single_tri_transform,
+        in_out_var_list,
+        [
+            {
+                "orig_grib_fp": v[0],
+                "out_nc_fp": v[1],
+                "varname": v[2],
+                "grid_text": grid_text,
+                "grid_weight": grid_weight,
+                "encoding": encoding,
+            }
+            for v in in_out_var_list
+        ],
+        callback,
+        run_remap_chunk if CONVERT_ENGINE == "native" else run_chunk,
+    )
 
 
 @retry(wait_fixed=10e3, stop_max_attempt_number=3, stop_max_delay=10 * 10e3)
@@ -152,22 +370,50 @@ def single_ens_stats(
     orig_grib_fp: str,
     out_nc_fp: str,
     varname: str,
-    stats: str,
+    stats,
     split_rule: str = os.path.join(MAESTERS, "static/pf_split"),
+    encoding: Encoding = None,
+    bbox: tuple = None,
 ):
     """cal the ens method of all pf type ensemble from grib and save as nc
 
+    The members are split with grib_filter, then stats, rename and nc output run in one cdo chain.
+    The native engine, and several stats or the ones cdo has not, decode all
+    members into one array and compute every stat in process in one pass,
+    written together into the nc without split files.
+
     Parameters:
         orig_grib_fp: str, original grib filepath
         out_nc_fp: str, output nc filepath
-        varname: str, variable name in output nc file
-        stats: str, ens method like 'ensmean'/'ensmax'/'ensmin'/'ensstd'/'ensstd1'/'enssum'/'ensvar'/'ensvar1'/'ensskew'/'enspctl'/'ensmedian'/'enskurt'/'ensrange'
+        varname: str, variable name in output nc file, with the suffix of each stat like 'ENSSTD' for several stats
+        stats: str | list, ens method like 'ensmean'/'ensmax'/'ensmin'/'ensstd'/'ensstd1'/'enssum'/'ensvar'/'ensvar1'/'enspctl,P'/'ensmedian'/'ensrange'/'ensprob,[gt|ge|lt|le,]T', or a list of them
         split_rule: str, the rule_file of split grib, default is pertubationNumber split
+        encoding: Encoding, compression, chunks, dtype and packing of the nc
+        bbox: tuple, (west, south, east, north) written only, None for the whole grid
     return:
         out_nc_fp
     """
     if os.path.exists(out_nc_fp):
         return out_nc_fp
+    stats = parse_stats(stats)
+    if CONVERT_ENGINE == "native" or len(stats) > 1 or split_stat(stats[0])[0] not in CDO_STATS:
+        from maesters.utils.decode import decode_messages, open_messages
+        from maesters.utils.ensemble import member_messages
+
+        messages = member_messages(open_messages(orig_grib_fp))
+        if len(messages) == 0:
+            raise Exception(f"{orig_grib_fp} has no pf member")
+        names = (
+            {stats[0]: varname}
+            if len(stats) == 1
+            else {s: varname + stat_suffix(s) for s in stats}
+        )
+        ds = ens_dataset(decode_messages(messages, varname, bbox), varname, stats, names)
+        os.makedirs(os.path.dirname(out_nc_fp), 0o777, exist_ok=True)
+        tmp_fp = out_nc_fp + ".tmp"
+        write_nc(ds, tmp_fp, encoding)
+        publish_nc(tmp_fp, out_nc_fp)
+        return out_nc_fp
     orig_dir = os.path.dirname(orig_grib_fp)
     orig_fn = os.path.basename(orig_grib_fp)
     orig_base_filename = (
@@ -179,23 +425,32 @@ def single_ens_stats(
     if os.path.exists(tmp_dir):
         shutil.rmtree(tmp_dir)
     os.makedirs(tmp_dir, 0o777, exist_ok=True)
-    call(
-        f"{os.path.join(PATH,'grib_filter')} {split_rule} ../{orig_fn}",
-        shell=True,
-        cwd=tmp_dir,
-    )
-    call(
-        f"{os.path.join(PATH,'cdo')} -s {stats} *-*.pn* temp.grib ",
-        cwd=tmp_dir,
-        shell=True,
-    )
-    os.makedirs(out_dir, 0o777, exist_ok=True)
-    call(
-        f"{os.path.join(PATH,'cdo')} showname temp.grib | xargs -I {'{}'} {os.path.join(PATH,'cdo')} -f nc -chname,{'{}'},{varname} temp.grib {out_nc_fp}",
-        cwd=tmp_dir,
-        shell=True,
-    )
-    shutil.rmtree(tmp_dir)
+    try:
+        code = call(
+            [os.path.join(PATH, "grib_filter"), split_rule, f"../{orig_fn}"], cwd=tmp_dir
+        )
+        if code != 0:
+            raise Exception(f"grib_filter {orig_grib_fp} exit {code}")
+        members = sorted(glob(os.path.join(tmp_dir, "*-*.pn*")))
+        if len(members) == 0:
+            raise Exception(f"{orig_grib_fp} has no pf member")
+        os.makedirs(out_dir, 0o777, exist_ok=True)
+        tmp_fp = out_nc_fp + ".tmp"
+        # the variadic ens operator is the last of the chain and takes all members
+        crop = [cdo_sellonlatbox(bbox)] if bbox is not None else []
+        cdo(
+            "-s",
+            *cdo_options(encoding, "nc"),
+            f"-setname,{varname}",
+            *crop,
+            f"-{stats[0]}",
+            *members,
+            tmp_fp,
+        )
+        rewrite_nc(tmp_fp, encoding)
+        publish_nc(tmp_fp, out_nc_fp)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
     return out_nc_fp
 
 
@@ -205,6 +460,7 @@ def single_ens_mean(
     out_nc_fp: str,
     varname: str,
     split_rule: str = os.path.join(MAESTERS, "static/pf_split"),
+    bbox: tuple = None,
 ):
     """cal the mean of all pf type ensemble from grib and save as nc
 
@@ -213,83 +469,66 @@ def single_ens_mean(
         out_nc_fp: str, output nc filepath
         varname: str, variable name in output nc file
         split_rule: str, the rule_file of split grib, default is pertubationNumber split
+        bbox: tuple, (west, south, east, north) written only, None for the whole grid
     return:
         out_nc_fp
     """
-    return single_ens_stats(orig_grib_fp, out_nc_fp, varname, "ensmean", split_rule)
+    return single_ens_stats(
+        orig_grib_fp, out_nc_fp, varname, "ensmean", split_rule, bbox=bbox
+    )
 
 
 def batch_ens_stats(
     in_out_var_list: list,
-    stats: str,
+    stats,
     split_rule: str = os.path.join(MAESTERS, "static/pf_split"),
+    callback: Callable = None,
+    encoding: Encoding = None,
+    bbox: tuple = None,
 ) -> list:
     """batch cal ens stats
 
     Parameters:
         in_out_var_list: list, [(orig_grib_fp, out_nc_fp, varname), ...,]
-        stats: str, ens method like 'ensmean'/'ensmax'/'ensmin'/'ensstd'/'ensstd1'/'enssum'/'ensvar'/'ensvar1'/'ensskew'/'enspctl'/'ensmedian'/'enskurt'/'ensrange'
+        stats: str | list, ens method, or a list of them computed in one pass, see single_ens_stats
         split_rule: str, grib_filter split rule_file
+        callback: Callable, called with every converted item, e.g. a LayoutWriter
+        encoding: Encoding, compression, chunks, dtype and packing of the nc
+        bbox: tuple, (west, south, east, north) written only, None for the whole grid
     return:
         list, fail list
     """
-    results = []
-    fail = []
-    with ProcessPoolExecutor(max_workers=PARALLEL_NUM) as pool:
-        for value in in_out_var_list:
-            results.append(
-                pool.submit(
-                    single_ens_stats,
-                    orig_grib_fp=value[0],
-                    out_nc_fp=value[1],
-                    varname=value[2],
-                    stats=stats,
-                    split_rule=split_rule,
-                )
-            )
-        for n, r in enumerate(as_completed(results)):
-            try:
-                r.result()
-            except Exception as e:
-                logger.error(in_out_var_list[n])
-                logger.error(e)
-                fail.append(in_out_var_list[n])
-    return fail
+    return batch_run(
+        single_ens_stats,
+        in_out_var_list,
+        [
+            {
+                "orig_grib_fp": v[0],
+                "out_nc_fp": v[1],
+                "varname": v[2],
+                "stats": stats,
+                "split_rule": split_rule,
+                "encoding": encoding,
+                "bbox": bbox,
+            }
+            for v in in_out_var_list
+        ],
+        callback,
+    )
 
 
 def batch_ens_mean(
-    in_out_var_list: list, split_rule: str = os.path.join(MAESTERS, "static/pf_split")
+    in_out_var_list: list,
+    split_rule: str = os.path.join(MAESTERS, "static/pf_split"),
+    bbox: tuple = None,
 ) -> list:
     """batch cal ens mean
 
     Parameters:
         in_out_var_list: list, [(orig_grib_fp, out_nc_fp, varname), ...,]
         split_rule: str, grib_filter split rule_file
+        bbox: tuple, (west, south, east, north) written only, None for the whole grid
     return:
         list, fail list
     """
-    return batch_ens_stats(in_out_var_list, "ensmean", split_rule=split_rule)
-
-
-# def batch_ens_mean(in_out_var_list:list,split_rule:str=os.path.join(MAESTERS,'static/pf_split'))->list:
-#     """ batch cal ens mean
-
-#     Parameters:
-#         in_out_var_list: list, [(orig_grib_fp, out_nc_fp, varname), ...,]
-#         split_rule: str, grib_filter split rule_file
-#     return:
-#         list, fail list
-#     """
-#     results = []
-#     fail = []
-#     with ProcessPoolExecutor(max_workers=PARALLEL_NUM) as pool:
-#         for value in in_out_var_list:
-#             results.append(pool.submit(single_ens_mean,orig_grib_fp=value[0],out_nc_fp=value[1],varname=value[2],split_rule=split_rule))
-#         for n,r in enumerate(as_completed(results)):
-#             try:
-#                 r.result()
-#             except Exception as e:
-#                 logger.error(in_out_var_list[n])
-#                 logger.error(e)
-#                 fail.append(in_out_var_list[n])
-#     return fail
+    return batch_ens_stats(in_out_var_list, "ensmean", split_rule=split_rule, bbox=bbox)
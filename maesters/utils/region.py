@@ -0,0 +1,198 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from maesters.config import DEFAULT_MAESTER
+
+# regional grids and weights cut from global ones, by source files and bbox
+REMAP_CACHE = os.path.join(DEFAULT_MAESTER["cachehome"], "remap")
+
+
+def check_bbox(bbox) -> tuple:
+    """check bbox and get it as floats
+
+    Parameters:
+        bbox: tuple, (west, south, east, north) in degrees, west may be larger than east across the antimeridian
+    return:
+        tuple, (west, south, east, north)
+    """
+    if bbox is None:
+        return None
+    if len(bbox) != 4:
+        raise Exception(f"bbox {bbox} is not (west, south, east, north)")
+    west, south, east, north = (float(b) for b in bbox)
+    if not -90 <= south < north <= 90:
+        raise Exception(f"bbox {bbox}: south and north out of order or range")
+    return west, south, east, north
+
+
+def cdo_sellonlatbox(bbox) -> str:
+    """get the cdo operator selecting bbox"""
+    west, south, east, north = check_bbox(bbox)
+    return f"-sellonlatbox,{west:g},{east:g},{south:g},{north:g}"
+
+
+def lon_in_bbox(lon: np.ndarray, bbox) -> np.ndarray:
+    """get the longitudes shifted to start at the west of bbox, nan outside of it"""
+    west, _, east, _ = check_bbox(bbox)
+    width = (east - west) % 360 or 360
+    shifted = west + (np.asarray(lon, "float64") - west) % 360
+    return np.where(shifted - west <= width, shifted, np.nan)
+
+
+def bbox_index(lat: np.ndarray, lon: np.ndarray, bbox) -> tuple:
+    """get the indexes of a regular grid inside bbox
+
+    Parameters:
+        lat: np.ndarray, 1-D latitudes
+        lon: np.ndarray, 1-D longitudes
+        bbox: tuple, (west, south, east, north)
+    return:
+        tuple, (lat indexes, lon indexes, lon values from west of bbox, ascending)
+    """
+    _, south, _, north = check_bbox(bbox)
+    lat = np.asarray(lat)
+    lat_idx = np.nonzero((lat >= south) & (lat <= north))[0]
+    shifted = lon_in_bbox(lon, bbox)
+    lon_idx = np.nonzero(~np.isnan(shifted))[0]
+    lon_idx = lon_idx[np.argsort(shifted[lon_idx], kind="stable")]
+    if len(lat_idx) == 0 or len(lon_idx) == 0:
+        raise Exception(f"bbox {bbox} has no grid point")
+    return lat_idx, lon_idx, shifted[lon_idx]
+
+
+def read_grid_text(grid_text: str) -> dict:
+    """read a cdo grid description file of a lonlat grid
+
+    return:
+        dict, like {'gridtype': 'lonlat', 'xsize': 2879, 'xfirst': -180.0, 'xinc': 0.125, ...}
+    """
+    grid = {}
+    with open(grid_text) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if "=" not in line:
+                continue
+            k, v = (s.strip() for s in line.split("=", 1))
+            grid[k] = v if k == "gridtype" else float(v) if "." in v or "e" in v.lower() else int(v)
+    if grid.get("gridtype") != "lonlat":
+        raise Exception(f"{grid_text}: only lonlat grid is supported")
+    return grid
+
+
+def write_grid_text(grid: dict, grid_text: str):
+    """write grid as a cdo grid description file"""
+    with open(grid_text, "w") as f:
+        f.write("# CDO grid description file\n")
+        for k in ["gridtype", "xsize", "ysize", "xfirst", "xinc", "yfirst", "yinc"]:
+            f.write(f"{k.ljust(9)} = {grid[k]}\n")
+
+
+def regional_grid(grid: dict, bbox) -> tuple:
+    """cut the part of a lonlat grid inside bbox
+
+    return:
+        tuple, (grid of the part, 0-based x indexes, 0-based y indexes in the global grid)
+    """
+    lon = grid["xfirst"] + grid["xinc"] * np.arange(grid["xsize"])
+    lat = grid["yfirst"] + grid["yinc"] * np.arange(grid["ysize"])
+    y, x, shifted = bbox_index(lat, lon, bbox)
+    if np.any(np.diff(x) < 0):
+        raise Exception(f"bbox {bbox} wraps around the edge of the grid")
+    part = dict(grid)
+    part.update(
+        xsize=len(x),
+        ysize=len(y),
+        xfirst=float(shifted[0]),
+        yfirst=float(lat[y[0]]),
+    )
+    return part, x, y
+
+
+def subset_weights(grid_weight: str, out_fp: str, dst_index: np.ndarray, dst_dims: tuple):
+    """write the SCRIP weights of the destination cells dst_index only
+
+    Parameters:
+        grid_weight: str, SCRIP weights file written by cdo gen*
+        out_fp: str, output weights file
+        dst_index: np.ndarray, 0-based destination cells kept, in the order of the regional grid
+        dst_dims: tuple, (xsize, ysize) of the regional grid
+    """
+    import netCDF4
+
+    with netCDF4.Dataset(grid_weight) as src:
+        src.set_auto_maskandscale(False)
+        size = len(src.dimensions["dst_grid_size"])
+        new = np.full(size, -1, "int64")
+        new[dst_index] = np.arange(len(dst_index))
+        dst_address = src.variables["dst_address"][:].astype("int64") - 1
+        links = np.nonzero(new[dst_address] >= 0)[0]
+        with netCDF4.Dataset(out_fp, "w", format=src.data_model) as dst:
+            dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+            for name, dim in src.dimensions.items():
+                n = {
+                    "dst_grid_size": len(dst_index),
+                    "num_links": len(links),
+                }.get(name, len(dim))
+                dst.createDimension(name, n)
+            for name, var in src.variables.items():
+                out = dst.createVariable(name, var.dtype, var.dimensions)
+                out.setncatts({k: var.getncattr(k) for k in var.ncattrs()})
+                if name == "dst_address":
+                    out[:] = new[dst_address[links]] + 1
+                elif name == "dst_grid_dims":
+                    out[:] = np.asarray(dst_dims, var.dtype)
+                elif var.dimensions[:1] == ("num_links",):
+                    out[:] = var[:][links]
+                elif var.dimensions[:1] == ("dst_grid_size",):
+                    out[:] = var[:][dst_index]
+                else:
+                    out[:] = var[:]
+
+
+def regional_remap(grid_text: str, grid_weight: str, bbox) -> tuple:
+    """get the grid description and weights remapping to the part of grid_text inside bbox
+
+    The regional weights keep the links of the target cells inside bbox
+    only, so the remap computes and writes the region alone. They are cut
+    once and cached under cachehome by the source files and bbox.
+
+    Parameters:
+        grid_text: str, cdo grid description of the global target grid
+        grid_weight: str, SCRIP weights to the global target grid
+        bbox: tuple, (west, south, east, north)
+    return:
+        tuple, (regional grid_text, regional grid_weight)
+    """
+    st = os.stat(grid_weight)
+    key = hashlib.sha256(
+        json.dumps(
+            [
+                os.path.abspath(grid_text),
+                os.path.abspath(grid_weight),
+                st.st_mtime_ns,
+                st.st_size,
+                check_bbox(bbox),
+            ]
+        ).encode("utf-8")
+    ).hexdigest()[:16]
+    out_dir = os.path.join(REMAP_CACHE, key)
+    text_fp = os.path.join(out_dir, "grid.txt")
+    weight_fp = os.path.join(out_dir, "weights.nc")
+    if os.path.exists(weight_fp):
+        return text_fp, weight_fp
+
+    os.makedirs(out_dir, 0o777, exist_ok=True)
+    grid = read_grid_text(grid_text)
+    part, x, y = regional_grid(grid, bbox)
+    # cells are numbered row by row, x fastest
+    dst_index = (y[:, None] * grid["xsize"] + x[None, :]).ravel()
+    tmp = f"{weight_fp}.{os.getpid()}.tmp"
+    write_grid_text(part, f"{text_fp}.{os.getpid()}.tmp")
+    subset_weights(grid_weight, tmp, dst_index, (part["xsize"], part["ysize"]))
+    # the weights are published last, they mark the pair complete
+    os.replace(f"{text_fp}.{os.getpid()}.tmp", text_fp)
+    os.replace(tmp, weight_fp)
+    return text_fp, weight_fp
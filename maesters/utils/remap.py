@@ -0,0 +1,169 @@
+import os
+import threading
+
+import numpy as np
+
+from maesters.utils.region import read_grid_text
+
+# weights loaded in this process, by file and mtime: each worker loads a weights file once
+_REMAPS = {}
+_REMAPS_LOCK = threading.Lock()
+# fields remapped together, each block is accumulated in float64
+REMAP_BLOCK = int(os.environ.get("MAESTERS_REMAP_BLOCK", 4))
+
+
+class SparseRemap:
+    """remap weights as a sparse (dst, src) matrix, applied to many fields in one product
+
+    scipy.sparse is used if it is installed, else the links are sorted by
+    destination and summed with numpy reduceat.
+    """
+
+    def __init__(
+        self,
+        src: np.ndarray,
+        dst: np.ndarray,
+        weights: np.ndarray,
+        src_size: int,
+        dst_dims: tuple,
+    ) -> None:
+        """
+        Parameters:
+            src: np.ndarray, 0-based source cell of every link
+            dst: np.ndarray, 0-based destination cell of every link
+            weights: np.ndarray, weight of every link
+            src_size: int, source cells
+            dst_dims: tuple, (xsize, ysize) of the destination grid
+        """
+        self.src_size = int(src_size)
+        self.dst_dims = (int(dst_dims[0]), int(dst_dims[1]))
+        self.dst_size = self.dst_dims[0] * self.dst_dims[1]
+        # destination cells without link are missing, like cdo
+        self.linked = np.zeros(self.dst_size, bool)
+        self.linked[dst] = True
+        try:
+            from scipy.sparse import csr_matrix
+
+            self._matrix = csr_matrix(
+                (np.asarray(weights, "float64"), (dst, src)),
+                shape=(self.dst_size, self.src_size),
+            )
+        except ImportError:
+            self._matrix = None
+            order = np.argsort(dst, kind="stable")
+            self._src = np.asarray(src)[order]
+            self._weights = np.asarray(weights, "float64")[order]
+            self._dst, self._starts = np.unique(np.asarray(dst)[order], return_index=True)
+
+    @classmethod
+    def from_scrip(cls, grid_weight: str) -> "SparseRemap":
+        """read SCRIP weights, like the ones written by cdo gen*"""
+        import netCDF4
+
+        with netCDF4.Dataset(grid_weight) as nc:
+            nc.set_auto_maskandscale(False)
+            return cls(
+                nc.variables["src_address"][:].astype("int64") - 1,
+                nc.variables["dst_address"][:].astype("int64") - 1,
+                nc.variables["remap_matrix"][:][:, 0],
+                len(nc.dimensions["src_grid_size"]),
+                tuple(nc.variables["dst_grid_dims"][:]),
+            )
+
+    def _dot(self, fields: np.ndarray) -> np.ndarray:
+        if self._matrix is not None:
+            return np.asarray((self._matrix @ fields.T).T)
+        out = np.zeros((fields.shape[0], self.dst_size))
+        out[:, self._dst] = np.add.reduceat(
+            fields[:, self._src] * self._weights, self._starts, axis=1
+        )
+        return out
+
+    def apply(self, fields: np.ndarray) -> np.ndarray:
+        """remap stacked fields, REMAP_BLOCK fields at a time
+
+        The weights of missing source cells are dropped and the rest
+        renormalized, a destination cell with no valid source is missing.
+        The fields are read in their dtype, only the products of a block
+        are float64.
+
+        Parameters:
+            fields: np.ndarray, (fields, src cells), nan for missing
+        return:
+            np.ndarray, float32 (fields, ysize, xsize)
+        """
+        fields = np.asarray(fields).reshape(-1, self.src_size)
+        out = np.empty((fields.shape[0], self.dst_size), "float32")
+        full = None
+        for start in range(0, fields.shape[0], max(1, REMAP_BLOCK)):
+            block = fields[start : start + max(1, REMAP_BLOCK)]
+            valid = ~np.isnan(block)
+            res = self._dot(np.where(valid, block, 0))
+            partial = ~valid.all(axis=1)
+            if partial.any():
+                if full is None:
+                    full = self._dot(np.ones((1, self.src_size), "float32"))
+                norm = self._dot(valid[partial].astype("float32"))
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    res[partial] = np.where(norm > 0, res[partial] * full / norm, np.nan)
+            out[start : start + len(block)] = res
+        out[:, ~self.linked] = np.nan
+        return out.reshape(-1, self.dst_dims[1], self.dst_dims[0])
+
+
+def load_remap(grid_weight: str) -> SparseRemap:
+    """get the SparseRemap of a weights file, read once per process"""
+    key = (os.path.abspath(grid_weight), os.stat(grid_weight).st_mtime_ns)
+    with _REMAPS_LOCK:
+        if key not in _REMAPS:
+            _REMAPS[key] = SparseRemap.from_scrip(grid_weight)
+        return _REMAPS[key]
+
+
+def read_fields(source) -> tuple:
+    """read the messages of a grib as flat fields, on any grid
+
+    Parameters:
+        source: str | bytes, grib filepath or bytes of messages
+    return:
+        tuple, (np.ndarray (messages, cells) nan for missing, [valid time,...], attrs)
+    """
+    from maesters.utils.decode import open_messages
+
+    messages = open_messages(source)
+    if len(messages) == 0:
+        raise Exception(f"{source}: no GRIB message")
+    fields = np.stack(
+        [np.ma.filled(m.values.astype("float32"), np.nan).ravel() for m in messages]
+    )
+    times = [np.datetime64(m.validDate, "ns") for m in messages]
+    attrs = {"units": messages[0].units, "long_name": messages[0].name}
+    return fields, times, attrs
+
+
+def remap_dataset(values: np.ndarray, times: list, varname: str, grid_text: str, attrs: dict = None):
+    """build the dataset of remapped fields on the lonlat grid of grid_text
+
+    Parameters:
+        values: np.ndarray, (time, ysize, xsize)
+        times: list, valid time of every field
+        varname: str, variable name in the dataset
+        grid_text: str, cdo grid description of the destination grid
+        attrs: dict, attributes of the variable
+    return:
+        xr.Dataset, varname(time, lat, lon)
+    """
+    import xarray as xr
+
+    grid = read_grid_text(grid_text)
+    if values.shape[1:] != (grid["ysize"], grid["xsize"]):
+        raise Exception(f"{grid_text} is not the grid of the weights")
+    lon = grid["xfirst"] + grid["xinc"] * np.arange(grid["xsize"])
+    lat = grid["yfirst"] + grid["yinc"] * np.arange(grid["ysize"])
+    ds = xr.Dataset(
+        {varname: (("time", "lat", "lon"), values, attrs or {})},
+        coords={"time": times, "lat": lat, "lon": lon},
+    )
+    ds["lat"].attrs = {"units": "degrees_north", "standard_name": "latitude"}
+    ds["lon"].attrs = {"units": "degrees_east", "standard_name": "longitude"}
+    return ds
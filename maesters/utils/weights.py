@@ -0,0 +1,446 @@
+import os
+import json
+import hashlib
+from dataclasses import dataclass, field, astuple
+
+import numpy as np
+
+from maesters.config import DEFAULT_MAESTER
+from maesters.utils.region import read_grid_text, write_grid_text
+
+METHODS = ["nearest", "bilinear", "conservative"]
+MAP_METHODS = {
+    "nearest": "Nearest neighbor",
+    "bilinear": "Bilinear remapping",
+    "conservative": "Conservative remapping",
+}
+# generated grid descriptions and weights, by the hash of source grid, target grid and method
+WEIGHT_CACHE = os.path.join(DEFAULT_MAESTER["cachehome"], "weights")
+# target cells are split n x n to estimate their overlap with unstructured source cells
+CONSERVATIVE_SUBSAMPLE = int(os.environ.get("MAESTERS_CONSERVATIVE_SUBSAMPLE", 4))
+# target points searched at once, bounding the memory of the generation
+WEIGHT_BLOCK = int(os.environ.get("MAESTERS_WEIGHT_BLOCK", 1 << 22))
+
+
+@dataclass
+class GridSpec:
+    """regular lon-lat grid, like a cdo lonlat grid description
+
+    Cells are numbered row by row, x fastest, like the values of a regular_ll GRIB.
+
+    Attributes:
+        xsize: points along longitude
+        ysize: points along latitude
+        xfirst: longitude of the first point, degrees
+        xinc: longitude step, degrees
+        yfirst: latitude of the first point, degrees
+        yinc: latitude step, negative for rows from north to south
+    """
+
+    xsize: int
+    ysize: int
+    xfirst: float
+    xinc: float
+    yfirst: float
+    yinc: float
+
+    def __post_init__(self):
+        self.xsize, self.ysize = int(self.xsize), int(self.ysize)
+        self.xfirst, self.xinc = float(self.xfirst), float(self.xinc)
+        self.yfirst, self.yinc = float(self.yfirst), float(self.yinc)
+        if self.xsize < 1 or self.ysize < 1 or self.xinc <= 0 or self.yinc == 0:
+            raise Exception(f"{self} is not a lonlat grid")
+
+    @classmethod
+    def from_text(cls, grid_text: str) -> "GridSpec":
+        """read a cdo grid description file"""
+        grid = read_grid_text(grid_text)
+        return cls(*(grid[k] for k in ["xsize", "ysize", "xfirst", "xinc", "yfirst", "yinc"]))
+
+    @classmethod
+    def from_message(cls, message) -> "GridSpec":
+        """get the grid of a regular_ll pygrib message"""
+        if message.gridType != "regular_ll" or message.iScansNegatively:
+            raise Exception(f"{message.gridType} grid is not regular_ll from west to east")
+        yinc = message.jDirectionIncrementInDegrees
+        return cls(
+            message.Ni,
+            message.Nj,
+            message.longitudeOfFirstGridPointInDegrees,
+            message.iDirectionIncrementInDegrees,
+            message.latitudeOfFirstGridPointInDegrees,
+            yinc if message.jScansPositively else -yinc,
+        )
+
+    @classmethod
+    def world(cls, resolution: float) -> "GridSpec":
+        """get the global grid of resolution degrees, from -180 and -90 like target_grid_world_0125"""
+        return cls(
+            round(360 / resolution), round(180 / resolution) + 1, -180, resolution, -90, resolution
+        )
+
+    def write_text(self, grid_text: str):
+        """write the grid as a cdo grid description file"""
+        write_grid_text(
+            {"gridtype": "lonlat", **dict(zip(self.__dataclass_fields__, astuple(self)))},
+            grid_text,
+        )
+
+    @property
+    def key(self) -> str:
+        return json.dumps(["lonlat", *astuple(self)])
+
+    @property
+    def size(self) -> int:
+        return self.xsize * self.ysize
+
+    @property
+    def lon(self) -> np.ndarray:
+        return self.xfirst + self.xinc * np.arange(self.xsize)
+
+    @property
+    def lat(self) -> np.ndarray:
+        return self.yfirst + self.yinc * np.arange(self.ysize)
+
+    @property
+    def wrap(self) -> bool:
+        """the rows go round the globe"""
+        return abs(self.xinc * self.xsize - 360) < 1e-6
+
+    def points(self, start: int = 0, stop: int = None) -> tuple:
+        """get the flat lat and lon of the points of rows start to stop"""
+        lat = self.lat[start:stop]
+        return np.repeat(lat, self.xsize), np.tile(self.lon, len(lat))
+
+
+@dataclass
+class CellGrid:
+    """unstructured grid by cell centers, like the icosahedral grid of ICON
+
+    Attributes:
+        lat: latitude of the cell centers, degrees
+        lon: longitude of the cell centers, degrees
+        key: identity of the grid in the weight cache
+    """
+
+    lat: np.ndarray = field(repr=False)
+    lon: np.ndarray = field(repr=False)
+    key: str
+
+    @classmethod
+    def from_icon(cls, grid_file: str) -> "CellGrid":
+        """read the cell centers of an ICON grid file, like icon_grid_0026_R03B07_G.nc"""
+        import netCDF4
+
+        with netCDF4.Dataset(grid_file) as nc:
+            lat = np.degrees(nc.variables["clat"][:].astype("float64"))
+            lon = np.degrees(nc.variables["clon"][:].astype("float64"))
+            if "uuidOfHGrid" in nc.ncattrs():
+                key = nc.getncattr("uuidOfHGrid")
+            else:
+                st = os.stat(grid_file)
+                key = json.dumps([os.path.abspath(grid_file), st.st_mtime_ns, st.st_size])
+        return cls(lat, lon, key)
+
+    @property
+    def size(self) -> int:
+        return len(self.lat)
+
+
+def source_grid(src):
+    """get the source grid of src, a GridSpec, CellGrid, cdo grid description or ICON grid file"""
+    if isinstance(src, (GridSpec, CellGrid)):
+        return src
+    if str(src).endswith(".txt"):
+        return GridSpec.from_text(src)
+    return CellGrid.from_icon(src)
+
+
+def target_grid(dst) -> GridSpec:
+    """get the target grid of dst, a GridSpec, cdo grid description or dict of its keys"""
+    if isinstance(dst, GridSpec):
+        return dst
+    if isinstance(dst, dict):
+        return GridSpec(**{k: v for k, v in dst.items() if k != "gridtype"})
+    return GridSpec.from_text(dst)
+
+
+def _xyz(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """get points on the unit sphere, (n, 3)"""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], -1)
+
+
+def _cell_tree(src: CellGrid):
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        raise Exception(
+            "weights from an unstructured grid need scipy, pip install maesters-nwp[remap]"
+        )
+    return cKDTree(_xyz(src.lat, src.lon))
+
+
+def _axis(coord: np.ndarray, first: float, inc: float, period: float = None) -> np.ndarray:
+    """get the fractional indexes of coord along a regular axis, period 360 for longitudes"""
+    coord = np.asarray(coord, "float64")
+    if period:
+        half = 0.5 * abs(inc)
+        return ((coord - first + half) % period - half) / inc
+    return (coord - first) / inc
+
+
+def _nearest_regular(src: GridSpec, lat: np.ndarray, lon: np.ndarray) -> tuple:
+    i = np.round(_axis(lon, src.xfirst, src.xinc, 360)).astype("int64")
+    j = np.round(_axis(lat, src.yfirst, src.yinc)).astype("int64")
+    ok = (j >= 0) & (j < src.ysize)
+    if src.wrap:
+        i %= src.xsize
+    else:
+        ok &= (i >= 0) & (i < src.xsize)
+    dst = np.nonzero(ok)[0]
+    return j[ok] * src.xsize + i[ok], dst, np.ones(len(dst))
+
+
+def _bilinear_regular(src: GridSpec, lat: np.ndarray, lon: np.ndarray) -> tuple:
+    x = _axis(lon, src.xfirst, src.xinc, 360)
+    y = _axis(lat, src.yfirst, src.yinc)
+    # points within half a step outside of the source are taken from its edge
+    ok = (y >= -0.5) & (y <= src.ysize - 0.5)
+    y = np.clip(y, 0, src.ysize - 1)
+    if not src.wrap:
+        ok &= (x >= -0.5) & (x <= src.xsize - 0.5)
+        x = np.clip(x, 0, src.xsize - 1)
+    i0, j0 = np.floor(x).astype("int64"), np.floor(y).astype("int64")
+    fx, fy = x - i0, y - j0
+    j1 = np.minimum(j0 + 1, src.ysize - 1)
+    i1 = (i0 + 1) % src.xsize if src.wrap else np.minimum(i0 + 1, src.xsize - 1)
+    i0 %= src.xsize
+    corners = [
+        (j0, i0, (1 - fy) * (1 - fx)),
+        (j0, i1, (1 - fy) * fx),
+        (j1, i0, fy * (1 - fx)),
+        (j1, i1, fy * fx),
+    ]
+    dst = np.nonzero(ok)[0]
+    links = [(j[ok] * src.xsize + i[ok], dst, w[ok]) for j, i, w in corners]
+    return tuple(np.concatenate(a) for a in zip(*links))
+
+
+def _nearest_cells(tree, lat: np.ndarray, lon: np.ndarray) -> tuple:
+    _, src = tree.query(_xyz(lat, lon), k=1, workers=-1)
+    return src.astype("int64"), np.arange(len(src)), np.ones(len(src))
+
+
+def _bilinear_cells(tree, lat: np.ndarray, lon: np.ndarray) -> tuple:
+    """linear interpolation in the triangle of the 3 nearest cell centers
+
+    The barycentric weights are taken in the plane of the triangle, clipped
+    to positive and normalized, a degenerate triangle falls back to the nearest.
+    """
+    p = _xyz(lat, lon)
+    _, src = tree.query(p, k=3, workers=-1)
+    vertices = tree.data[src].transpose(0, 2, 1)
+    ok = np.abs(np.linalg.det(vertices)) > 1e-12
+    w = np.zeros(src.shape)
+    w[ok] = np.linalg.solve(vertices[ok], p[ok][..., None])[..., 0]
+    w = np.clip(w, 0, None)
+    total = w.sum(1)
+    bad = total <= 0
+    w[bad] = [1, 0, 0]
+    total[bad] = 1
+    w /= total[:, None]
+    dst = np.repeat(np.arange(len(src)), 3)
+    keep = w.ravel() > 0
+    return src.ravel()[keep].astype("int64"), dst[keep], w.ravel()[keep]
+
+
+def _sin_bounds(grid: GridSpec) -> tuple:
+    lat = grid.lat
+    half = 0.5 * abs(grid.yinc)
+    return (
+        np.sin(np.radians(np.clip(lat - half, -90, 90))),
+        np.sin(np.radians(np.clip(lat + half, -90, 90))),
+    )
+
+
+def _overlap(dst_lo, dst_hi, src_lo, src_hi) -> np.ndarray:
+    return np.clip(
+        np.minimum(dst_hi[:, None], src_hi[None, :]) - np.maximum(dst_lo[:, None], src_lo[None, :]),
+        0,
+        None,
+    )
+
+
+def _conservative_regular(src: GridSpec, dst: GridSpec) -> tuple:
+    """exact overlap areas of two lonlat grids, separable in sin(lat) and lon"""
+    oy = _overlap(*_sin_bounds(dst), *_sin_bounds(src))
+    half_d, half_s = 0.5 * dst.xinc, 0.5 * src.xinc
+    ox = sum(
+        _overlap(dst.lon - half_d, dst.lon + half_d, src.lon - half_s + s, src.lon + half_s + s)
+        for s in (-360, 0, 360)
+    )
+    # fracarea: normalized by the area of the target cell covered by the source
+    with np.errstate(invalid="ignore", divide="ignore"):
+        oy /= oy.sum(1, keepdims=True)
+        ox /= ox.sum(1, keepdims=True)
+    j, q = np.nonzero(oy > 0)
+    i, p = np.nonzero(ox > 0)
+    return (
+        (q[:, None] * src.xsize + p[None, :]).ravel(),
+        (j[:, None] * dst.xsize + i[None, :]).ravel(),
+        (oy[j, q][:, None] * ox[i, p][None, :]).ravel(),
+    )
+
+
+def _conservative_cells(tree, dst: GridSpec, start: int, stop: int, n: int) -> tuple:
+    """overlap of the target cells of rows start to stop with the source cells
+
+    Each target cell is split into n x n parts of equal area, a part belongs
+    to the source cell of the nearest center.
+    """
+    lo, hi = (b[start:stop] for b in _sin_bounds(dst))
+    k = (np.arange(n) + 0.5) / n
+    lat = np.degrees(np.arcsin((lo[:, None] + (hi - lo)[:, None] * k).ravel()))
+    lon = (dst.lon[:, None] - 0.5 * dst.xinc + dst.xinc * k).ravel()
+    _, src = tree.query(
+        _xyz(np.repeat(lat, len(lon)), np.tile(lon, len(lat))), k=1, workers=-1
+    )
+    rows = np.repeat(np.arange(start, stop), n)
+    cols = np.repeat(np.arange(dst.xsize), n)
+    cell = (rows[:, None] * dst.xsize + cols[None, :]).ravel()
+    links, counts = np.unique(cell * tree.n + src, return_counts=True)
+    return links % tree.n, links // tree.n, counts / (n * n)
+
+
+def gen_weights(src, dst: GridSpec, method: str = "conservative") -> tuple:
+    """generate the remap weights from src to dst
+
+    Parameters:
+        src: GridSpec | CellGrid, source grid
+        dst: GridSpec, target grid
+        method: str, 'nearest', 'bilinear' or 'conservative'
+    return:
+        tuple, (0-based source cells, 0-based target cells, weights) of the links, sorted by target
+    """
+    if method not in METHODS:
+        raise Exception(f"method {method} not in {METHODS}")
+    if method == "conservative" and isinstance(src, GridSpec):
+        links = [_conservative_regular(src, dst)]
+    else:
+        tree = None if isinstance(src, GridSpec) else _cell_tree(src)
+        n = CONSERVATIVE_SUBSAMPLE if method == "conservative" else 1
+        rows = max(1, WEIGHT_BLOCK // (dst.xsize * n * n))
+        links = []
+        for start in range(0, dst.ysize, rows):
+            stop = min(start + rows, dst.ysize)
+            if method == "conservative":
+                links.append(_conservative_cells(tree, dst, start, stop, n))
+                continue
+            if tree is None:
+                func = _nearest_regular if method == "nearest" else _bilinear_regular
+                s, d, w = func(src, *dst.points(start, stop))
+            else:
+                func = _nearest_cells if method == "nearest" else _bilinear_cells
+                s, d, w = func(tree, *dst.points(start, stop))
+            links.append((s, d + start * dst.xsize, w))
+    s, d, w = (np.concatenate(a) for a in zip(*links))
+    order = np.lexsort((s, d))
+    return s[order], d[order], w[order]
+
+
+def write_scrip(
+    weight_fp: str, links: tuple, src, dst: GridSpec, method: str
+):
+    """write the links as SCRIP weights, read by SparseRemap.from_scrip and regional_remap
+
+    Parameters:
+        weight_fp: str, output weights file
+        links: tuple, (0-based source cells, 0-based target cells, weights)
+        src: GridSpec | CellGrid, source grid
+        dst: GridSpec, target grid
+        method: str, 'nearest', 'bilinear' or 'conservative'
+    """
+    import netCDF4
+
+    s, d, w = links
+    if isinstance(src, GridSpec):
+        src_dims, (src_lat, src_lon) = [src.xsize, src.ysize], src.points()
+    else:
+        src_dims, src_lat, src_lon = [src.size], src.lat, src.lon
+    dst_lat, dst_lon = dst.points()
+    frac = np.zeros(dst.size)
+    frac[d] = 1
+    with netCDF4.Dataset(weight_fp, "w", format="NETCDF4") as nc:
+        nc.setncatts(
+            {
+                "title": f"{method} weights generated by maesters",
+                "normalization": "fracarea",
+                "map_method": MAP_METHODS[method],
+                "conventions": "SCRIP",
+            }
+        )
+        for name, n in [
+            ("src_grid_size", src.size),
+            ("dst_grid_size", dst.size),
+            ("src_grid_rank", len(src_dims)),
+            ("dst_grid_rank", 2),
+            ("num_links", len(w)),
+            ("num_wgts", 1),
+        ]:
+            nc.createDimension(name, n)
+        for name, dtype, dims, values in [
+            ("src_grid_dims", "i4", ("src_grid_rank",), src_dims),
+            ("dst_grid_dims", "i4", ("dst_grid_rank",), [dst.xsize, dst.ysize]),
+            ("src_grid_center_lat", "f8", ("src_grid_size",), src_lat),
+            ("src_grid_center_lon", "f8", ("src_grid_size",), src_lon),
+            ("dst_grid_center_lat", "f8", ("dst_grid_size",), dst_lat),
+            ("dst_grid_center_lon", "f8", ("dst_grid_size",), dst_lon),
+            ("src_grid_imask", "i4", ("src_grid_size",), np.ones(src.size)),
+            ("dst_grid_imask", "i4", ("dst_grid_size",), np.ones(dst.size)),
+            ("dst_grid_frac", "f8", ("dst_grid_size",), frac),
+            ("src_address", "i4", ("num_links",), s + 1),
+            ("dst_address", "i4", ("num_links",), d + 1),
+            ("remap_matrix", "f8", ("num_links", "num_wgts"), w[:, None]),
+        ]:
+            var = nc.createVariable(name, dtype, dims)
+            if "center" in name:
+                var.units = "degrees"
+            var[:] = values
+
+
+def grid_weights(src, dst, method: str = "conservative") -> tuple:
+    """get the grid description and weights remapping src to dst, generated once
+
+    The weights are cached under cachehome by the hash of the source grid,
+    target grid and method, so every run and worker after the first one
+    reads them from disk, like the static ICON weights.
+
+    Parameters:
+        src: GridSpec | CellGrid | str, source grid, or its cdo grid description or ICON grid file
+        dst: GridSpec | dict | str, target grid, or its cdo grid description
+        method: str, 'nearest', 'bilinear' or 'conservative'
+    return:
+        tuple, (grid_text, grid_weight) for the tri transform
+    """
+    if method not in METHODS:
+        raise Exception(f"method {method} not in {METHODS}")
+    src, dst = source_grid(src), target_grid(dst)
+    spec = [src.key, dst.key, method]
+    if method == "conservative" and isinstance(src, CellGrid):
+        spec.append(CONSERVATIVE_SUBSAMPLE)
+    key = hashlib.sha256(json.dumps(spec).encode("utf-8")).hexdigest()[:16]
+    out_dir = os.path.join(WEIGHT_CACHE, key)
+    text_fp = os.path.join(out_dir, "grid.txt")
+    weight_fp = os.path.join(out_dir, "weights.nc")
+    if os.path.exists(weight_fp):
+        return text_fp, weight_fp
+
+    os.makedirs(out_dir, 0o777, exist_ok=True)
+    tmp = f"{weight_fp}.{os.getpid()}.tmp"
+    dst.write_text(f"{text_fp}.{os.getpid()}.tmp")
+    write_scrip(tmp, gen_weights(src, dst, method), src, dst, method)
+    # the weights are published last, they mark the pair complete
+    os.replace(f"{text_fp}.{os.getpid()}.tmp", text_fp)
+    os.replace(tmp, weight_fp)
+    return text_fp, weight_fp
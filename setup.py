@@ -28,6 +28,7 @@ setup(
     # package_data={"": ["*.toml","*.txt"]},
     packages=find_packages(),
     install_requires=required,
+    extras_require={"async": ["aiohttp"], "zarr": ["zarr", "dask"], "remap": ["scipy"]},
     classifiers=[
         "Programming Language :: Python :: 3",
     ],
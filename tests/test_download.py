@@ -0,0 +1,75 @@
+import io
+
+from maesters.utils import download
+from maesters.utils.download import plan_range_spans
+
+
+def test_merge_adjacent_and_near_ranges():
+    ranges = [(200, 300, "c"), (0, 100, "a"), (100, 150, "b"), (2000, 2100, "d")]
+    spans = plan_range_spans(ranges, gap_bytes=0, file_size=None)
+    assert [(s, e) for s, e, _ in spans] == [(0, 150), (200, 300), (2000, 2100)]
+    assert [m[2] for m in spans[0][2]] == ["a", "b"]
+    spans = plan_range_spans(ranges, gap_bytes=50, file_size=None)
+    assert [(s, e) for s, e, _ in spans] == [(0, 300), (2000, 2100)]
+
+
+def test_gap_bytes_merges_within_gap():
+    ranges = [(0, 100, "a"), (150, 200, "b"), (400, 500, "c")]
+    spans = plan_range_spans(ranges, gap_bytes=50, file_size=None)
+    assert [(s, e) for s, e, _ in spans] == [(0, 200), (400, 500)]
+    assert [m[2] for m in spans[0][2]] == ["a", "b"]
+    spans = plan_range_spans(ranges, gap_bytes=0, file_size=None)
+    assert len(spans) == 3
+
+
+def test_whole_file_fallback():
+    ranges = [(0, 400, "a"), (500, 900, "b")]
+    spans = plan_range_spans(ranges, gap_bytes=0, file_size=1000, whole_file_ratio=0.8)
+    assert spans == [(0, 1000, [(0, 400, "a"), (500, 900, "b")])]
+    spans = plan_range_spans(ranges, gap_bytes=0, file_size=10000, whole_file_ratio=0.8)
+    assert [(s, e) for s, e, _ in spans] == [(0, 400), (500, 900)]
+    assert plan_range_spans([], file_size=1000) == []
+
+
+class FakeResponse:
+    def __init__(self, content: bytes, start: int, end: int, piece: int):
+        self.content = content
+        self.status_code = 206
+        self.headers = {"Content-Range": f"bytes {start}-{end - 1}/{len(content)}"}
+        self.url = "http://host/file"
+        self._body = content[start:end]
+        self._piece = piece
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        for i in range(0, len(self._body), self._piece):
+            yield self._body[i : i + self._piece]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeSession:
+    def __init__(self, content: bytes, piece: int):
+        self.content = content
+        self.piece = piece
+
+    def get(self, url, headers, **kwargs):
+        start, end = headers["Range"][6:].split("-")
+        return FakeResponse(self.content, int(start), int(end) + 1, self.piece)
+
+
+def test_span_split_across_chunk_boundaries(monkeypatch):
+    content = bytes(range(256)) * 4
+    members = [(10, 13, "a"), (13, 40, "b"), (60, 61, "c"), (61, 200, "d")]
+    for piece in [1, 3, 7, 64, 1024]:
+        session = FakeSession(content, piece)
+        monkeypatch.setattr(download, "get_session", lambda url: session)
+        handles = [io.BytesIO() for _ in members]
+        download._stream_span("http://host/file", 10, 200, members, handles)
+        assert [h.getvalue() for h in handles] == [content[s:e] for s, e, _ in members]
@@ -0,0 +1,40 @@
+import numpy as np
+
+from maesters.utils.encoding import Encoding, bitround, cdo_chunktype, cdo_options
+
+
+def test_bitround():
+    values = np.array([1.0, 3.14159265, -2.5e-7, 123456.789, np.nan], "float32")
+    rounded = bitround(values, 8)
+    assert rounded.dtype == np.float32 and np.isnan(rounded[-1])
+    np.testing.assert_allclose(rounded[:-1], values[:-1], rtol=2.0**-8)
+    # the dropped mantissa bits are zero
+    assert not (rounded[:-1].view("uint32") & ((1 << 15) - 1)).any()
+    assert (bitround(values, 23)[:-1] == values[:-1]).all()
+
+
+def test_cdo_options():
+    def options(encoding):
+        return " ".join(cdo_options(encoding, "nc"))
+
+    assert options(None) == "-f nc"
+    assert options(Encoding()) == "-f nc -b F32"
+    assert options(Encoding(compression="zlib", level=5)) == (
+        "-f nc4 -b F32 -k grid -z zip_5 --shuffle"
+    )
+    assert options(Encoding(compression="zstd", shuffle=False, dtype="float64")) == (
+        "-f nc4 -b F64 -k grid -z zstd_4"
+    )
+    assert options(Encoding(chunks={"lat": 1})) == "-f nc4 -b F32 -k lines"
+    # packed when rewritten, not compressed twice
+    packed = Encoding(compression="zlib", pack="int16")
+    assert packed.rewrite and options(packed) == "-f nc -b F32"
+
+
+def test_cdo_chunktype():
+    assert cdo_chunktype(None) == "grid"
+    assert cdo_chunktype({"time": 1, "lat": 1000, "lon": 1000}) == "grid"
+    assert cdo_chunktype({"lat": 1}) == "lines"
+    assert cdo_chunktype({"time": 24}) is None
+    assert Encoding(chunks={"time": 24}).rewrite
+    assert not Encoding(chunks={"lat": 256, "lon": 256}).rewrite
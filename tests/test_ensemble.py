@@ -0,0 +1,68 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from maesters.utils.ensemble import ens_stats, parse_stats, stat_suffix
+
+
+@pytest.fixture
+def values():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(21, 5, 7)).astype("float32")
+    values[3, 0, 0] = np.nan
+    values[:, 1, 1] = np.nan
+    return values
+
+
+def test_stats_match_nan_reductions(values):
+    stats = [
+        "ensmean",
+        "ensstd",
+        "ensstd1",
+        "ensvar",
+        "ensvar1",
+        "ensmin",
+        "ensmax",
+        "enssum",
+        "ensrange",
+        "ensmedian",
+        "enspctl,90",
+        "ensprob,gt,0.5",
+        "ensprob,le,0",
+    ]
+    out = ens_stats(values, stats)
+    v = values.astype("float64")
+    count = (~np.isnan(v)).sum(0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = {
+            "ensmean": np.nanmean(v, 0),
+            "ensstd": np.nanstd(v, 0),
+            "ensstd1": np.nanstd(v, 0, ddof=1),
+            "ensvar": np.nanvar(v, 0),
+            "ensvar1": np.nanvar(v, 0, ddof=1),
+            "ensmin": np.nanmin(v, 0),
+            "ensmax": np.nanmax(v, 0),
+            "enssum": np.where(count > 0, np.nansum(v, 0), np.nan),
+            "ensrange": np.nanmax(v, 0) - np.nanmin(v, 0),
+            "ensmedian": np.nanmedian(v, 0),
+            "enspctl,90": np.nanpercentile(v, 90, 0),
+            "ensprob,gt,0.5": np.where(count > 0, (v > 0.5).sum(0) / count, np.nan),
+            "ensprob,le,0": np.where(count > 0, (v <= 0).sum(0) / count, np.nan),
+        }
+    for s in stats:
+        assert out[s].dtype == np.float32
+        np.testing.assert_allclose(out[s], expected[s], rtol=1e-5, atol=1e-6, err_msg=s)
+    # a cell without member is missing
+    assert all(np.isnan(out[s][1, 1]) for s in stats)
+
+
+def test_parse_stats():
+    assert parse_stats("ensmean") == ["ensmean"]
+    assert stat_suffix("ensprob,gt,0.001") == "ENSPROBGT0P001"
+    for bad in [[], "ensfoo", "enspctl,101", "ensprob,eq,1", "ensmean,1"]:
+        with pytest.raises(Exception):
+            parse_stats(bad)
+    with pytest.raises(Exception):
+        ens_stats(np.zeros((2, 3)), ["ensskew"])
@@ -0,0 +1,71 @@
+import pytest
+
+from maesters.utils.grib import (
+    MAX_PADDING,
+    GribStreamChecker,
+    check_grib,
+    split_messages,
+)
+
+
+def message(length: int) -> bytes:
+    """a GRIB2 message of length bytes, section 0, filler and section 8"""
+    head = b"GRIB\0\0\0\x02" + length.to_bytes(8, "big")
+    return head + b"\x01" * (length - 20) + b"7777"
+
+
+MESSAGES = [message(40), message(100), message(64)]
+
+
+def stream(buf: bytes, piece: int) -> int:
+    checker = GribStreamChecker()
+    for i in range(0, len(buf), piece):
+        checker.update(buf[i : i + piece])
+    return checker.close()
+
+
+@pytest.mark.parametrize("piece", [1, 3, 17, 4096])
+def test_stream_contiguous(piece):
+    assert stream(b"".join(MESSAGES), piece) == 3
+
+
+@pytest.mark.parametrize("piece", [1, 3, 17, 4096])
+def test_stream_zero_padding(piece):
+    assert stream((b"\0" * 8).join(MESSAGES), piece) == 3
+
+
+@pytest.mark.parametrize(
+    "buf",
+    [
+        b"".join(MESSAGES)[:-5],
+        b"".join(MESSAGES)[:50],
+        b"<html>" + b"".join(MESSAGES),
+        b"".join(MESSAGES) + b"\0\0",
+        MESSAGES[0] + b"xx" + MESSAGES[1],
+        (b"\0" * (MAX_PADDING + 1)).join(MESSAGES),
+        MESSAGES[0][:-4] + b"7778",
+    ],
+)
+@pytest.mark.parametrize("piece", [1, 7, 4096])
+def test_stream_rejects(buf, piece):
+    with pytest.raises(Exception):
+        stream(buf, piece)
+
+
+def test_check_grib_file(tmp_path):
+    fp = str(tmp_path / "a.grib2")
+    with open(fp, "wb") as f:
+        f.write((b"\0" * 4).join(MESSAGES))
+    assert check_grib(fp) == 3
+    with pytest.raises(Exception):
+        check_grib(fp, messages=4)
+    with open(fp, "wb") as f:
+        f.write(b"".join(MESSAGES)[:-1])
+    with pytest.raises(Exception):
+        check_grib(fp)
+
+
+def test_split_messages():
+    assert split_messages((b"\0" * 4).join(MESSAGES)) == MESSAGES
+    with pytest.raises(Exception):
+        split_messages(b"junk" + b"".join(MESSAGES))
@@ -0,0 +1,59 @@
+import os
+
+from maesters.utils.journal import DownloadJournal
+
+
+def run_batch(local_dir, batch, urls, convert=True):
+    """plan, download and convert the urls of batch like a citadel operation"""
+    journal = DownloadJournal.for_batch(local_dir, batch)
+    if journal.is_complete():
+        return journal
+    tmp_dir = local_dir + "_tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    if not journal.is_planned():
+        journal.plan([(u, os.path.join(tmp_dir, f"{batch}_{u}.grib2")) for u in urls])
+        journal.close_plan()
+    for url, local_fp in journal.pending_downloads():
+        with open(local_fp, "wb") as f:
+            f.write(b"GRIB")
+        journal.downloaded(local_fp, 4)
+    if convert:
+        pending = journal.pending_conversions()
+        in_out_list = [(fp, fp.replace(".grib2", ".nc")) for fp in pending]
+        journal.converted(in_out_list)
+    return journal
+
+
+def test_consecutive_batches(tmp_path):
+    local_dir = str(tmp_path / "latest")
+    first = run_batch(local_dir, "2024010300", ["a", "b"])
+    assert first.is_complete()
+    second = DownloadJournal.for_batch(local_dir, "2024010312")
+    assert not second.is_planned()
+    assert not second.is_complete()
+    second = run_batch(local_dir, "2024010312", ["a", "b", "c"])
+    assert second.is_complete()
+    tmp_dir = local_dir + "_tmp"
+    assert second.stage(os.path.join(tmp_dir, "2024010312_c.grib2")) == "converted"
+    assert second.stage(os.path.join(tmp_dir, "2024010300_a.grib2")) is None
+
+
+def test_crashed_batch_is_not_resumed_by_next(tmp_path):
+    local_dir = str(tmp_path / "latest")
+    crashed = run_batch(local_dir, "2024010300", ["a", "b"], convert=False)
+    stale = crashed.pending_conversions()
+    assert len(stale) == 2
+    journal = DownloadJournal.for_batch(local_dir, "2024010312")
+    assert journal.pending_downloads() == []
+    assert journal.pending_conversions() == []
+    assert not any(os.path.exists(fp) for fp in stale)
+    journal = run_batch(local_dir, "2024010312", ["c"])
+    assert journal.is_complete()
+
+
+def test_same_batch_resumes(tmp_path):
+    local_dir = str(tmp_path / "latest")
+    run_batch(local_dir, "2024010300", ["a", "b"], convert=False)
+    journal = DownloadJournal.for_batch(local_dir, "2024010300")
+    assert journal.is_planned()
+    assert len(journal.pending_conversions()) == 2
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from maesters.utils.remap import SparseRemap
+from maesters.utils.weights import CellGrid, GridSpec, gen_weights
+
+SRC = GridSpec(36, 19, 0, 10, -90, 10)
+DST = GridSpec(24, 13, -180, 15, -90, 15)
+
+
+def remap(src, method):
+    s, d, w = gen_weights(src, DST, method)
+    return s, d, w, SparseRemap(s, d, w, src.size, (DST.xsize, DST.ysize))
+
+
+@pytest.mark.parametrize("method", ["nearest", "bilinear", "conservative"])
+@pytest.mark.parametrize("src", [SRC, CellGrid(*SRC.points(), key="cells")])
+def test_weight_row_sums(src, method):
+    if isinstance(src, CellGrid):
+        pytest.importorskip("scipy")
+    s, d, w, _ = remap(src, method)
+    np.testing.assert_allclose(np.bincount(d, w, minlength=DST.size), 1, atol=1e-12)
+
+
+@pytest.mark.parametrize("method", ["nearest", "bilinear", "conservative"])
+def test_remap_lat_only_field(method):
+    _, _, _, r = remap(SRC, method)
+    field = np.repeat(SRC.lat, SRC.xsize).astype("float32")[None]
+    out = r.apply(field)
+    assert out.shape == (1, DST.ysize, DST.xsize) and out.dtype == np.float32
+    # constant along longitude
+    np.testing.assert_allclose(out[0], out[0][:, :1].repeat(DST.xsize, 1), atol=1e-5)
+    if method == "bilinear":
+        np.testing.assert_allclose(out[0][:, 0], DST.lat, atol=1e-5)
+
+
+def test_remap_missing_cells():
+    _, _, _, r = remap(SRC, "bilinear")
+    field = np.repeat(SRC.lat, SRC.xsize).astype("float32")
+    fields = np.stack([field, field, np.full_like(field, np.nan)])
+    fields[1, ::5] = np.nan
+    out = r.apply(fields)
+    # the weights of the missing cells are renormalized over the valid ones,
+    # a target cell whose only source is missing is missing
+    valid = np.isfinite(out[1])
+    assert valid.mean() > 0.8
+    assert np.abs(out[1] - out[0])[valid].max() <= abs(SRC.yinc)
+    assert np.isnan(out[2]).all()